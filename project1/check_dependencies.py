@@ -29,6 +29,13 @@ try:
 except ImportError:
     print 'You do not have argparse installed. Please use pip or your favorite method to install argparse for python.'
 
+try:
+    print 'Checking for scipy maxflow (optional)...'
+    from scipy.sparse.csgraph import maximum_flow
+    print 'scipy maxflow found.'
+except ImportError:
+    print 'You do not have scipy >= 1.4 installed. The scipy maxflow solver will not be available.'
+
 try:
     print 'Checking for Cython...'
     import Cython
@@ -45,4 +52,15 @@ except ImportError:
     process = subprocess.Popen(["sh", "./third_party/pymaxflow/build.sh"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     output = process.communicate()[0]
     print ''
-    print 'pymaxflow built and linked'
\ No newline at end of file
+    print 'pymaxflow built and linked'
+
+try:
+    print 'pypushrelabel...'
+    import third_party.pushrelabel.pypushrelabel as pypushrelabel
+    print 'pypushrelabel found.'
+except ImportError:
+    print 'You have not built pypushrelabel yet. Going to build it for you now...'
+    process = subprocess.Popen(["sh", "./third_party/pushrelabel/build.sh"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = process.communicate()[0]
+    print ''
+    print 'pypushrelabel built and linked'
\ No newline at end of file
@@ -0,0 +1,300 @@
+import sys
+import os
+import time
+import argparse
+import resource
+from multiprocessing import Process, Queue
+
+import matplotlib.pyplot as plt
+import numpy as np
+import grabcut
+import maxflow_solvers
+from gmm import update_gmms
+
+#################################################################
+# BEGIN REQUIRED INPUT PARAMETERS
+
+# Bounding box and file extension
+BBOX_DIR = "bboxes/"
+BBOX_EXT = ".txt"
+
+# Input images and file extension
+DATA_DIR = "data_GT/"
+DATA_EXT = ".jpg"
+
+# END REQUIRED INPUT PARAMETERS
+#################################################################
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks GrabCut on all images. In solvers mode, every \
+                    maxflow backend solves the exact same graph (from the first \
+                    GrabCut iteration), and its solve time and the resulting \
+                    cut are reported. In memory mode, the peak RSS of a full \
+                    GrabCut run that keeps all segmentations is reported, \
+                    with and without the compact segmentation history, and \
+                    for a baseline that handles the energies and graphs like \
+                    GrabCut did before the memory changes. In \
+                    energy mode, the total energy after every GrabCut \
+                    iteration is tracked, and checked to be non-increasing \
+                    and equal to the value of the min cut.')
+    parser.add_argument('image_file', default = None, nargs='?',
+        help='Input image name (without extension or path) if you want to process a single image only')
+    parser.add_argument('-m', '--mode', default='solvers',
+        choices=['solvers', 'memory', 'energy'],
+        help='What to benchmark')
+    parser.add_argument('-s', '--solvers', nargs='+',
+        default=maxflow_solvers.available_solvers(),
+        help='Maxflow backends to compare. The first one is the reference')
+    parser.add_argument('-c','--num-components', dest="num_components",
+        type=int,default=5,
+        help='Number of components in each GMM')
+    parser.add_argument('-n','--num-iterations', dest="num_iterations",
+        type=int,default=10,
+        help='Number of GrabCut iterations (memory and energy modes)')
+
+    return parser.parse_args()
+
+# Computes the inputs of the first min cut of GrabCut for the given image
+def compute_graph_inputs(image, bbox, num_components):
+    alpha, foreground_gmm, background_gmm = grabcut.initialization(image, bbox,
+        num_components=num_components)
+    pairwise_energies = grabcut.compute_smoothness_vectorized(image, neighborhood='eight')
+
+    pixels = image.reshape((image.shape[0]*image.shape[1], image.shape[2]))
+    foreground_components = foreground_gmm.get_component(pixels).astype(np.int8).reshape((image.shape[0], image.shape[1]))
+    background_components = background_gmm.get_component(pixels).astype(np.int8).reshape((image.shape[0], image.shape[1]))
+
+    k = np.where(alpha==1, foreground_components, background_components)
+    update_gmms(pixels, k, alpha, foreground_gmm, background_gmm)
+
+    theta = (background_gmm, foreground_gmm)
+    foreground_energies = grabcut.get_unary_energy_vectorized(1,
+        foreground_components.reshape((pixels.shape[0], 1)), theta, pixels)
+    background_energies = grabcut.get_unary_energy_vectorized(0,
+        background_components.reshape((pixels.shape[0], 1)), theta, pixels)
+
+    return foreground_energies, background_energies, pairwise_energies
+
+# Builds the graph with the given backend, and returns the resulting
+# segmentation together with timing information
+def run_solver(solver, image, bbox, foreground_energies, background_energies,
+    pairwise_energies):
+    start_time = time.time()
+    graph = grabcut.build_graph(image, bbox, foreground_energies,
+        background_energies, pairwise_energies, solver=solver)
+    build_time = time.time() - start_time
+
+    start_time = time.time()
+    flow = graph.maxflow()
+    partition = graph.what_segment_vectorized()
+    solve_time = time.time() - start_time
+
+    return partition, flow, build_time, solve_time
+
+# get_unary_energy_vectorized as it was before the memory changes: a mean and an
+# inverse covariance matrix are gathered for every pixel
+def legacy_unary_energy(alpha, k, gmms, pixels, debug=False):
+    pi_base = gmms[alpha].weights
+    pi = pi_base[k].reshape(pixels.shape[0])
+    pi[pi==0] = 1e-15
+
+    dets_base = np.array([gmms[alpha].gaussians[i].sigma_det for i in xrange(len(gmms[alpha].gaussians))])
+    dets = dets_base[k].reshape(pixels.shape[0])
+    dets[dets==0] = 1e-15
+
+    means_base = np.array([gmms[alpha].gaussians[i].mean for i in xrange(len(gmms[alpha].gaussians))])
+    means = np.swapaxes(means_base[k], 1, 2)
+    means = means.reshape((means.shape[0:2]))
+
+    cov_base = np.array([gmms[alpha].gaussians[i].sigma_inv for i in xrange(len(gmms[alpha].gaussians))])
+    cov = np.swapaxes(cov_base[k], 1, 3)
+    cov = cov.reshape((cov.shape[0:3]))
+
+    term = pixels - means
+    middle_matrix = np.array([np.sum(np.multiply(term, cov[:, :, 0]),axis=1),
+                              np.sum(np.multiply(term, cov[:, :, 1]),axis=1),
+                              np.sum(np.multiply(term, cov[:, :, 2]),axis=1)]).T
+
+    log_prob = np.sum(np.multiply(middle_matrix, term), axis=1)
+
+    return -np.log(pi) \
+        + 0.5 * np.log(dets) \
+        + 0.5 * log_prob
+
+# Makes grabcut handle the energies and graphs like it did before the memory
+# changes: the per-pixel unary energy temporaries, all eight float64 pairwise
+# terms, and the graph of the previous iteration alive until the next graph
+# is built. Only used in the child processes of the memory mode.
+def use_legacy_memory_profile():
+    grabcut.get_unary_energy_vectorized = legacy_unary_energy
+    grabcut.get_graph_pairwise_energies = lambda pairwise_energies: pairwise_energies
+
+    build_graph = grabcut.build_graph
+    previous_graph = [None]
+    def build_graph_keeping_previous(*args, **kwargs):
+        graph = build_graph(*args, **kwargs)
+        previous_graph[0] = graph
+        return graph
+    grabcut.build_graph = build_graph_keeping_previous
+
+# Runs GrabCut keeping all the segmentations, and reports the peak RSS of
+# the process. Meant to be run in its own process, so that the peak is not
+# shared with other runs.
+def measure_memory(q, image, bbox, image_name, num_iterations, num_components,
+    compact_history, legacy=False):
+    if legacy:
+        use_legacy_memory_profile()
+
+    start_time = time.time()
+    segmentations = grabcut.grabcut(image, bbox, image_name,
+        num_iterations=num_iterations, num_components=num_components,
+        get_all_segmentations=True, compact_history=compact_history)
+    run_time = time.time() - start_time
+
+    if compact_history:
+        history_bytes = segmentations.nbytes()
+    else:
+        history_bytes = sum([s.nbytes for s in segmentations])
+
+    # ru_maxrss is in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    q.put((peak_rss, history_bytes, run_time))
+
+def benchmark_memory(args, image_names):
+    print "%-10s %-8s %14s %14s %10s"%('Image', 'History', 'Peak RSS (MB)',
+        'History (KB)', 'Time (s)')
+    print "------------------------------------------------------------------"
+    configurations = ['baseline', 'list', 'compact']
+    peak_rss = dict((history, []) for history in configurations)
+    for image_name in image_names:
+        bbox_file = open(BBOX_DIR + image_name + BBOX_EXT, "r")
+        bbox = map(int, bbox_file.readlines()[0].strip().split(" "))
+
+        image = plt.imread(DATA_DIR + image_name + DATA_EXT)
+
+        # The baseline keeps its segmentations in a list
+        for history in configurations:
+            q = Queue()
+            process = Process(target=measure_memory, args=(q, image, bbox,
+                image_name, args.num_iterations, args.num_components,
+                history == 'compact', history == 'baseline'))
+            process.start()
+            rss, history_bytes, run_time = q.get()
+            process.join()
+
+            peak_rss[history].append(rss)
+            print "%-10s %-8s %14.1f %14.1f %10.2f"%(image_name, history,
+                rss/1024.0, history_bytes/1024.0, run_time)
+
+    print "------------------------------------------------------------------"
+    print "Number of Images:", len(image_names)
+    for history in configurations:
+        print "Average peak RSS (%s): %0.1f MB"%(history, np.mean(peak_rss[history])/1024.0)
+    print "------------------------------------------------------------------"
+
+def benchmark_energy(args, image_names):
+    print "%-10s %6s %14s %14s %10s %12s"%('Image', 'Iters', 'Initial E',
+        'Final E', 'Increases', 'Cut error')
+    print "------------------------------------------------------------------"
+    num_monotonic = 0
+    for image_name in image_names:
+        bbox_file = open(BBOX_DIR + image_name + BBOX_EXT, "r")
+        bbox = map(int, bbox_file.readlines()[0].strip().split(" "))
+
+        image = plt.imread(DATA_DIR + image_name + DATA_EXT)
+
+        # The energy of the first cut must match the value of the cut (up to
+        # the float32 flow accumulated by the solver)
+        foreground_energies, background_energies, pairwise_energies = \
+            compute_graph_inputs(image, bbox, args.num_components)
+        partition, flow, _, _ = run_solver(args.solvers[0], image, bbox,
+            foreground_energies, background_energies, pairwise_energies)
+        energy = grabcut.get_energy_vectorized(
+            partition.reshape(image.shape[:2]), foreground_energies,
+            background_energies, pairwise_energies,
+            grabcut.get_definite_background(image.shape, bbox))
+
+        _, energies = grabcut.grabcut(image, bbox, image_name,
+            num_iterations=args.num_iterations,
+            num_components=args.num_components, maxflow_solver=args.solvers[0],
+            get_energies=True)
+
+        # Allow for float32 rounding in the graph capacities
+        tolerance = 1e-5 * np.abs(energies[:-1])
+        num_increases = np.sum(np.diff(energies) > tolerance)
+        if num_increases == 0:
+            num_monotonic += 1
+
+        print "%-10s %6d %14.2f %14.2f %10d %12.2e"%(image_name, len(energies),
+            energies[0], energies[-1], num_increases, abs(energy - flow)/flow)
+
+    print "------------------------------------------------------------------"
+    print "Number of Images:", len(image_names)
+    print "Images with non-increasing energy: %d"%num_monotonic
+    print "------------------------------------------------------------------"
+
+def benchmark_solvers(args, image_names):
+    # A single backend has nothing to be compared with
+    if len(args.solvers) < 2:
+        raise ValueError('The solvers mode compares at least two maxflow '
+            'backends, got: %s (available: %s). Run check_dependencies.py to '
+            'build pymaxflow and pypushrelabel.'%(', '.join(args.solvers) or 'none',
+            ', '.join(maxflow_solvers.available_solvers()) or 'none'))
+    for solver in args.solvers:
+        # Fails with the reason if the backend cannot be used
+        maxflow_solvers.create_solver_graph(solver, 1, 1)
+
+    total_solve_time = dict((solver, 0.0) for solver in args.solvers)
+
+    print "%-10s %-12s %10s %10s %14s %10s"%('Image', 'Solver', 'Build (s)',
+        'Solve (s)', 'Cut value', 'Diff px')
+    print "------------------------------------------------------------------------"
+    for image_name in image_names:
+        bbox_file = open(BBOX_DIR + image_name + BBOX_EXT, "r")
+        bbox = map(int, bbox_file.readlines()[0].strip().split(" "))
+
+        image = plt.imread(DATA_DIR + image_name + DATA_EXT)
+
+        foreground_energies, background_energies, pairwise_energies = \
+            compute_graph_inputs(image, bbox, args.num_components)
+
+        reference = None
+        for solver in args.solvers:
+            partition, flow, build_time, solve_time = run_solver(solver,
+                image, bbox, foreground_energies, background_energies,
+                pairwise_energies)
+            total_solve_time[solver] += solve_time
+
+            # Cut equality is measured against the first solver
+            if reference is None:
+                reference = partition
+            num_different = np.sum(partition != reference)
+
+            print "%-10s %-12s %10.4f %10.4f %14.2f %10d"%(image_name, solver,
+                build_time, solve_time, flow, num_different)
+
+    print "------------------------------------------------------------------------"
+    print "Number of Images:", len(image_names)
+    for solver in args.solvers:
+        print "Total solve time (%s): %0.4f s"%(solver, total_solve_time[solver])
+    print "------------------------------------------------------------------------"
+
+def main():
+    args = get_args()
+
+    # Get image names
+    filenames = os.listdir(DATA_DIR)
+    image_names = sorted([f.replace(DATA_EXT, '') for f in filenames])
+    if args.image_file != None:
+        image_names = [args.image_file]
+
+    if args.mode == 'memory':
+        benchmark_memory(args, image_names)
+    elif args.mode == 'energy':
+        benchmark_energy(args, image_names)
+    else:
+        benchmark_solvers(args, image_names)
+
+if __name__ == '__main__':
+    main()
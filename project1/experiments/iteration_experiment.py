@@ -63,7 +63,7 @@ def main():
         image = plt.imread(DATA_DIR + image_name + DATA_EXT)
 
         # Call GrabCut. Pass the image and bounding box.
-        segmentations = grabcut.grabcut(image, bbox, image_name, num_iterations=MAX_NUM_ITERATIONS, get_all_segmentations=True)
+        segmentations = grabcut.grabcut(image, bbox, image_name, num_iterations=MAX_NUM_ITERATIONS, get_all_segmentations=True, compact_history=True)
 
         # Compare the resulting segmentation to the GT segmentation
         # ground_truth is a grayscale image (2D matrix)
@@ -35,6 +35,15 @@ class Gaussian:
             
         return self.term1 * np.exp(-0.5 * np.sum(np.multiply((x-mean), middle_matrix),axis=1))
 
+    # Sets precomputed parameters (e.g. from GMM.set_statistics, which
+    # inverts all the covariance matrices of a GMM in one batch)
+    def set_parameters(self, mean, sigma, sigma_inv, sigma_det):
+        self.mean = mean
+        self.sigma = sigma
+        self.sigma_inv = sigma_inv
+        self.sigma_det = sigma_det
+        self.term1 = 1/np.sqrt(self.TWO_PI_3 * self.sigma_det)
+
     def update_parameters(self, data):
         self.mean = np.mean(data, axis=0)
         self.sigma = np.cov(data, rowvar=0) + np.eye(self.k)*1e-8
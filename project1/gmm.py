@@ -2,6 +2,13 @@ from gaussian import Gaussian
 from sklearn.cluster import KMeans
 import numpy as np
 
+# Pairs of channels for which second moments are accumulated (upper triangle
+# of the 3x3 covariance matrix)
+CHANNEL_PAIRS = [(0,0), (0,1), (0,2), (1,1), (1,2), (2,2)]
+
+# Number of pixels per chunk when statistics are computed in a thread pool
+CHUNK_SIZE = 2**18
+
 class GMM:
     def __init__(self, K):
         self.K = K
@@ -40,27 +47,135 @@ class GMM:
 
     # X -> -1, 1 .. K -> -1 = not current class
     def update_components(self, X, assignments):
-        num_pixels = float(np.sum(assignments != -1))
+        X = X.reshape((-1, 3))
+        assignments = assignments.ravel()
+        counts, sums, products = compute_component_statistics(X, assignments, self.K)
+        self.set_statistics(counts, sums, products)
+
+    # Updates all the components from their sufficient statistics (see
+    # compute_component_statistics). All covariance matrices are inverted
+    # in one batch.
+    def set_statistics(self, counts, sums, products):
+        num_pixels = float(np.sum(counts))
+        non_empty = counts > 0
+
+        if num_pixels == 0:
+            # No pixels at all, disable every component
+            for distribution in self.gaussians:
+                distribution.mean = [-1e9,-1e9,-1e9]
+            self.weights = np.zeros((self.K,))
+            return
+
+        means = np.zeros((self.K, 3))
+        means[non_empty] = sums[non_empty] / counts[non_empty, np.newaxis]
+
+        # Same normalization as np.cov (N-1), guarding single pixel components
+        normalization = np.maximum(counts - 1, 1).astype(np.float64)
+        sigmas = products - counts[:, np.newaxis, np.newaxis] * \
+            np.einsum('ki,kj->kij', means, means)
+        sigmas = sigmas / normalization[:, np.newaxis, np.newaxis] + np.eye(3)*1e-8
+
+        weights = counts / num_pixels
+
+        # Reseed empty components by splitting the component with the highest
+        # variance along its principal axis, so that no component is wasted
+        for i in np.where(~non_empty)[0]:
+            candidates = np.where(non_empty)[0]
+            eigenvalues, eigenvectors = np.linalg.eigh(sigmas[candidates])
+            best = np.argmax(eigenvalues[:, -1])
+            j = candidates[best]
+            variance = eigenvalues[best, -1]
+            direction = eigenvectors[best][:, -1]
+
+            # Splitting a gaussian in half along an axis moves each half by
+            # sqrt(2/pi) standard deviations and leaves (1-2/pi) of the variance
+            offset = np.sqrt(2*variance/np.pi) * direction
+            shrink = (2/np.pi) * variance * np.outer(direction, direction)
+
+            means[i] = means[j] + offset
+            means[j] = means[j] - offset
+            sigmas[j] = sigmas[j] - shrink
+            sigmas[i] = sigmas[j]
+            weights[i] = weights[j] = weights[j] / 2
+            non_empty[i] = True
+
+        sigma_invs = np.linalg.inv(sigmas)
+        sigma_dets = np.linalg.det(sigmas)
 
-        # print np.sum([np.sum(assignments==i) for i in xrange(len(self.gaussians))]), num_pixels
-        # gaussians = []
-        # weights = []
         for i, distribution in enumerate(self.gaussians):
-            if X[assignments==i].shape[0] != 0:
-                distribution.update_parameters(X[assignments==i])
-                self.weights[i] = (np.sum(assignments==i)/num_pixels)
-            else:
-                # print 'Empty component',i
-                distribution.mean = [-1e9,-1e9,-1e9]
-                self.weights[i] = 0
-        # self.gaussians = gaussians
-        # self.weights = np.array(weights)
-        # self.K = len(gaussians)
+            distribution.set_parameters(means[i], sigmas[i], sigma_invs[i], sigma_dets[i])
+        self.weights = weights
 
     def compute_probability(self, x):
         return np.dot(self.weights, [g.compute_probability(x) for g in self.gaussians])
 
 
+# Computes the sufficient statistics of every component in a single pass
+# over the pixels
+# 
+# X - N x 3 array of pixels
+# labels - component of each pixel, -1 for pixels that are ignored
+# num_labels - number of components
+# 
+# Returns: counts (num_labels), sums (num_labels x 3) and sums of outer
+#   products (num_labels x 3 x 3)
+def compute_component_statistics(X, labels, num_labels):
+    keep = labels >= 0
+    X = X[keep].astype(np.float64)
+    labels = labels[keep].astype(np.intp)
+
+    counts = np.bincount(labels, minlength=num_labels)[:num_labels].astype(np.float64)
+    sums = np.zeros((num_labels, 3))
+    products = np.zeros((num_labels, 3, 3))
+
+    for c in xrange(3):
+        sums[:, c] = np.bincount(labels, weights=X[:, c], minlength=num_labels)[:num_labels]
+    for (a, b) in CHANNEL_PAIRS:
+        products[:, a, b] = np.bincount(labels, weights=X[:, a]*X[:, b], minlength=num_labels)[:num_labels]
+        products[:, b, a] = products[:, a, b]
+
+    return counts, sums, products
+
+# Updates the foreground and background GMMs together. Both GMMs are handled
+# as one set of 2K labels, so the statistics of all components are computed
+# in one pass over the pixels.
+# 
+# X - N x 3 array of pixels
+# k - component of each pixel (in the GMM given by alpha)
+# alpha - 1 for foreground pixels, 0 for background pixels
+# pool - optional multiprocessing.pool.ThreadPool. If given, the pixels are
+#   split into chunks whose statistics are computed concurrently (numpy
+#   releases the GIL), and the two GMMs are finalized concurrently.
+def update_gmms(X, k, alpha, foreground_gmm, background_gmm, pool=None):
+    X = X.reshape((-1, 3))
+    k = k.ravel().astype(np.int32)
+    alpha = alpha.ravel()
+
+    # Background components are labelled 0..K_bg-1, foreground components
+    # K_bg..K_bg+K_fg-1
+    num_labels = background_gmm.K + foreground_gmm.K
+    labels = np.where(alpha == 1, k + background_gmm.K, k)
+    labels[k < 0] = -1
+
+    if pool is None:
+        counts, sums, products = compute_component_statistics(X, labels, num_labels)
+    else:
+        chunks = [(X[i:i+CHUNK_SIZE], labels[i:i+CHUNK_SIZE], num_labels)
+                    for i in xrange(0, X.shape[0], CHUNK_SIZE)]
+        partial = pool.map(lambda chunk: compute_component_statistics(*chunk), chunks)
+        counts = np.sum([p[0] for p in partial], axis=0)
+        sums = np.sum([p[1] for p in partial], axis=0)
+        products = np.sum([p[2] for p in partial], axis=0)
+
+    K = background_gmm.K
+    updates = [(background_gmm, counts[:K], sums[:K], products[:K]),
+               (foreground_gmm, counts[K:], sums[K:], products[K:])]
+    if pool is None:
+        for gmm, c, s, p in updates:
+            gmm.set_statistics(c, s, p)
+    else:
+        pool.map(lambda u: u[0].set_statistics(u[1], u[2], u[3]), updates)
+
 def GMM_test():
     g = GMM(5)
 
@@ -1,27 +1,41 @@
 from matplotlib.patches import Rectangle
 from matplotlib.patches import Circle
-from gmm import GMM
+from gmm import GMM, update_gmms
+from multiprocessing.pool import ThreadPool
+from segmentation_history import SegmentationHistory
 import matplotlib.pyplot as plt
 import matplotlib.colors
+import maxflow_solvers
 import numpy as np
 import argparse
 import os
-
-try:
-    import third_party.pymaxflow.pymaxflow as pymaxflow
-except ImportError:
-    import pymaxflow
-
 import time
 import sys
 
 # Global constants
 gamma = 50
 
+# Offsets of the neighbors, in the order used by compute_smoothness_vectorized
+NEIGHBORHOOD = [(-1,0),(+1,0),(0,-1),(0,+1),(-1,-1),(-1,+1),(+1,+1),(+1,-1)]
+# Each pair of neighbors is connected once in the graph, using these offsets
+# (up, left, up-left, up-right)
+GRAPH_NEIGHBORS = [0,2,4,5]
+
+
 
+# Adaptive gamma (see compute_gamma). Gamma is interpolated linearly between
+# GAMMA_RANGE as the entropy of the spectral histogram goes through
+# GAMMA_ENTROPY_RANGE (in bits), so that color skewed (low entropy) images get
+# a weaker pairwise term.
+GAMMA_RANGE = (20, 50)
+GAMMA_ENTROPY_RANGE = (7.0, 9.0)
+# Number of pixels used to compute the spectral histogram
+GAMMA_SAMPLE_SIZE = 4096
+# Adaptive gamma of every image seen so far, by image name and shape
+gamma_cache = {}
 
-# If energy changes less than CONVERGENCE_CRITERIA percent from the last iteration
-# we will terminate
+# If energy changes less than CONVERGENCE_CRITERON (i.e. 2%) from the last iteration
+# we will terminate (only with stop_on_convergence)
 CONVERGENCE_CRITERON = 0.02
 
 ################################################################################
@@ -60,6 +74,12 @@ def get_args():
     parser.add_argument('-e','--enable-user-interaction', dest="user_interaction",
         action="store_true", default=False,
         help='Flag to enable user interaction to provide more feedback')
+    parser.add_argument('-s','--maxflow-solver', dest="maxflow_solver",
+        default='bk', choices=sorted(maxflow_solvers.MAXFLOW_SOLVERS.keys()),
+        help='Maxflow backend used to compute the min cut')
+    parser.add_argument('-g','--adaptive-gamma', dest="adaptive_gamma",
+        action="store_true", default=False,
+        help='Flag to compute gamma from the entropy of the spectral histogram of the image')
 
     return parser.parse_args()
 
@@ -241,11 +261,8 @@ def initialization(img, bbox, num_components=5, debug=False):
     height, width, _ = img.shape
     alpha = np.zeros((height, width), dtype=np.int8)
 
-    for h in xrange(height): # Rows
-        for w in xrange(width): # Columns
-            if (w >= xmin) and (w <= xmax) and (h >= ymin) and (h <= ymax):
-                # Foreground
-                alpha[h,w] = 1
+    # Foreground (pixels on the bounding box edge are included)
+    alpha[max(ymin,0):ymax+1, max(xmin,0):xmax+1] = 1
 
     foreground_gmm = GMM(num_components)
     background_gmm = GMM(num_components)
@@ -254,7 +271,7 @@ def initialization(img, bbox, num_components=5, debug=False):
     bg_clusters = background_gmm.initialize_gmm(img[alpha==0])
 
     if debug:
-        k = np.ones(alpha.shape, dtype=int)*-1
+        k = -1*np.ones(alpha.shape, dtype=np.int8)
         k[alpha==1] = fg_clusters[:]
         k[alpha==0] = bg_clusters[:]
         visualize_clusters(img.shape, k, alpha)
@@ -270,19 +287,97 @@ def initialization(img, bbox, num_components=5, debug=False):
 
 # Given an image, computes the total number of nodes and edges required, and 
 # returns a constructed graph object
-def create_graph(img):
+# 
+# solver - name of the maxflow backend to use (see maxflow_solvers.py)
+def create_graph(img, solver='bk'):
     num_neighbors = 8
 
     num_nodes = img.shape[0]*img.shape[1] + 2
     num_edges = img.shape[0]*img.shape[1]*num_neighbors
 
-    g = pymaxflow.PyGraph(num_nodes, num_edges)
+    g = maxflow_solvers.create_solver_graph(solver, num_nodes, num_edges)
 
     # Creating nodes
     g.add_node(num_nodes-2)
 
     return g
 
+# Returns a boolean mask of the pixels that are constrained to be background:
+# pixels outside the bounding box and pixels marked by the user
+# 
+# img_shape - image dimensions
+# bbox - bounding box of the foreground object
+# user_definite_background - set of (x,y) pixels marked as background by the user
+def get_definite_background(img_shape, bbox, user_definite_background=set()):
+    height, width = img_shape[0], img_shape[1]
+    definite_background = np.ones((height, width), dtype=bool)
+    definite_background[max(bbox[1],0):bbox[3]+1, max(bbox[0],0):bbox[2]+1] = False
+    for (x,y) in user_definite_background:
+        if 0 <= x < width and 0 <= y < height:
+            definite_background[y,x] = True
+    return definite_background
+
+# Given the unary and pairwise energies of an image, constructs the graph on
+# which the min cut is computed
+# 
+# img - image to perform segmentation on
+# bbox - bounding box of the foreground object. Pixels outside of it are
+#   constrained to be background
+# foreground_energies, background_energies - unary energy of each pixel
+# pairwise_energies - output of compute_smoothness_vectorized (or of
+#   get_graph_pairwise_energies)
+# user_definite_background - set of (x,y) pixels marked as background by the user
+# solver - name of the maxflow backend to use (see maxflow_solvers.py)
+# gamma_value - weight of the pairwise term. Uses the global gamma if not given
+def build_graph(img, bbox, foreground_energies, background_energies,
+    pairwise_energies, user_definite_background=set(), solver='bk',
+    gamma_value=None):
+    if gamma_value is None:
+        gamma_value = gamma
+    height, width = img.shape[0], img.shape[1]
+    graph = create_graph(img, solver=solver)
+
+    # Compute Unary weights
+    # If pixel is outside of bounding box, assign large unary energy
+    definite_background = get_definite_background(img.shape, bbox,
+        user_definite_background).flatten()
+
+    w1 = foreground_energies.astype(np.float32) # to background node
+    w2 = background_energies.astype(np.float32) # to foreground node
+    w1[definite_background] = 1e9
+    w2[definite_background] = 0
+
+    graph.add_tweights_vectorized(np.arange(height*width, dtype=np.int32), w1, w2)
+
+    # Compute pairwise weights
+    src_h = np.tile(np.arange(height).reshape(height, 1), (1, width))
+    src_w = np.tile(np.arange(width).reshape(1, width), (height, 1))
+    src_h = src_h.astype(np.int32)
+    src_w = src_w.astype(np.int32)
+
+    for i, energy in enumerate(pairwise_energies):
+        if i not in GRAPH_NEIGHBORS:
+            continue
+        height_offset, width_offset = NEIGHBORHOOD[i]
+
+        dst_h = src_h + height_offset
+        dst_w = src_w + width_offset
+
+        idx = np.logical_and(np.logical_and(dst_h >= 0, dst_h < height),
+                            np.logical_and(dst_w >= 0, dst_w < width))
+
+        src_idx = src_h * width + src_w
+        dst_idx = dst_h * width + dst_w
+
+        src_idx = src_idx[idx].flatten()
+        dst_idx = dst_idx[idx].flatten()
+        weights = energy.astype(np.float32)[idx].flatten()
+        weights = gamma_value*weights
+
+        graph.add_edge_vectorized(src_idx, dst_idx, weights, weights)
+
+    return graph
+
 # Given a gmm and a list of pixels, computes the -log(prob) of each pixel belonging
 # to the given GMM. This method does not consider which component was assigned
 # to the pixel
@@ -329,39 +424,35 @@ def get_total_unary_energy_vectorized(gmm, pixels, debug=False):
 # k - array with each element corresponding to which component the
 #   corresponding pixel in the pixels array belongs to
 # pixels - array of pixels
+# 
+# The pixels are processed one component at a time, so that only the 3x3
+# inverse covariance of that component is used, instead of gathering a
+# mean and a covariance matrix for every pixel.
 def get_unary_energy_vectorized(alpha, k, gmms, pixels, debug=False):
-    pi_base = gmms[alpha].weights
-    pi = pi_base[k].reshape(pixels.shape[0])
-    pi[pi==0] = 1e-15
-
-    dets_base = np.array([gmms[alpha].gaussians[i].sigma_det for i in xrange(len(gmms[alpha].gaussians))])
-    dets = dets_base[k].reshape(pixels.shape[0])
-    dets[dets==0] = 1e-15
-
-    means_base = np.array([gmms[alpha].gaussians[i].mean for i in xrange(len(gmms[alpha].gaussians))])
-    means = np.swapaxes(means_base[k], 1, 2)
-    means = means.reshape((means.shape[0:2]))
+    k = k.reshape(pixels.shape[0])
+    energies = np.zeros((pixels.shape[0],))
+    for i, gaussian in enumerate(gmms[alpha].gaussians):
+        idx = np.flatnonzero(k == i)
+        if idx.shape[0] == 0:
+            continue
+
+        pi = gmms[alpha].weights[i]
+        if pi == 0:
+            pi = 1e-15
+        det = gaussian.sigma_det
+        if det == 0:
+            det = 1e-15
+
+        term = pixels[idx] - np.ravel(gaussian.mean)
+        # Not really the log_prob, but a part of it
+        log_prob = np.sum(np.multiply(np.dot(term, gaussian.sigma_inv.T), term), axis=1)
 
-    cov_base = np.array([gmms[alpha].gaussians[i].sigma_inv for i in xrange(len(gmms[alpha].gaussians))])
-    cov = np.swapaxes(cov_base[k], 1, 3)
-    cov = cov.reshape((cov.shape[0:3]))
-
-    term = pixels - means
-    middle_matrix = np.array([np.sum(np.multiply(term, cov[:, :, 0]),axis=1),
-                              np.sum(np.multiply(term, cov[:, :, 1]),axis=1),
-                              np.sum(np.multiply(term, cov[:, :, 2]),axis=1)]).T
-
-    # Not really the log_prob, but a part of it
-    log_prob = np.sum(np.multiply(middle_matrix, term), axis=1)
+        if debug:
+            print i, idx.shape, log_prob.shape
 
-    if debug:
-        print pi.shape
-        print dets.shape
-        print log_prob.shape
+        energies[idx] = -np.log(pi) + 0.5 * np.log(det) + 0.5 * log_prob
 
-    return -np.log(pi) \
-        + 0.5 * np.log(dets) \
-        + 0.5 * log_prob
+    return energies
 
 # Given an image (z), computes the expected difference between neighboring 
 # pixels, and returns the corresponding beta value.
@@ -461,6 +552,56 @@ def compute_smoothness_vectorized(z, neighborhood='eight', compute_dict=False, d
         return smoothness_matrix, energies
     return energies
 
+# Given the output of compute_smoothness_vectorized, only keeps the terms used by
+# the graph (GRAPH_NEIGHBORS), as float32 like the graph capacities. The other
+# terms are replaced by None. The result can be used by build_graph and
+# get_energy_vectorized, and takes a quarter of the memory.
+def get_graph_pairwise_energies(pairwise_energies):
+    return [energy.astype(np.float32) if i in GRAPH_NEIGHBORS else None
+        for i, energy in enumerate(pairwise_energies)]
+
+# Given an alpha map and the energies used to build the graph, computes the
+# total energy of the segmentation. This is the vectorized equivalent of
+# get_energy, and uses the exact terms of the graph built by build_graph, so
+# the result equals the value of the corresponding cut.
+# 
+# alpha - matrix of alpha map
+# foreground_energies - unary energy of each pixel if it is foreground
+# background_energies - unary energy of each pixel if it is background
+# pairwise_energies - output of compute_smoothness_vectorized (or of
+#   get_graph_pairwise_energies)
+# definite_background - optional mask of pixels constrained to background (see
+#   get_definite_background). Labeling them foreground costs 1e9.
+# gamma_value - weight of the pairwise term. Uses the global gamma if not given
+def get_energy_vectorized(alpha, foreground_energies, background_energies,
+    pairwise_energies, definite_background=None, gamma_value=None):
+    if gamma_value is None:
+        gamma_value = gamma
+    height, width = alpha.shape
+    foreground = alpha.flatten() == 1
+
+    # Compute U
+    foreground_energies = foreground_energies.reshape(foreground.shape)
+    background_energies = background_energies.reshape(foreground.shape)
+    if definite_background is not None:
+        definite_background = definite_background.flatten()
+        foreground_energies = np.where(definite_background, 1e9, foreground_energies)
+        background_energies = np.where(definite_background, 0, background_energies)
+    U = np.sum(np.where(foreground, foreground_energies, background_energies))
+
+    # Compute V (each pair of neighbors is counted once)
+    V = 0.0
+    for i in GRAPH_NEIGHBORS:
+        height_offset, width_offset = NEIGHBORHOOD[i]
+        src = (slice(max(0, -height_offset), height - max(0, height_offset)),
+               slice(max(0, -width_offset), width - max(0, width_offset)))
+        dst = (slice(src[0].start + height_offset, src[0].stop + height_offset),
+               slice(src[1].start + width_offset, src[1].stop + width_offset))
+        V += np.sum(pairwise_energies[i][src][alpha[src] != alpha[dst]], dtype=np.float64)
+    V = gamma_value * V
+
+    return U + V
+
 
 ################################################################################
 ############################## DEBUGGING HELPERS ###############################
@@ -500,33 +641,58 @@ def visualize_clusters(img_shape, k, alpha, iteration, image_name, show_image=Fa
         plt.show()
 
 # Computes gamma based on entropy of the spectral histogram of the given
-# image.
+# image. The spectral histogram combines the histograms of the R, G and B
+# channels (768 bins), and is computed on a fixed-size sample of evenly spaced
+# rows (about GAMMA_SAMPLE_SIZE pixels), so the cost does not depend on the
+# image size. The entropy is mapped
+# linearly to GAMMA_RANGE (see GAMMA_ENTROPY_RANGE).
 # 
 # z - image pixels
 # img_name - name for logging purposes
 def compute_gamma(z, img_name, debug=False, save_fig=False):
-    R,G,B = z[:,:,0],z[:,:,1],z[:,:,2]
-    img = z.copy()
-    matplotlib.colors.rgb_to_hsv(img)
+    height, width = z.shape[0], z.shape[1]
+    num_rows = -(-GAMMA_SAMPLE_SIZE // width)
+    sample = z[::max(1, height/num_rows)]
+    if sample.dtype.kind == 'f':
+        # plt.imread returns floats in [0,1] for png images
+        sample = sample*255
+    # Whole rows are contiguous, which is much cheaper to read than a
+    # pixel-strided sample
+    channels = sample.reshape((-1, 3)).T.astype(np.uint8)
+
+    histogram = np.concatenate([np.bincount(channels[c], minlength=256)
+        for c in xrange(3)]).astype(np.float64)
+
+    probs = histogram[histogram != 0]/np.sum(histogram)
+    entropy = -np.sum(np.multiply(probs, np.log2(probs)))
 
-    H = img[:,:,0].flatten()
-    H = H[np.random.randint(H.shape[0],size=100000)]
+    low, high = GAMMA_ENTROPY_RANGE
+    t = min(max((entropy - low)/(high - low), 0.0), 1.0)
+    gamma_value = GAMMA_RANGE[0] + t*(GAMMA_RANGE[1] - GAMMA_RANGE[0])
 
-    probs = np.zeros((256))
-    for i in xrange(256):
-        probs[i] = np.sum(H==i)
-    
-    probs = probs[probs != 0]
-    entropy = -np.sum(np.multiply(probs, np.log2(probs)))
-    print "%s: %0.2f"%(img_name, entropy/10000)
+    if debug:
+        print "%s: entropy %0.2f, gamma %0.2f"%(img_name, entropy, gamma_value)
 
-    if savefig:
+    if save_fig:
         plt.figure()
-        plt.hist(H, 256, range=(0.0,255.0), color='k', edgecolor='k')
-        plt.xlabel("%s: %0.2f"%(img_name, entropy/10000))
+        plt.bar(np.arange(histogram.shape[0]), histogram, width=1.0, color='k', edgecolor='k')
+        plt.xlabel("%s: %0.2f"%(img_name, entropy))
         plt.savefig('hists/' + img_name +'-h.eps', bbox_inches='tight')
         plt.close()
 
+    return gamma_value
+
+# Returns the adaptive gamma of the given image (see compute_gamma), and
+# caches it by image name so that it is only computed once per image
+# 
+# img - image to perform segmentation on
+# image_name - image name, used as the cache key
+def get_adaptive_gamma(img, image_name, debug=False):
+    key = (image_name, img.shape)
+    if key not in gamma_cache:
+        gamma_cache[key] = compute_gamma(img, image_name, debug=debug)
+    return gamma_cache[key]
+
 # Grabcut loop
 # This function contains the actual implementation of the entire grabcut
 # algorithm
@@ -538,22 +704,43 @@ def compute_gamma(z, img_name, debug=False, save_fig=False):
 # num_components - number of components to inititalize the fg/bg GMM with
 # get_all_segmentations - Stores and returns the intermediate segmentation from 
 #   each iteration for experimental purposes
+# maxflow_solver - name of the maxflow backend used for the min cut (see
+#   maxflow_solvers.py)
+# compact_history - If get_all_segmentations is set, returns the intermediate
+#   segmentations as a delta-encoded SegmentationHistory instead of a list
+# num_threads - Number of threads used to update the GMMs. With more than one
+#   thread, the GMM statistics are computed concurrently on chunks of pixels
+# stop_on_convergence - Stops iterating once the total energy changes less
+#   than CONVERGENCE_CRITERON (relative) from the last iteration
+# get_energies - Also returns the total energy of the segmentation after each
+#   iteration, i.e. returns (segmentation(s), energies)
+# gamma_value - weight of the pairwise term. Uses the global gamma if not given
+# adaptive_gamma - Computes gamma for this image from the entropy of its
+#   spectral histogram (see compute_gamma). Overrides gamma_value
+# 
+# All masks are kept as int8 arrays: alpha (0/1), and the component map k
+# (-1, 0 .. num_components-1).
 def grabcut(img, bbox, image_name, user_interaction=False, num_iterations=10, 
     num_components=5, get_all_segmentations=False, debug=False, drawImage=False,
-    visualize_clusters=False):
+    visualize_clusters=False, maxflow_solver='bk', compact_history=False,
+    num_threads=1, stop_on_convergence=False, get_energies=False,
+    gamma_value=None, adaptive_gamma=False):
     if debug: 
         print 'Initializing gmms'
         tic()
     alpha, foreground_gmm, background_gmm = initialization(img, bbox, num_components=num_components)
-    k = np.zeros((img.shape[0],img.shape[1]), dtype=int)
     if debug:
         toc('Initializing gmms')
 
+    if adaptive_gamma:
+        gamma_value = get_adaptive_gamma(img, image_name, debug=debug)
+
     if debug:
         print 'Computing smoothness matrix...'
         tic()
 
-    pairwise_energies = compute_smoothness_vectorized(img, neighborhood='eight', debug=False)
+    pairwise_energies = get_graph_pairwise_energies(
+        compute_smoothness_vectorized(img, neighborhood='eight', debug=False))
     
     if debug:
         toc('Computing smoothness matrix')
@@ -561,10 +748,15 @@ def grabcut(img, bbox, image_name, user_interaction=False, num_iterations=10,
     if debug:
         print 'Starting EM'
     
-    segmentations = []
+    if compact_history:
+        segmentations = SegmentationHistory()
+    else:
+        segmentations = []
     segmentations.append(alpha)
+    energies = []
     user_definite_background = set()
     pixels = img.reshape((img.shape[0]*img.shape[1], img.shape[2]))
+    pool = ThreadPool(num_threads) if num_threads > 1 else None
     for user_interaction_iteration in xrange(2):
         for iteration in xrange(1,num_iterations+1):
             if debug:
@@ -575,12 +767,10 @@ def grabcut(img, bbox, image_name, user_interaction=False, num_iterations=10,
             # 1. Assigning GMM components to pixels
             if debug:
                 tic()
-            foreground_components = foreground_gmm.get_component(pixels).reshape((img.shape[0], img.shape[1]))
-            background_components = background_gmm.get_component(pixels).reshape((img.shape[0], img.shape[1]))
+            foreground_components = foreground_gmm.get_component(pixels).astype(np.int8).reshape((img.shape[0], img.shape[1]))
+            background_components = background_gmm.get_component(pixels).astype(np.int8).reshape((img.shape[0], img.shape[1]))
 
-            k = np.ones((img.shape[0],img.shape[1]), dtype=int)*-1
-            k[alpha==1] = foreground_components[alpha==1]
-            k[alpha==0] = background_components[alpha==0]
+            k = np.where(alpha==1, foreground_components, background_components)
 
             if debug:
                 toc('Assigning GMM components')
@@ -593,14 +783,7 @@ def grabcut(img, bbox, image_name, user_interaction=False, num_iterations=10,
             # 2. Learn GMM parameters
             if debug:
                 tic()
-            foreground_assignments = -1*np.ones(k.shape)
-            foreground_assignments[alpha==1] = k[alpha==1]
-
-            background_assignments = -1*np.ones(k.shape)
-            background_assignments[alpha==0] = k[alpha==0]
-
-            foreground_gmm.update_components(img, foreground_assignments)
-            background_gmm.update_components(img, background_assignments)
+            update_gmms(pixels, k, alpha, foreground_gmm, background_gmm, pool=pool)
 
             if debug:
                 toc('Updating GMM parameters')
@@ -609,58 +792,14 @@ def grabcut(img, bbox, image_name, user_interaction=False, num_iterations=10,
             # Compute Unary weights
             if debug:
                 tic()
-            graph = create_graph(img)
             theta = (background_gmm, foreground_gmm)
 
             foreground_energies = get_unary_energy_vectorized(1, foreground_components.reshape((img.shape[0]*img.shape[1], 1)), theta, pixels)
             background_energies = get_unary_energy_vectorized(0, background_components.reshape((img.shape[0]*img.shape[1], 1)), theta, pixels)
 
-            done_with = set()
-            for h in xrange(img.shape[0]):
-                for w in xrange(img.shape[1]):
-                    index = h*img.shape[1] + w
-                    # If pixel is outside of bounding box, assign large unary energy
-                    if w < bbox[0] or w > bbox[2] or h < bbox[1] or h > bbox[3]:
-                        w1 = 1e9
-                        w2 = 0
-                    elif (w,h) in user_definite_background:
-                        w1 = 1e9
-                        w2 = 0
-                    else:
-                        # Source: Compute U for curr node
-                        start_time = time.time()
-                        w1 = foreground_energies[index] # to background node
-                        w2 = background_energies[index] # to foreground node
-
-                    graph.add_tweights(index, w1, w2)
-
-            # Compute pairwise weights
-            NEIGHBORHOOD = [(-1,0),(+1,0),(0,-1),(0,+1),(-1,-1),(-1,+1),(+1,+1),(+1,-1)]
-            src_h = np.tile(np.arange(img.shape[0]).reshape(img.shape[0], 1), (1, img.shape[1]))
-            src_w = np.tile(np.arange(img.shape[1]).reshape(1, img.shape[1]), (img.shape[0], 1))
-            src_h = src_h.astype(np.int32)
-            src_w = src_w.astype(np.int32)
-
-            for i, energy in enumerate(pairwise_energies):
-                if i in [1,3,6,7]:
-                    continue
-                height_offset, width_offset = NEIGHBORHOOD[i]
-
-                dst_h = src_h + height_offset
-                dst_w = src_w + width_offset
-
-                idx = np.logical_and(np.logical_and(dst_h >= 0, dst_h < img.shape[0]),
-                                    np.logical_and(dst_w >= 0, dst_w < img.shape[1]))
-
-                src_idx = src_h * img.shape[1] + src_w
-                dst_idx = dst_h * img.shape[1] + dst_w
-
-                src_idx = src_idx[idx].flatten()
-                dst_idx = dst_idx[idx].flatten()
-                weights = energy.astype(np.float32)[idx].flatten()
-                weights = gamma*weights
-
-                graph.add_edge_vectorized(src_idx, dst_idx, weights, weights)
+            graph = build_graph(img, bbox, foreground_energies, background_energies,
+                pairwise_energies, user_definite_background, solver=maxflow_solver,
+                gamma_value=gamma_value)
 
             if debug:
                 toc("Creating graph")
@@ -669,7 +808,11 @@ def grabcut(img, bbox, image_name, user_interaction=False, num_iterations=10,
             if debug:
                 tic()
             graph.maxflow()
-            partition = graph.what_segment_vectorized()
+            partition = graph.what_segment_vectorized().astype(np.int8)
+            partition = partition.reshape(alpha.shape)
+            # Free the graph now rather than when the next one is assigned,
+            # so that two graphs are never alive at the same time
+            graph = None
 
             if debug:
                 toc("Min cut")
@@ -678,8 +821,7 @@ def grabcut(img, bbox, image_name, user_interaction=False, num_iterations=10,
             if debug:
                 tic()
 
-            partition = partition.reshape(alpha.shape)
-            num_changed_pixels = np.sum(np.abs(partition-alpha))
+            num_changed_pixels = np.count_nonzero(partition != alpha)
             alpha = partition
             segmentations.append(alpha)
 
@@ -688,15 +830,32 @@ def grabcut(img, bbox, image_name, user_interaction=False, num_iterations=10,
 
             relative_change = num_changed_pixels/float(img.shape[0]*img.shape[1])
 
+            # Total energy of the new segmentation
+            if stop_on_convergence or get_energies or debug:
+                definite_background = get_definite_background(img.shape, bbox,
+                    user_definite_background)
+                energy = get_energy_vectorized(alpha, foreground_energies,
+                    background_energies, pairwise_energies, definite_background,
+                    gamma_value=gamma_value)
+                energies.append(energy)
+
             if drawImage:
                 if iteration % 10 == 0 or (iteration == num_iterations and not user_interaction):
-                    result = np.reshape(partition, (img.shape[0], img.shape[1]))*255
-                    result = result.astype(dtype=np.uint8)
+                    result = np.reshape(partition, (img.shape[0], img.shape[1]))
+                    result = result.astype(dtype=np.uint8)*255
                     result = np.dstack((result, result, result))
                     plt.imshow(result)
                     plt.show()
             if debug:
                 print 'Relative change was %f'%relative_change
+                print 'Energy was %f'%energy
+
+            if stop_on_convergence and len(energies) > 1:
+                relative_energy_change = abs(energies[-2] - energies[-1])/abs(energies[-2])
+                if relative_energy_change < CONVERGENCE_CRITERON:
+                    if debug:
+                        print 'Converged after %d iterations'%iteration
+                    break
 
         # Prompt for user interaction if enabled
         if user_interaction:
@@ -716,11 +875,14 @@ def grabcut(img, bbox, image_name, user_interaction=False, num_iterations=10,
                         alpha[current_y,current_x] = 0
         else:
             break
-        
-    if get_all_segmentations:
-        return segmentations
-    else:
-        return alpha
+
+    if pool is not None:
+        pool.close()
+
+    result = segmentations if get_all_segmentations else alpha
+    if get_energies:
+        return result, energies
+    return result
 
 def main():
     args = get_args()
@@ -738,11 +900,14 @@ def main():
     print 'Num Iterations: %d'%args.num_iterations
     print 'Num Components: %d'%args.num_components
     print 'User Interaction Enabled: %r'%args.user_interaction
+    print 'Maxflow Solver: %s'%args.maxflow_solver
+    print 'Adaptive Gamma: %r'%args.adaptive_gamma
     print '----------------------------------------------'
      
     grabcut(img, bbox, args.image_file, num_iterations=args.num_iterations, 
         num_components=args.num_components, user_interaction=args.user_interaction, 
-        debug=True, drawImage=True)
+        debug=True, drawImage=True, maxflow_solver=args.maxflow_solver,
+        adaptive_gamma=args.adaptive_gamma)
 
 ################################################################################
 ######################## UNVECTORIZED GRABCUT HELPERS ##########################
@@ -0,0 +1,210 @@
+import numpy as np
+
+try:
+    import third_party.pymaxflow.pymaxflow as pymaxflow
+except ImportError:
+    try:
+        import pymaxflow
+    except ImportError:
+        pymaxflow = None
+
+try:
+    import third_party.pushrelabel.pypushrelabel as pypushrelabel
+except ImportError:
+    try:
+        import pypushrelabel
+    except ImportError:
+        pypushrelabel = None
+
+try:
+    import scipy.sparse
+    from scipy.sparse.csgraph import maximum_flow, breadth_first_order
+    scipy_maxflow_available = True
+except ImportError:
+    scipy_maxflow_available = False
+
+# Segment labels, identical to the termtype enum in graph.h
+SOURCE = 0
+SINK = 1
+
+################################################################################
+############################### SCIPY BACKEND ##################################
+################################################################################
+# ScipyGraph class
+# Drop-in replacement for pymaxflow.PyGraph that solves the min cut with
+# scipy.sparse.csgraph.maximum_flow (requires scipy >= 1.4, which needs
+# Python 3, so it is not available with the Python 2 runtime of this
+# project; use the pushrelabel backend to compare against bk). The graph is
+# only collected while edges are added, and is assembled into a single sparse
+# capacity matrix when maxflow() is called.
+#
+# scipy only supports integer capacities, so all capacities are multiplied by
+# capacity_scale and rounded. Terminal capacities are clipped to
+# MAX_CAPACITY, which still acts as "infinity" for the hard constraints
+# (1e9) used in grabcut.
+class ScipyGraph:
+    MAX_CAPACITY = 2**30
+
+    def __init__(self, node_num_max, edge_num_max, capacity_scale=1000.0):
+        if not scipy_maxflow_available:
+            raise ImportError('The scipy backend requires scipy >= 1.4 '
+                '(scipy.sparse.csgraph.maximum_flow)')
+        self.capacity_scale = capacity_scale
+        self.num_nodes = 0
+
+        self.cap_source = np.zeros((0,), dtype=np.float64)
+        self.cap_sink = np.zeros((0,), dtype=np.float64)
+
+        self.edge_src = []
+        self.edge_dst = []
+        self.edge_cap = []
+        self.edge_rev_cap = []
+
+        self.segments = None
+
+    def add_node(self, num=1):
+        first_node = self.num_nodes
+        self.num_nodes += num
+        self.cap_source = np.concatenate((self.cap_source, np.zeros((num,))))
+        self.cap_sink = np.concatenate((self.cap_sink, np.zeros((num,))))
+        return first_node
+
+    def get_node_num(self):
+        return self.num_nodes
+
+    def add_edge(self, i, j, cap, rev_cap):
+        self.add_edge_vectorized(np.array([i], dtype=np.int32),
+            np.array([j], dtype=np.int32), np.array([cap], dtype=np.float32),
+            np.array([rev_cap], dtype=np.float32))
+
+    def add_edge_vectorized(self, i, j, cap, rev_cap):
+        assert i.size == j.size
+        assert i.size == cap.size
+        assert i.size == rev_cap.size
+        self.edge_src.append(np.asarray(i, dtype=np.int32))
+        self.edge_dst.append(np.asarray(j, dtype=np.int32))
+        self.edge_cap.append(np.asarray(cap, dtype=np.float64))
+        self.edge_rev_cap.append(np.asarray(rev_cap, dtype=np.float64))
+
+    def add_tweights(self, i, cap_source, cap_sink):
+        self.cap_source[i] += cap_source
+        self.cap_sink[i] += cap_sink
+
+    def add_tweights_vectorized(self, i, cap_source, cap_sink):
+        assert i.size == cap_source.size
+        assert i.size == cap_sink.size
+        np.add.at(self.cap_source, i, cap_source)
+        np.add.at(self.cap_sink, i, cap_sink)
+
+    # Computes the maximum flow, and returns the value of the corresponding
+    # minimum cut (in the original, unscaled capacities)
+    def maxflow(self):
+        n = self.num_nodes
+        source, sink = n, n + 1
+
+        # Like graph.cpp, only the difference between the two terminal
+        # capacities of a node matters; the common part is a constant flow
+        common = np.minimum(self.cap_source, self.cap_sink)
+        cap_source = self.cap_source - common
+        cap_sink = self.cap_sink - common
+
+        if len(self.edge_src) > 0:
+            src = np.concatenate(self.edge_src)
+            dst = np.concatenate(self.edge_dst)
+            cap = np.concatenate(self.edge_cap)
+            rev_cap = np.concatenate(self.edge_rev_cap)
+        else:
+            src = dst = np.zeros((0,), dtype=np.int32)
+            cap = rev_cap = np.zeros((0,))
+
+        nodes = np.arange(n, dtype=np.int32)
+        rows = np.concatenate((src, dst, np.tile(source, n), nodes))
+        cols = np.concatenate((dst, src, nodes, np.tile(sink, n)))
+        capacities = np.concatenate((self.scale(cap), self.scale(rev_cap),
+            self.scale(cap_source), self.scale(cap_sink)))
+
+        keep = capacities > 0
+        graph = scipy.sparse.csr_matrix(
+            (capacities[keep], (rows[keep], cols[keep])), shape=(n + 2, n + 2))
+        graph.sum_duplicates()
+
+        result = maximum_flow(graph, source, sink)
+        flow = getattr(result, 'flow', None)
+        if flow is None:
+            # scipy < 1.8 calls the flow matrix 'residual'
+            flow = result.residual
+
+        # Nodes reachable from the source in the residual graph form the
+        # source side of the minimum cut
+        residual = (graph - flow).tocsr()
+        residual.data[residual.data < 0] = 0
+        residual.eliminate_zeros()
+        reachable = breadth_first_order(residual, source, directed=True,
+            return_predecessors=False)
+
+        self.segments = np.ones((n + 2,), dtype=np.int32) * SINK
+        self.segments[reachable] = SOURCE
+        self.segments = self.segments[:n]
+
+        # Cut value from the unscaled capacities
+        is_source = self.segments == SOURCE
+        cut = np.sum(common)
+        cut += np.sum(cap_source[~is_source]) + np.sum(cap_sink[is_source])
+        cut += np.sum(cap[is_source[src] & ~is_source[dst]])
+        cut += np.sum(rev_cap[is_source[dst] & ~is_source[src]])
+        return cut
+
+    def scale(self, capacities):
+        scaled = np.rint(capacities * self.capacity_scale)
+        return np.minimum(scaled, self.MAX_CAPACITY).astype(np.int32)
+
+    def what_segment(self, i):
+        return self.segments[i]
+
+    def what_segment_vectorized(self):
+        return self.segments.copy()
+
+################################################################################
+############################### SOLVER REGISTRY ################################
+################################################################################
+def create_bk_graph(node_num_max, edge_num_max):
+    if pymaxflow is None:
+        raise ImportError('pymaxflow has not been built. Please run '
+            'check_dependencies.py')
+    return pymaxflow.PyGraph(node_num_max, edge_num_max)
+
+def create_pushrelabel_graph(node_num_max, edge_num_max):
+    if pypushrelabel is None:
+        raise ImportError('pypushrelabel has not been built. Please run '
+            'check_dependencies.py')
+    return pypushrelabel.PyGraph(node_num_max, edge_num_max)
+
+# Maps the name of a maxflow backend to a function that creates an empty
+# graph with room for the given number of nodes and edges.
+#   bk - Boykov-Kolmogorov (pymaxflow, third_party/pymaxflow/graph.cpp)
+#   pushrelabel - highest-label push-relabel (pypushrelabel,
+#     third_party/pushrelabel/pushrelabel.cpp)
+#   scipy - scipy.sparse.csgraph.maximum_flow
+MAXFLOW_SOLVERS = {
+    'bk': create_bk_graph,
+    'pushrelabel': create_pushrelabel_graph,
+    'scipy': ScipyGraph,
+}
+
+# Returns the names of the backends that can be used on this machine
+def available_solvers():
+    solvers = []
+    if pymaxflow is not None:
+        solvers.append('bk')
+    if pypushrelabel is not None:
+        solvers.append('pushrelabel')
+    if scipy_maxflow_available:
+        solvers.append('scipy')
+    return solvers
+
+# Creates an empty graph using the requested maxflow backend
+def create_solver_graph(solver, node_num_max, edge_num_max):
+    if solver not in MAXFLOW_SOLVERS:
+        raise ValueError('Unknown maxflow solver \'%s\'. Choose one of: %s'%(
+            solver, ', '.join(sorted(MAXFLOW_SOLVERS.keys()))))
+    return MAXFLOW_SOLVERS[solver](node_num_max, edge_num_max)
@@ -0,0 +1,89 @@
+import numpy as np
+
+# SegmentationHistory class
+# Stores the sequence of alpha maps produced by GrabCut in a compact form.
+# The first alpha map is kept bitpacked (1 bit per pixel), and every
+# following map only stores the flat indices of the pixels that changed since
+# the previous one. Since only a few pixels change between iterations, the
+# history is much smaller than a list of full masks.
+#
+# The history behaves like a read-only list of int8 alpha maps, i.e. it
+# supports len(), indexing and iteration.
+class SegmentationHistory:
+    def __init__(self):
+        self.shape = None
+        self.keyframe = None # Bitpacked first alpha map
+        self.deltas = [] # Flat indices of changed pixels for every later map
+        self.last = None # Most recent alpha map, used to compute the next delta
+
+    # alpha - 2D alpha map with values 0 (background) and 1 (foreground)
+    def append(self, alpha):
+        current = alpha.ravel() != 0
+        if self.keyframe is None:
+            self.shape = alpha.shape
+            self.keyframe = np.packbits(current)
+        else:
+            assert alpha.shape == self.shape
+            self.deltas.append(np.flatnonzero(current != self.last).astype(np.int32))
+        self.last = current
+
+    def __len__(self):
+        if self.keyframe is None:
+            return 0
+        return len(self.deltas) + 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('SegmentationHistory index out of range')
+
+        alpha = self.get_keyframe()
+        for delta in self.deltas[:index]:
+            alpha[delta] ^= True
+        return alpha.reshape(self.shape).astype(np.int8)
+
+    def __iter__(self):
+        if self.keyframe is None:
+            return
+        alpha = self.get_keyframe()
+        yield alpha.reshape(self.shape).astype(np.int8)
+        for delta in self.deltas:
+            alpha[delta] ^= True
+            yield alpha.reshape(self.shape).astype(np.int8)
+
+    def get_keyframe(self):
+        num_pixels = self.shape[0]*self.shape[1]
+        return np.unpackbits(self.keyframe)[:num_pixels].astype(bool)
+
+    # Number of bytes used to store the history (excluding the working copy of
+    # the last alpha map)
+    def nbytes(self):
+        if self.keyframe is None:
+            return 0
+        return self.keyframe.nbytes + sum([delta.nbytes for delta in self.deltas])
+
+def SegmentationHistory_test():
+    masks = [np.random.randint(0, 2, size=(37, 53)).astype(np.int8)]
+    for i in xrange(10):
+        mask = masks[-1].copy()
+        flip = np.random.randint(0, mask.size, size=50)
+        mask.ravel()[flip] = 1 - mask.ravel()[flip]
+        masks.append(mask)
+
+    history = SegmentationHistory()
+    for mask in masks:
+        history.append(mask)
+
+    assert len(history) == len(masks)
+    for i, mask in enumerate(history):
+        assert np.array_equal(mask, masks[i])
+    assert np.array_equal(history[-1], masks[-1])
+    assert np.array_equal(history[3], masks[3])
+    print 'Stored %d bytes instead of %d'%(history.nbytes(), sum([m.nbytes for m in masks]))
+
+def main():
+    SegmentationHistory_test()
+
+if __name__ == '__main__':
+    main()
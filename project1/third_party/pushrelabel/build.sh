@@ -0,0 +1,8 @@
+#!/bin/bash
+
+if [ ! -f pushrelabel.cpp ]; then
+    cd third_party/pushrelabel
+fi
+output="$(python setup.py build_ext --inplace)"
+mv `echo $output | grep "pypushrelabel.so" | rev | cut -d' ' -f 1 | rev` .
+rm -rf project1/
@@ -0,0 +1,316 @@
+/* pushrelabel.cpp */
+
+#include <algorithm>
+#include "pushrelabel.h"
+
+// Work (relabels and arc scans) after which the labels are recomputed,
+// relative to the size of the graph (see Cherkassky and Goldberg)
+#define RELABEL_WORK 12
+#define GLOBAL_RELABEL_NODES 6
+#define GLOBAL_RELABEL_FREQ 2
+
+PushRelabelGraph::PushRelabelGraph(int node_num_max, int edge_num_max)
+	: num_nodes(0), max_label(1), highest_active(-1), highest_label(-1),
+	  work(0), sink_flow(0)
+{
+	cap_source.reserve(node_num_max);
+	cap_sink.reserve(node_num_max);
+	edge_i.reserve(edge_num_max);
+	edge_j.reserve(edge_num_max);
+	edge_cap.reserve(edge_num_max);
+	edge_rev_cap.reserve(edge_num_max);
+}
+
+int PushRelabelGraph::add_node(int num)
+{
+	int first = num_nodes;
+	num_nodes += num;
+	cap_source.resize(num_nodes, 0);
+	cap_sink.resize(num_nodes, 0);
+	return first;
+}
+
+void PushRelabelGraph::add_edge(int i, int j, double cap, double rev_cap)
+{
+	edge_i.push_back(i);
+	edge_j.push_back(j);
+	edge_cap.push_back(cap);
+	edge_rev_cap.push_back(rev_cap);
+}
+
+void PushRelabelGraph::add_tweights(int i, double cap_source_i, double cap_sink_i)
+{
+	cap_source[i] += cap_source_i;
+	cap_sink[i] += cap_sink_i;
+}
+
+PushRelabelGraph::termtype PushRelabelGraph::what_segment(int i) const
+{
+	return (termtype) segments[i];
+}
+
+// Builds the residual graph, with the arcs of every node next to each other
+void PushRelabelGraph::build_arcs()
+{
+	int m = (int) edge_i.size();
+
+	first_arc.assign(num_nodes + 1, 0);
+	for (int e = 0; e < m; e++)
+	{
+		first_arc[edge_i[e] + 1]++;
+		first_arc[edge_j[e] + 1]++;
+	}
+	for (int u = 0; u < num_nodes; u++)
+		first_arc[u + 1] += first_arc[u];
+
+	head.resize(2 * m);
+	sister.resize(2 * m);
+	residual.resize(2 * m);
+	std::vector<int> next(first_arc.begin(), first_arc.end() - 1);
+	for (int e = 0; e < m; e++)
+	{
+		int a = next[edge_i[e]]++;
+		int b = next[edge_j[e]]++;
+		head[a] = edge_j[e];
+		head[b] = edge_i[e];
+		sister[a] = b;
+		sister[b] = a;
+		residual[a] = edge_cap[e];
+		residual[b] = edge_rev_cap[e];
+	}
+}
+
+void PushRelabelGraph::add_to_bucket(int u)
+{
+	int l = label[u];
+	bucket_prev[u] = -1;
+	bucket_next[u] = bucket_first[l];
+	if (bucket_first[l] >= 0)
+		bucket_prev[bucket_first[l]] = u;
+	bucket_first[l] = u;
+	if (l > highest_label)
+		highest_label = l;
+}
+
+void PushRelabelGraph::remove_from_bucket(int u)
+{
+	if (bucket_prev[u] >= 0)
+		bucket_next[bucket_prev[u]] = bucket_next[u];
+	else
+		bucket_first[label[u]] = bucket_next[u];
+	if (bucket_next[u] >= 0)
+		bucket_prev[bucket_next[u]] = bucket_prev[u];
+}
+
+void PushRelabelGraph::activate(int u)
+{
+	int l = label[u];
+	active_next[u] = active_first[l];
+	active_first[l] = u;
+	if (l > highest_active)
+		highest_active = l;
+}
+
+// Sets every label to the exact distance to the sink in the residual graph
+// (breadth first search from the sink), and rebuilds the buckets
+void PushRelabelGraph::global_relabel()
+{
+	std::fill(label.begin(), label.end(), max_label);
+	std::fill(active_first.begin(), active_first.end(), -1);
+	std::fill(bucket_first.begin(), bucket_first.end(), -1);
+	highest_active = -1;
+	highest_label = -1;
+
+	std::vector<int> queue;
+	queue.reserve(num_nodes);
+	for (int u = 0; u < num_nodes; u++)
+	{
+		if (to_sink[u] > 0)
+		{
+			label[u] = 1;
+			queue.push_back(u);
+		}
+	}
+	for (size_t q = 0; q < queue.size(); q++)
+	{
+		int u = queue[q];
+		for (int a = first_arc[u]; a < first_arc[u + 1]; a++)
+		{
+			int v = head[a];
+			if (label[v] == max_label && residual[sister[a]] > 0)
+			{
+				label[v] = label[u] + 1;
+				queue.push_back(v);
+			}
+		}
+	}
+
+	for (size_t q = 0; q < queue.size(); q++)
+	{
+		int u = queue[q];
+		current[u] = first_arc[u];
+		add_to_bucket(u);
+		if (excess[u] > 0)
+			activate(u);
+	}
+}
+
+void PushRelabelGraph::push(int u, int a)
+{
+	int v = head[a];
+	double delta = std::min(excess[u], residual[a]);
+	if (excess[v] == 0)
+		activate(v);
+	residual[a] -= delta;
+	residual[sister[a]] += delta;
+	excess[u] -= delta;
+	excess[v] += delta;
+}
+
+// No node is left with label l: the nodes above it cannot reach the sink.
+// They are all inactive, since only the highest active node is discharged.
+void PushRelabelGraph::gap(int l)
+{
+	for (int k = l + 1; k <= highest_label; k++)
+	{
+		for (int u = bucket_first[k]; u >= 0; u = bucket_next[u])
+			label[u] = max_label;
+		bucket_first[k] = -1;
+	}
+	highest_label = l - 1;
+}
+
+// Pushes the excess of u to its neighbors, relabeling u until it has no
+// excess left or cannot reach the sink anymore
+void PushRelabelGraph::discharge(int u)
+{
+	while (true)
+	{
+		int l = label[u];
+		if (l == 1 && to_sink[u] > 0)
+		{
+			double delta = std::min(excess[u], to_sink[u]);
+			to_sink[u] -= delta;
+			excess[u] -= delta;
+			sink_flow += delta;
+			if (excess[u] == 0)
+				return;
+		}
+
+		int end = first_arc[u + 1];
+		for (int a = current[u]; a < end; a++)
+		{
+			if (residual[a] > 0 && label[head[a]] == l - 1)
+			{
+				push(u, a);
+				if (excess[u] == 0)
+				{
+					current[u] = a;
+					return;
+				}
+			}
+		}
+
+		// Relabel
+		work += RELABEL_WORK + end - first_arc[u];
+		remove_from_bucket(u);
+		if (bucket_first[l] < 0)
+		{
+			gap(l);
+			label[u] = max_label;
+			return;
+		}
+
+		int new_label = max_label;
+		int new_current = first_arc[u];
+		if (to_sink[u] > 0)
+			new_label = 1;
+		for (int a = first_arc[u]; a < end; a++)
+		{
+			if (residual[a] > 0 && label[head[a]] + 1 < new_label)
+			{
+				new_label = label[head[a]] + 1;
+				new_current = a;
+			}
+		}
+		label[u] = new_label;
+		current[u] = new_current;
+		if (new_label >= max_label)
+			return;
+		add_to_bucket(u);
+	}
+}
+
+double PushRelabelGraph::maxflow()
+{
+	int n = num_nodes;
+	build_arcs();
+
+	// The source edges are saturated right away. Like graph.cpp, only the
+	// difference between the two terminal capacities of a node matters.
+	double flow = 0;
+	excess.resize(n);
+	to_sink.resize(n);
+	for (int u = 0; u < n; u++)
+	{
+		double common = std::min(cap_source[u], cap_sink[u]);
+		flow += common;
+		excess[u] = cap_source[u] - common;
+		to_sink[u] = cap_sink[u] - common;
+	}
+
+	max_label = n + 1;
+	label.assign(n, max_label);
+	current.assign(n, 0);
+	active_first.assign(max_label, -1);
+	active_next.assign(n, -1);
+	bucket_first.assign(max_label, -1);
+	bucket_next.assign(n, -1);
+	bucket_prev.assign(n, -1);
+	sink_flow = 0;
+	work = 0;
+
+	long global_relabel_work = GLOBAL_RELABEL_FREQ *
+		((long) GLOBAL_RELABEL_NODES * n + (long) first_arc[n]);
+	global_relabel();
+	while (highest_active >= 0)
+	{
+		int u = active_first[highest_active];
+		if (u < 0)
+		{
+			highest_active--;
+			continue;
+		}
+		active_first[highest_active] = active_next[u];
+		discharge(u);
+
+		if (work > global_relabel_work)
+		{
+			global_relabel();
+			work = 0;
+		}
+	}
+
+	// Nodes that can still reach the sink are on the sink side
+	global_relabel();
+	segments.resize(n);
+	for (int u = 0; u < n; u++)
+		segments[u] = (char) (label[u] < max_label ? SINK : SOURCE);
+
+	// Only the segments are needed from now on
+	std::vector<int>().swap(first_arc);
+	std::vector<int>().swap(head);
+	std::vector<int>().swap(sister);
+	std::vector<double>().swap(residual);
+	std::vector<double>().swap(excess);
+	std::vector<double>().swap(to_sink);
+	std::vector<int>().swap(label);
+	std::vector<int>().swap(current);
+	std::vector<int>().swap(active_first);
+	std::vector<int>().swap(active_next);
+	std::vector<int>().swap(bucket_first);
+	std::vector<int>().swap(bucket_next);
+	std::vector<int>().swap(bucket_prev);
+
+	return flow + sink_flow;
+}
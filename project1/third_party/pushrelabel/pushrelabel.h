@@ -0,0 +1,100 @@
+/* pushrelabel.h */
+/*
+	Highest-label push-relabel maxflow with global relabeling and the gap
+	heuristic, as described in
+
+		"On Implementing Push-Relabel Method for the Maximum Flow Problem."
+		Boris V. Cherkassky and Andrew V. Goldberg.
+		Algorithmica, 1997
+
+	The interface follows Graph in ../pymaxflow/graph.h, so that both
+	solvers can be used interchangeably on the same graph:
+
+		PushRelabelGraph g(node_num_max, edge_num_max);
+		g.add_node(n);
+		g.add_tweights(i, cap_source, cap_sink);
+		g.add_edge(i, j, cap, rev_cap);
+		double flow = g.maxflow();
+		g.what_segment(i); // SOURCE or SINK
+
+	Only the first phase of the method is run (a maximum preflow), which is
+	enough for the minimum cut: the nodes that can still reach the sink in
+	the residual graph are labeled SINK, and all other nodes SOURCE. Like
+	the Boykov-Kolmogorov solver (whose default segment is SOURCE), this
+	gives the minimum cut with the largest source side when several exist.
+
+	Capacities are doubles. Every push either empties the excess of a node
+	or saturates an arc, so the residual capacities never become negative.
+*/
+
+#ifndef __PUSHRELABEL_H__
+#define __PUSHRELABEL_H__
+
+#include <vector>
+
+class PushRelabelGraph
+{
+public:
+	typedef enum
+	{
+		SOURCE	= 0,
+		SINK	= 1
+	} termtype;
+
+	PushRelabelGraph(int node_num_max, int edge_num_max);
+
+	// Adds num nodes, and returns the index of the first one
+	int add_node(int num = 1);
+
+	// Adds the edges i -> j with capacity cap, and j -> i with capacity rev_cap
+	void add_edge(int i, int j, double cap, double rev_cap);
+
+	// Adds the terminal edges source -> i and i -> sink
+	void add_tweights(int i, double cap_source, double cap_sink);
+
+	// Computes the maximum flow and returns its value
+	double maxflow();
+
+	// Side of node i in the minimum cut (after maxflow)
+	termtype what_segment(int i) const;
+
+	int get_node_num() const { return num_nodes; }
+
+private:
+	int num_nodes;
+
+	// Edges and terminal capacities, as given by the caller
+	std::vector<int> edge_i, edge_j;
+	std::vector<double> edge_cap, edge_rev_cap;
+	std::vector<double> cap_source, cap_sink;
+
+	// Residual graph. The arcs of node u are
+	// first_arc[u] .. first_arc[u+1]-1, and sister[a] is the reverse of a.
+	std::vector<int> first_arc, head, sister;
+	std::vector<double> residual;
+	std::vector<double> excess;
+	std::vector<double> to_sink; // Residual capacity of u -> sink
+
+	// Labels, current arcs and buckets. max_label (num_nodes + 1) means
+	// that the node cannot reach the sink anymore.
+	int max_label;
+	std::vector<int> label, current;
+	std::vector<int> active_first, active_next;
+	std::vector<int> bucket_first, bucket_next, bucket_prev;
+	int highest_active, highest_label;
+	long work;
+	double sink_flow;
+
+	std::vector<char> segments;
+
+	void build_arcs();
+	void global_relabel();
+	void discharge(int u);
+	void push(int u, int a);
+	void gap(int l);
+	void add_to_bucket(int u);
+	void remove_from_bucket(int u);
+	void activate(int u);
+};
+
+#endif
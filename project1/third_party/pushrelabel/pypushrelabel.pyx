@@ -0,0 +1,68 @@
+# distutils: language = c++
+# distutils: sources = pushrelabel.cpp
+
+import numpy as np
+cimport numpy as np
+cimport cython
+
+cdef extern from "pushrelabel.h":
+    cdef cppclass PushRelabelGraph:
+        PushRelabelGraph(int node_num_max, int edge_num_max) except +
+        int add_node(int)
+        void add_edge(int i, int j, double cap, double rev_cap)
+        void add_tweights(int i, double cap_source, double cap_sink)
+        double maxflow()
+        int what_segment(int i)
+        int get_node_num()
+
+# Same interface as pymaxflow.PyGraph
+cdef class PyGraph:
+    cdef PushRelabelGraph *thisptr
+    def __cinit__(self, int node_num_max, int edge_num_max):
+        self.thisptr = new PushRelabelGraph(node_num_max, edge_num_max)
+    def __dealloc__(self):
+        del self.thisptr
+    def add_node(self, int num=1):
+        return self.thisptr.add_node(num)
+    def add_edge(self, int i, int j, double cap, double rev_cap):
+        self.thisptr.add_edge(i, j, cap, rev_cap)
+    def add_tweights(self, int i, double cap_source, double cap_sink):
+        self.thisptr.add_tweights(i, cap_source, cap_sink)
+    def maxflow(self):
+        return self.thisptr.maxflow()
+    def what_segment(self, int i):
+        return self.thisptr.what_segment(i)
+    def get_node_num(self):
+        return self.thisptr.get_node_num()
+
+    @cython.boundscheck(False)
+    def add_edge_vectorized(self,
+                            np.ndarray[dtype=np.int32_t, ndim=1, negative_indices=False] i,
+                            np.ndarray[dtype=np.int32_t, ndim=1, negative_indices=False] j,
+                            np.ndarray[dtype=np.float32_t, ndim=1, negative_indices=False] cap,
+                            np.ndarray[dtype=np.float32_t, ndim=1, negative_indices=False] rev_cap):
+        assert i.size == j.size
+        assert i.size == cap.size
+        assert i.size == rev_cap.size
+        cdef int l
+        for l in range(i.size):
+            self.thisptr.add_edge(i[l], j[l], cap[l], rev_cap[l])
+
+    @cython.boundscheck(False)
+    def add_tweights_vectorized(self,
+                            np.ndarray[dtype=np.int32_t, ndim=1, negative_indices=False] i,
+                            np.ndarray[dtype=np.float32_t, ndim=1, negative_indices=False] cap_source,
+                            np.ndarray[dtype=np.float32_t, ndim=1, negative_indices=False] cap_sink):
+        assert i.size == cap_source.size
+        assert i.size == cap_sink.size
+        cdef int l
+        for l in range(i.size):
+            self.thisptr.add_tweights(i[l], cap_source[l], cap_sink[l])
+
+    @cython.boundscheck(False)
+    def what_segment_vectorized(self):
+        cdef np.ndarray[dtype=np.int32_t, ndim=1, negative_indices=False] out_segments = np.empty(self.thisptr.get_node_num(), np.int32)
+        cdef int l
+        for l in range(self.thisptr.get_node_num()):
+            out_segments[l] = self.thisptr.what_segment(l)
+        return out_segments
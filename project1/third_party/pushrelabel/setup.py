@@ -0,0 +1,10 @@
+from distutils.core import setup
+from Cython.Build import cythonize
+import numpy as np
+
+
+setup(
+    name = "pypushrelabel",
+    include_dirs=[np.get_include()],
+    ext_modules = cythonize('pypushrelabel.pyx')
+)
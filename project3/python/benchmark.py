@@ -0,0 +1,192 @@
+import sys
+import time
+import argparse
+
+import numpy as np
+import util
+import suppression
+import proposal_filter
+import dataset_manifest
+
+from settings import *
+
+################################################################
+# Benchmarks of the R-CNN test pass
+#
+#   nms - Runs the NMS of suppression.py and the previous
+#         implementation (legacyNMS) on the same detections, checks
+#         that they keep the same bboxes, and reports the total and
+#         worst (tail) time per image. The detections are the
+#         selective search regions of every test image, scored by
+#         their overlap with the GT bboxes plus some noise. This is
+#         the cluttered worst case of the test pass, where a class
+#         fires on thousands of regions.
+#
+#   proposals - Recall of the GT bboxes of the test images by the
+#         selective search proposals kept by several proposal filter
+#         settings (see proposal_filter.py), against the number of
+#         proposals kept per image, i.e. the extraction cost. A GT
+#         bbox is recalled when a kept proposal overlaps it by 0.5
+#         (or 0.7), and MABO is the mean best overlap of the GT bboxes.
+#
+
+def getArgs():
+    parser = argparse.ArgumentParser(description='Benchmarks parts of the R-CNN test pass')
+    parser.add_argument("--mode", choices=['nms', 'proposals'], default='nms', help="What to benchmark")
+    parser.add_argument("--num_images", type=int, default=None, help="Only use the first num_images test images")
+    parser.add_argument("--max_detections", type=int, default=None, help="Maximum number of detections per image and class")
+    return parser.parse_args()
+
+# The NMS loop of test_rcnn before suppression.py. Kept as the reference
+def legacyNMS(data):
+    candidates = np.copy(data)
+    results = []
+
+    while candidates.size != 0:
+        curr_candidate = candidates[0, :]
+        rest_candidates = candidates[1:, :]
+        overlaps = util.computeOverlap(curr_candidate, rest_candidates)
+        results.append(curr_candidate)
+        candidates = rest_candidates[np.where(overlaps < NMS_THRESHOLD)[0], :]
+    return np.array(results)
+
+################################################################
+# makeDetections(data, max_detections)
+#   Builds scored detections of every class for every image
+#
+# Input: data (test data, see util.readMatrixData)
+#        max_detections (maximum number of detections per class)
+# Output: detections (list of (image_name, {class_id: n x 5 matrix sorted by score}))
+#
+def makeDetections(data, image_names, max_detections=None):
+    rng = np.random.RandomState(0)
+    detections = []
+    for image_name in image_names:
+        regions = data["ssearch"][image_name]
+        labels = np.array(data["gt"][image_name][0]).ravel()
+        gt_bboxes = data["gt"][image_name][1]
+        per_class = {}
+        for class_id in xrange(1, NUM_CLASSES+1):
+            IDX = np.where(labels == class_id)[0]
+            scores = 0.2 * rng.rand(regions.shape[0])
+            if len(IDX) > 0:
+                scores += util.computeOverlaps(regions, gt_bboxes[IDX]).max(axis=1)
+            order = np.argsort(-scores, kind='mergesort')
+            if max_detections is not None:
+                order = order[0:max_detections]
+            per_class[class_id] = np.hstack((regions[order], scores[order,np.newaxis]))
+        detections.append((image_name, per_class))
+    return detections
+
+# Runs nms_function on every detection matrix, returns the results and the
+# time spent on each image
+def timeNMS(nms_function, detections):
+    results = []
+    times = []
+    for image_name, per_class in detections:
+        start = time.time()
+        results.append(dict((c, nms_function(per_class[c])) for c in per_class))
+        times.append(time.time() - start)
+    return results, np.array(times)
+
+def benchmarkNMS(args):
+    data = util.readMatrixData("test")
+    image_names = sorted(data["gt"].keys())[0:args.num_images]
+    detections = makeDetections(data, image_names, args.max_detections)
+    num_detections = sum(d.shape[0] for _, per_class in detections for d in per_class.values())
+    print 'NMS on %d images, %d detections (threshold %0.2f)'%(len(detections), num_detections, NMS_THRESHOLD)
+    print '%-24s %10s %12s %12s %10s'%('Method', 'Kept', 'Total (s)', 'Worst (ms)', 'Speedup')
+
+    reference, reference_times = timeNMS(legacyNMS, detections)
+    num_kept = sum(r.shape[0] for result in reference for r in result.values())
+    print '%-24s %10d %12.3f %12.2f %10s'%('legacy', num_kept, reference_times.sum(), 1000*reference_times.max(), '1.0x')
+
+    def report(name, results, times, check=True):
+        num_kept = sum(len(r) for result in results for r in result.values())
+        if check:
+            for result, expected in zip(results, reference):
+                for c in expected:
+                    if not np.array_equal(result[c], expected[c]):
+                        print '[ERROR] %s keeps different bboxes than legacy NMS'%name
+                        sys.exit(1)
+        print '%-24s %10d %12.3f %12.2f %9.1fx'%(name, num_kept, times.sum(), 1000*times.max(),
+            reference_times.sum() / max(times.sum(), 1e-9))
+
+    results, times = timeNMS(lambda d: suppression.nms(d, NMS_THRESHOLD), detections)
+    report('nms', results, times)
+
+    results, times = timeNMS(lambda d: suppression.nms(d, NMS_THRESHOLD, top_k=10), detections)
+    report('nms (top 10)', results, times, check=False)
+
+    # All classes of an image in one pass
+    batched_results = []
+    batched_times = []
+    for image_name, per_class in detections:
+        class_ids = sorted(per_class.keys())
+        bboxes = util.stack([per_class[c] for c in class_ids])
+        labels = np.concatenate([c * np.ones(per_class[c].shape[0], dtype=int) for c in class_ids])
+        start = time.time()
+        keep = suppression.batchedNMS(bboxes, labels, NMS_THRESHOLD)
+        batched_times.append(time.time() - start)
+        batched_results.append(dict((c, bboxes[keep[labels[keep] == c]]) for c in class_ids))
+    report('batched nms', batched_results, np.array(batched_times))
+
+    results, times = timeNMS(lambda d: suppression.softNMS(d, 'linear'), detections)
+    report('soft-nms (linear)', results, times, check=False)
+
+    results, times = timeNMS(lambda d: suppression.softNMS(d, 'gaussian'), detections)
+    report('soft-nms (gaussian)', results, times, check=False)
+
+# Proposal filter settings compared by benchmarkProposals
+def proposalFilterSettings():
+    settings = [('all', proposal_filter.filterSettings(0, None, None, None))]
+    for top_n in [1500, 1000, 500, 250, 100]:
+        settings.append(('top %d'%top_n, proposal_filter.filterSettings(0, None, None, top_n)))
+    settings.append(('min size 20', proposal_filter.filterSettings(20, None, None, None)))
+    settings.append(('aspect ratio 4', proposal_filter.filterSettings(0, 4.0, None, None)))
+    for overlap in [0.9, 0.8, 0.7]:
+        settings.append(('dedup %0.1f'%overlap, proposal_filter.filterSettings(0, None, overlap, None)))
+    for top_n in [None, 1000, 500]:
+        name = 'size+aspect+dedup 0.8' + ('' if top_n is None else ' top %d'%top_n)
+        settings.append((name, proposal_filter.filterSettings(20, 4.0, 0.8, top_n)))
+    return settings
+
+def benchmarkProposals(args):
+    # All the proposals of the ssearch file, whatever the filter settings
+    data = dataset_manifest.readDataset("test", settings=proposal_filter.filterSettings(0, None, None, None))
+    image_names = sorted(data["gt"].keys())[0:args.num_images]
+    images = [(data["ssearch"][image_name], data["gt"][image_name][1]) for image_name in image_names]
+    num_proposals = sum(regions.shape[0] for regions, _ in images)
+    num_gt = sum(gt_bboxes.shape[0] for _, gt_bboxes in images)
+    print 'Proposals of %d images: %d proposals, %d GT bboxes'%(len(images), num_proposals, num_gt)
+    print '%-32s %12s %10s %10s %10s %8s %10s'%('Filter', 'Per image', 'Kept', 'Recall@0.5', 'Recall@0.7', 'MABO', 'Time (s)')
+
+    for name, settings in proposalFilterSettings():
+        best_overlaps = []
+        num_kept = 0
+        filter_time = 0.0
+        for regions, gt_bboxes in images:
+            start = time.time()
+            kept = proposal_filter.filterProposals(regions, settings)
+            filter_time += time.time() - start
+            num_kept += kept.shape[0]
+            if gt_bboxes.shape[0] == 0:
+                continue
+            if kept.shape[0] == 0:
+                best_overlaps.append(np.zeros(gt_bboxes.shape[0]))
+            else:
+                best_overlaps.append(util.computeOverlaps(regions[kept], gt_bboxes).max(axis=0))
+        best_overlaps = np.concatenate(best_overlaps)
+        print '%-32s %12.1f %9.1f%% %10.3f %10.3f %8.3f %10.3f'%(name, float(num_kept) / len(images),
+            100.0 * num_kept / num_proposals, np.mean(best_overlaps >= 0.5), np.mean(best_overlaps >= 0.7),
+            best_overlaps.mean(), filter_time)
+
+def main():
+    args = getArgs()
+    if args.mode == 'nms':
+        benchmarkNMS(args)
+    if args.mode == 'proposals':
+        benchmarkProposals(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+import os.path
+
+import cv2
+import numpy as np
+
+from scipy.io import loadmat
+from settings import *
+
+try:
+    import caffe
+    caffe_available = True
+except ImportError:
+    caffe_available = False
+
+################################################################
+# loadImageMean()
+#   Loads the ILSVRC 2012 mean image and crops its center to the
+#   CNN input size. The mean is used to fill the parts of warped
+#   regions that fall outside of the image
+#
+# Input: None
+# Output: img_mean (CNN_INPUT_SIZE x CNN_INPUT_SIZE x 3 matrix)
+#
+def loadImageMean():
+    img_mean = loadmat(os.path.join(ML_DIR, "ilsvrc_2012_mean.mat"))["image_mean"]
+    offset = int(np.floor((img_mean.shape[0] - CNN_INPUT_SIZE)/2) + 1)
+    return img_mean[offset:offset+CNN_INPUT_SIZE, offset:offset+CNN_INPUT_SIZE, :]
+
+################################################################
+# Feature layers
+#   Every backend extracts a list of layers (FEATURE_LAYER by
+#   default) in the same forward pass. The features of a region
+#   are the outputs of its layers, flattened and concatenated in
+#   the order of the list. backend.layer_sizes gives the number of
+#   features of every layer, which feature_store.FeatureStoreWriter
+#   uses to write each layer to its own shards.
+#
+
+# Checks that every layer is in the registry of a backend (dictionary
+# layer name -> number of features), and returns [(layer, num_features)]
+def selectLayers(layers, registry):
+    for layer in layers:
+        if layer not in registry:
+            raise ValueError('Unknown layer \'%s\'. Choose from: %s'%(layer, ', '.join(sorted(registry.keys()))))
+    return [(layer, int(registry[layer])) for layer in layers]
+
+# Layers of a caffe network, with the number of features per region
+def caffeLayers(net):
+    return dict((name, blob.data[0].size) for name, blob in net.blobs.items())
+
+################################################################
+# CaffeBackend
+#   Extracts the layers with the caffe network defined by
+#   MODEL_DEPLOY and MODEL_SNAPSHOT
+#
+class CaffeBackend:
+    def __init__(self, gpu_id=0, layers=[FEATURE_LAYER]):
+        if not caffe_available:
+            raise ImportError('The caffe backend requires pycaffe')
+
+        # Must be in the form (3,227,227)
+        # K,H,W (https://github.com/BVLC/caffe/blob/master/python/caffe/io.py Line 136)
+        img_mean = np.swapaxes(loadImageMean(), 0, 2)
+
+        if GPU_MODE == True:
+            caffe.set_mode_gpu()
+            #local_id = gpu_id % 4
+            caffe.set_device(0)
+        else:
+            caffe.set_mode_cpu()
+
+        # Channel Swap is because images are RGB, we want BGR
+        # Raw Scale is because sklearn (which caffe uses) loads pixels into [0,1] range
+        # Mean image is so that its subtracted from every image
+        self.net = caffe.Classifier(MODEL_DEPLOY, MODEL_SNAPSHOT, channel_swap=[2,1,0], mean=img_mean, raw_scale=255)
+        self.layer_sizes = selectLayers(layers, caffeLayers(self.net))
+        self.num_features = sum(num_features for _, num_features in self.layer_sizes)
+
+    # Do NOT use opencv to read the file. Caffe needs images in BGR format
+    # CAFFE LOADS R-G-B, thats why channel_swap needed
+    def loadImage(self, image_path):
+        return caffe.io.load_image(image_path)
+
+    # batch - n x CNN_INPUT_SIZE x CNN_INPUT_SIZE x 3 warped regions
+    # Returns the n x num_features features of the batch
+    def extract(self, batch):
+        # Turn off oversampling so that all our images are processed
+        self.net.predict(batch, oversample=False)
+        n = batch.shape[0]
+        return np.hstack([self.net.blobs[layer].data[0:n].reshape((n, -1)) for layer, _ in self.layer_sizes])
+
+# Loads an image in the same format as caffe.io.load_image (RGB in [0,1])
+def readImageRGB(image_path):
+    img = cv2.imread(image_path)
+    if img is None:
+        raise IOError('Could not read image \'%s\''%image_path)
+    return img[:,:,::-1].astype(np.float32) / 255.0
+
+# Layers of the numpy backends: pool5 (the pooled regions), fc6_ft (a
+# fixed random projection of pool5 with a ReLU) and fc7_ft (the same on
+# fc6_ft). Only the requested layers are computed
+def numpyLayers(pooled, weights, layer_sizes):
+    outputs = {'pool5': pooled}
+    layers = [layer for layer, _ in layer_sizes]
+    if 'fc6_ft' in layers or 'fc7_ft' in layers:
+        outputs['fc6_ft'] = np.maximum(np.dot(pooled, weights[0]), 0)
+    if 'fc7_ft' in layers:
+        outputs['fc7_ft'] = np.maximum(np.dot(outputs['fc6_ft'], weights[1]), 0)
+    return np.hstack([outputs[layer] for layer in layers])
+
+# Random weights of the fc6_ft and fc7_ft layers of the numpy backends
+def numpyWeights(rng, num_inputs):
+    fc6 = (rng.randn(num_inputs, NUM_CNN_FEATURES) / np.sqrt(num_inputs)).astype(np.float32)
+    fc7 = (rng.randn(NUM_CNN_FEATURES, NUM_CNN_FEATURES) / np.sqrt(NUM_CNN_FEATURES)).astype(np.float32)
+    return fc6, fc7
+
+################################################################
+# NumpyBackend
+#   CPU stand-in for the CNN, used to test the extraction pipeline
+#   without caffe. The regions are average pooled to an 8x8 grid
+#   (pool5), and the fc layers are fixed random projections (see
+#   numpyLayers). The features are deterministic, but meaningless
+#   for detection
+#
+class NumpyBackend:
+    GRID_SIZE = 8
+
+    def __init__(self, gpu_id=0, layers=[FEATURE_LAYER]):
+        cell = CNN_INPUT_SIZE / self.GRID_SIZE
+        self.crop = cell * self.GRID_SIZE
+        num_inputs = self.GRID_SIZE * self.GRID_SIZE * 3
+
+        self.weights = numpyWeights(np.random.RandomState(0), num_inputs)
+        self.layer_sizes = selectLayers(layers, {'pool5': num_inputs, 'fc6_ft': NUM_CNN_FEATURES, 'fc7_ft': NUM_CNN_FEATURES})
+        self.num_features = sum(num_features for _, num_features in self.layer_sizes)
+
+    def loadImage(self, image_path):
+        return readImageRGB(image_path)
+
+    # batch - n x CNN_INPUT_SIZE x CNN_INPUT_SIZE x 3 warped regions
+    # Returns the n x num_features features of the batch
+    def extract(self, batch):
+        n = batch.shape[0]
+        cell = self.crop / self.GRID_SIZE
+        pooled = batch[:, 0:self.crop, 0:self.crop, :].reshape(
+            (n, self.GRID_SIZE, cell, self.GRID_SIZE, cell, 3)).mean(axis=(2,4))
+        return numpyLayers(pooled.reshape((n, -1)), self.weights, self.layer_sizes)
+
+################################################################
+# Shared convolution backends
+#   Instead of a forward pass per warped region, the convolutions
+#   run once per image and scale, and the features of every region
+#   are pooled from their output (RoI pooling, as in SPP-net and
+#   Fast R-CNN) before the fully connected layers. prepareImage
+#   rescales the image to every scale of ROI_SCALES (on the CPU,
+#   ahead of the backend, see extractor.extractFeaturesShared),
+#   and extractRegions computes the features of the regions. Each
+#   region uses the scale at which its area is closest to
+#   CNN_INPUT_SIZE^2 (SPP-net).
+#
+
+# Returns the factor every scale of ROI_SCALES resizes an H x W image by
+def imageScales(H, W, scales=ROI_SCALES, max_size=ROI_MAX_SIZE):
+    factors = []
+    for scale in scales:
+        factor = float(scale) / min(H, W)
+        if factor * max(H, W) > max_size:
+            factor = float(max_size) / max(H, W)
+        factors.append(factor)
+    return factors
+
+# Returns the index of the scale of every region (0-indexed bboxes)
+def regionScales(regions, factors):
+    areas = (regions[:,2] - regions[:,0] + 1.0) * (regions[:,3] - regions[:,1] + 1.0)
+    scaled_areas = areas[:,np.newaxis] * (np.array(factors) ** 2)
+    return np.argmin(np.abs(scaled_areas - CNN_INPUT_SIZE * CNN_INPUT_SIZE), axis=1)
+
+# Resizes an image by every factor
+def imagePyramid(img, factors):
+    H, W = img.shape[0:2]
+    return [(factor, cv2.resize(img, (max(int(round(W*factor)), 1), max(int(round(H*factor)), 1)),
+        interpolation=cv2.INTER_LINEAR)) for factor in factors]
+
+################################################################
+# roiAveragePool(feature_map, rois, grid_size)
+#   RoI pooling of the regions from a feature map. Every region is
+#   split into grid_size x grid_size bins, with the bin boundaries
+#   of the ROIPooling layer of Fast R-CNN, and every bin is averaged
+#   (from an integral image, so all regions are pooled at once).
+#   Empty bins are 0
+#
+# Input: feature_map (H x W x C matrix)
+#        rois (n x 4 matrix of bboxes in feature map cells)
+#        grid_size (number of bins along each side)
+# Output: pooled (n x grid_size x grid_size x C matrix)
+#
+def roiAveragePool(feature_map, rois, grid_size):
+    H, W, C = feature_map.shape
+    integral = np.zeros((H+1, W+1, C))
+    integral[1:,1:,:] = feature_map.cumsum(axis=0).cumsum(axis=1)
+
+    def binEdges(start, end, size):
+        start = np.round(start)
+        bin_size = np.maximum(np.round(end) - start + 1, 1) / grid_size
+        edges = np.arange(grid_size + 1)
+        low = np.clip(np.floor(edges[:-1] * bin_size[:,np.newaxis]) + start[:,np.newaxis], 0, size)
+        high = np.clip(np.ceil(edges[1:] * bin_size[:,np.newaxis]) + start[:,np.newaxis], 0, size)
+        return low.astype(np.int64), high.astype(np.int64)
+
+    x_low, x_high = binEdges(rois[:,0], rois[:,2], W)
+    y_low, y_high = binEdges(rois[:,1], rois[:,3], H)
+    y_low, y_high = y_low[:,:,np.newaxis], y_high[:,:,np.newaxis]
+    x_low, x_high = x_low[:,np.newaxis,:], x_high[:,np.newaxis,:]
+
+    sums = integral[y_high, x_high] - integral[y_low, x_high] - integral[y_high, x_low] + integral[y_low, x_low]
+    counts = (y_high - y_low) * (x_high - x_low)
+    return sums / np.maximum(counts, 1)[:,:,:,np.newaxis]
+
+################################################################
+# CaffeRoIBackend
+#   Extracts the layers with shared convolutions. MODEL_ROI_DEPLOY
+#   is the network of MODEL_DEPLOY with pool5 replaced by a
+#   ROIPooling layer (of the same output size, so the weights of
+#   MODEL_SNAPSHOT apply) with "data" and "rois" inputs, which
+#   requires a caffe build with that layer (e.g. Fast R-CNN's)
+#
+class CaffeRoIBackend:
+    shared_conv = True
+
+    def __init__(self, gpu_id=0, layers=[FEATURE_LAYER]):
+        if not caffe_available:
+            raise ImportError('The caffe_roi backend requires pycaffe')
+
+        if GPU_MODE == True:
+            caffe.set_mode_gpu()
+            caffe.set_device(0)
+        else:
+            caffe.set_mode_cpu()
+
+        self.net = caffe.Net(MODEL_ROI_DEPLOY, MODEL_SNAPSHOT, caffe.TEST)
+        self.layer_sizes = selectLayers(layers, caffeLayers(self.net))
+        self.num_features = sum(num_features for _, num_features in self.layer_sizes)
+        # Mean BGR pixel of the mean image CaffeBackend subtracts
+        self.pixel_mean = loadImageMean().reshape((-1, 3)).mean(axis=0).astype(np.float32)
+
+    def loadImage(self, image_path):
+        return caffe.io.load_image(image_path)
+
+    # img - RGB image in [0,1], see loadImage
+    # Returns the mean subtracted BGR image (in [0,255]) at every scale,
+    # as 1 x 3 x H x W blobs
+    def prepareImage(self, img):
+        img = img[:,:,::-1] * np.float32(255.0) - self.pixel_mean
+        factors = imageScales(img.shape[0], img.shape[1])
+        return [(factor, scaled.transpose((2,0,1))[np.newaxis]) for factor, scaled in imagePyramid(img, factors)]
+
+    # regions - n x 4 matrix of 0-indexed bboxes
+    # Returns the n x num_features features of the regions
+    def extractRegions(self, pyramid, regions):
+        features = np.zeros((regions.shape[0], self.num_features), dtype=np.float32)
+        scale_ids = regionScales(regions, [factor for factor, _ in pyramid])
+        for i, (factor, blob) in enumerate(pyramid):
+            IDX = np.where(scale_ids == i)[0]
+            if len(IDX) == 0:
+                continue
+
+            # Every roi is (image index in the blob, x1, y1, x2, y2)
+            rois = np.zeros((len(IDX), 5), dtype=np.float32)
+            rois[:,1:5] = regions[IDX] * factor
+            self.net.blobs['data'].reshape(*blob.shape)
+            self.net.blobs['rois'].reshape(*rois.shape)
+            self.net.forward(data=blob, rois=rois)
+            features[IDX,:] = np.hstack([self.net.blobs[layer].data.reshape((len(IDX), -1)) for layer, _ in self.layer_sizes])
+        return features
+
+################################################################
+# NumpyRoIBackend
+#   CPU stand-in for CaffeRoIBackend. The "convolutions" average
+#   the image over STRIDE x STRIDE cells and apply a fixed random
+#   projection (with a ReLU) to NUM_CHANNELS channels. The regions
+#   are pooled to GRID_SIZE x GRID_SIZE (roiAveragePool, pool5) and
+#   projected to the fc layers like NumpyBackend. The features are
+#   deterministic, but meaningless for detection
+#
+class NumpyRoIBackend:
+    shared_conv = True
+    STRIDE = 16
+    NUM_CHANNELS = 16
+    GRID_SIZE = 6
+
+    def __init__(self, gpu_id=0, layers=[FEATURE_LAYER]):
+        rng = np.random.RandomState(0)
+        self.conv = (rng.randn(3, self.NUM_CHANNELS) / np.sqrt(3)).astype(np.float32)
+        num_inputs = self.GRID_SIZE * self.GRID_SIZE * self.NUM_CHANNELS
+        self.weights = numpyWeights(rng, num_inputs)
+        self.layer_sizes = selectLayers(layers, {'pool5': num_inputs, 'fc6_ft': NUM_CNN_FEATURES, 'fc7_ft': NUM_CNN_FEATURES})
+        self.num_features = sum(num_features for _, num_features in self.layer_sizes)
+
+    def loadImage(self, image_path):
+        return readImageRGB(image_path)
+
+    def prepareImage(self, img):
+        return imagePyramid(img, imageScales(img.shape[0], img.shape[1]))
+
+    # H/STRIDE x W/STRIDE x NUM_CHANNELS feature map of an image
+    def featureMap(self, img):
+        H = max(img.shape[0] / self.STRIDE, 1)
+        W = max(img.shape[1] / self.STRIDE, 1)
+        cells = cv2.resize(img, (W, H), interpolation=cv2.INTER_AREA)
+        return np.maximum(np.dot(cells.reshape((-1, 3)), self.conv), 0).reshape((H, W, self.NUM_CHANNELS))
+
+    def extractRegions(self, pyramid, regions):
+        features = np.zeros((regions.shape[0], self.num_features), dtype=np.float32)
+        scale_ids = regionScales(regions, [factor for factor, _ in pyramid])
+        for i, (factor, img) in enumerate(pyramid):
+            IDX = np.where(scale_ids == i)[0]
+            if len(IDX) == 0:
+                continue
+
+            pooled = roiAveragePool(self.featureMap(img), regions[IDX] * (factor / self.STRIDE), self.GRID_SIZE)
+            features[IDX,:] = numpyLayers(pooled.reshape((len(IDX), -1)).astype(np.float32), self.weights, self.layer_sizes)
+        return features
+
+# Maps the name of a CNN backend to its class
+#   caffe - the real network (requires pycaffe)
+#   caffe_roi - the real network with shared convolutions (requires
+#               pycaffe with the ROIPooling layer)
+#   numpy, numpy_roi - CPU stand-ins for testing
+CNN_BACKENDS = {
+    'caffe': CaffeBackend,
+    'caffe_roi': CaffeRoIBackend,
+    'numpy': NumpyBackend,
+    'numpy_roi': NumpyRoIBackend,
+}
+
+# Returns the names of the backends that can be used on this machine
+def availableBackends():
+    backends = ['numpy', 'numpy_roi']
+    if caffe_available:
+        if os.path.isfile(MODEL_ROI_DEPLOY):
+            backends[0:0] = ['caffe_roi']
+        backends[0:0] = ['caffe']
+    return backends
+
+# Why a backend cannot be used on this machine (None if it can)
+def unavailableReason(name):
+    if name in availableBackends():
+        return None
+    if not caffe_available:
+        return 'You do not have pycaffe installed'
+    return 'The %s backend needs the network %s, which does not exist'%(name, MODEL_ROI_DEPLOY)
+
+# Creates the requested CNN backend, extracting the given layers
+def createBackend(name, gpu_id=0, layers=[FEATURE_LAYER]):
+    if name not in CNN_BACKENDS:
+        raise ValueError('Unknown CNN backend \'%s\'. Choose one of: %s'%(
+            name, ', '.join(sorted(CNN_BACKENDS.keys()))))
+    return CNN_BACKENDS[name](gpu_id, layers)
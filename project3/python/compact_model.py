@@ -0,0 +1,235 @@
+import os
+
+import numpy as np
+
+from settings import *
+
+################################################################
+# Compact models
+#   The SVMs of all classes (with the mean and std of their scaler
+#   folded into the weights) and the bbox regressors are exported
+#   into one NumPy archive. CompactModel scores and regresses with
+#   it using NumPy only, so inference needs neither sklearn nor the
+#   pickled models.
+#
+#   The folded weights score all classes with one matrix product,
+#   but round differently from scaler.transform followed by
+#   decision_function (which standardizes float32 features in
+#   float32). The rounding error is bounded, and every class with a
+#   score within that bound of 0 is scored again exactly like
+#   sklearn, so the detections (score > 0) are the same as with the
+#   pickled models.
+#
+#   Archive contents (k classes, d features):
+#     class_ids - k vector
+#     coef, intercept, mean, scale - SVM and scaler of every class (k x d, k, k x d, k x d)
+#     W, b - folded weights (d x k, k)
+#     regression_type - 'none', 'normal' or 'multivariate'
+#     regression_W, regression_b - regressors of every class (k x d x 4, k x 4)
+#
+
+# Relative rounding error of the folded scores, with a wide margin
+# (sklearn rounds the standardized features to float32 twice)
+EXACT_MARGIN = 1e-6
+
+def compactModelPath(models_dir=MODELS_DIR):
+    return os.path.join(models_dir, 'detector_%s.npz'%FEATURE_LAYER)
+
+# Returns the coef, intercept, mean and scale arrays of a binary linear
+# model (e.g. LinearSVC) and its scaler (see util.normalizeAndAddBias)
+def linearModelArrays(model, scaler):
+    coef = np.array(model.coef_, dtype=np.float64).ravel()
+    intercept = float(np.ravel(model.intercept_)[0])
+    mean = np.zeros(coef.shape[0])
+    scale = np.ones(coef.shape[0])
+    if scaler != 'NO_NORMALIZE':
+        if scaler.mean_ is not None:
+            mean = np.array(scaler.mean_, dtype=np.float64)
+        if scaler.scale_ is not None:
+            scale = np.array(scaler.scale_, dtype=np.float64)
+    return coef, intercept, mean, scale
+
+# Folds the mean and scale into the weights: the scores of raw features
+# X are X.dot(w) + b
+def foldWeights(coef, intercept, mean, scale):
+    w = coef / scale
+    b = intercept - np.dot(mean, w)
+    return w, b
+
+# Returns the d x 4 weights and 4 biases of the bbox regressors of a
+# class (4 Ridge models for 'normal', 1 multivariate Ridge otherwise)
+def regressionArrays(models):
+    if len(models) == 1:
+        return np.array(models[0].coef_).T, np.array(models[0].intercept_)
+    W = np.vstack([np.ravel(model.coef_) for model in models]).T
+    b = np.array([float(model.intercept_) for model in models])
+    return W, b
+
+################################################################
+# compactModelContents(svm_models)
+#   Arrays of the archive of the SVMs (and regressors) of all classes
+#
+# Input: svm_models (dictionary class_id -> (model, scaler))
+#        regression_models (dictionary class_id -> list of Ridge models,
+#                           as trained by trainBboxRegression)
+# Output: contents (dictionary name -> array, see above)
+#
+def compactModelContents(svm_models, regression_models=None):
+    class_ids = sorted(svm_models.keys())
+    arrays = [linearModelArrays(*svm_models[c]) for c in class_ids]
+    contents = {
+        'class_ids': np.array(class_ids),
+        'coef': np.vstack([coef for coef, _, _, _ in arrays]),
+        'intercept': np.array([intercept for _, intercept, _, _ in arrays]),
+        'mean': np.vstack([mean for _, _, mean, _ in arrays]),
+        'scale': np.vstack([scale for _, _, _, scale in arrays]),
+        'regression_type': np.array('none'),
+    }
+    folded = [foldWeights(*a) for a in arrays]
+    contents['W'] = np.vstack([w for w, _ in folded]).T
+    contents['b'] = np.array([b for _, b in folded])
+
+    if regression_models is not None:
+        regressions = [regressionArrays(regression_models[c]) for c in class_ids]
+        contents['regression_type'] = np.array('normal' if len(regression_models[class_ids[0]]) > 1 else 'multivariate')
+        contents['regression_W'] = np.array([W for W, _ in regressions])
+        contents['regression_b'] = np.array([b for _, b in regressions])
+
+    return contents
+
+# Writes the archive of the models (see compactModelContents) to file_name
+def exportCompactModel(file_name, svm_models, regression_models=None):
+    with open(file_name + '.tmp', 'wb') as fp:
+        np.savez(fp, **compactModelContents(svm_models, regression_models))
+    os.rename(file_name + '.tmp', file_name)
+
+################################################################
+# CompactModel(contents)
+#   NumPy inference with an exported model
+#
+class CompactModel:
+    def __init__(self, contents):
+        self.class_ids = [int(c) for c in contents['class_ids']]
+        self.coef = contents['coef']
+        self.intercept = contents['intercept']
+        self.mean = contents['mean']
+        self.scale = contents['scale']
+        self.W = contents['W']
+        self.b = contents['b']
+
+        self.regression_type = str(contents['regression_type'])
+        if self.regression_type != 'none':
+            self.regression_W = contents['regression_W']
+            self.regression_b = contents['regression_b']
+
+        # Rounding error bound of the folded scores of features x:
+        # EXACT_MARGIN * ((|x| + |mean|) * |w| + error_offset)
+        self.w_norms = np.sqrt(np.sum(self.W * self.W, axis=0))
+        self.mean_norms = np.sqrt(np.sum(self.mean * self.mean, axis=1))
+        self.error_offsets = np.abs(self.intercept) + np.sum(np.abs(self.mean) * np.abs(self.W.T), axis=1)
+
+    # Index of a class in the archive
+    def classIndex(self, class_id):
+        return self.class_ids.index(class_id)
+
+    # Indices of the classes of a vector of class ids
+    def classIndices(self, class_ids):
+        return np.searchsorted(self.class_ids, class_ids)
+
+    ################################################################
+    # scores(features)
+    #   Decision scores of all classes (n x k matrix, column i is
+    #   class_ids[i]). Positive scores are detections
+    #
+    def scores(self, features):
+        scores = np.dot(features, self.W) + self.b
+        if features.shape[0] == 0:
+            return scores
+
+        x_norms = np.sqrt(np.einsum('ij,ij->i', features, features, dtype=np.float64))
+        margins = EXACT_MARGIN * (np.outer(x_norms, self.w_norms) + self.mean_norms * self.w_norms + self.error_offsets)
+        for i in np.where(np.any(np.abs(scores) <= margins, axis=0))[0]:
+            scores[:,i] = self.exactScores(features, i)
+        return scores
+
+    # Decision scores of class i, computed exactly like the scaler
+    # and LinearSVC of the class would
+    def exactScores(self, features, i):
+        X = np.array(features, dtype=features.dtype if features.dtype in [np.float32, np.float64] else np.float64)
+        X -= self.mean[i]
+        X /= self.scale[i]
+        return (np.dot(X, self.coef[i][:,np.newaxis]) + self.intercept[i]).ravel()
+
+    ################################################################
+    # regress(class_id, features, bboxes)
+    #   Same as train_bbox.predictBoundingBox with the regressors of
+    #   class_id
+    #
+    def regress(self, class_id, features, bboxes):
+        i = self.classIndex(class_id)
+        targets = np.dot(features, self.regression_W[i]) + self.regression_b[i]
+        return applyBboxTargets(targets, bboxes)
+
+    ################################################################
+    # regressAll(class_ids, features, bboxes)
+    #   Regresses the bboxes of several classes (and images) at
+    #   once: row j uses the regressors of class_ids[j]. The targets
+    #   of every class are one matrix product into a shared buffer
+    #   (a product with the regressors of all classes stacked would
+    #   cost k times more), and all bboxes are decoded in one pass
+    #
+    def regressAll(self, class_ids, features, bboxes):
+        IDX = self.classIndices(class_ids)
+        order = np.argsort(IDX, kind='mergesort')
+        classes, starts = np.unique(IDX[order], return_index=True)
+        ends = np.append(starts[1:], order.shape[0])
+
+        targets = np.empty((order.shape[0], 4))
+        for i, start, end in zip(classes, starts, ends):
+            rows = order[start:end]
+            if end - start == rows[-1] - rows[0] + 1:
+                # Contiguous rows (e.g. detections grouped by class)
+                rows = slice(rows[0], rows[-1] + 1)
+            targets[rows] = np.dot(features[rows], self.regression_W[i])
+        targets += self.regression_b[IDX]
+        return applyBboxTargets(targets, bboxes)
+
+# Scores with models in memory, like their exported archive would
+def compactModelFromModels(svm_models, regression_models=None):
+    return CompactModel(compactModelContents(svm_models, regression_models))
+
+# Reads an archive written by exportCompactModel
+def loadCompactModel(file_name):
+    with np.load(file_name) as contents:
+        return CompactModel(dict((key, contents[key]) for key in contents.files))
+
+# Converts the regression targets (center x, center y, log width, log
+# height) of bboxes into the regressed bboxes, keeping the score column
+def applyBboxTargets(targets, bboxes):
+    result = np.empty((bboxes.shape[0], 5))
+
+    # Proposal widths, heights and centers
+    Pw = bboxes[:,2] - bboxes[:,0] + 1
+    Ph = bboxes[:,3] - bboxes[:,1] + 1
+    Px = 0.5 * (bboxes[:,0] + bboxes[:,2])
+    Py = 0.5 * (bboxes[:,1] + bboxes[:,3])
+
+    # Solve for G using Equations 1,2,3,4 from paper. Only half the
+    # width and height is needed
+    Gx = targets[:,0] * Px
+    Gx += Px
+    Gy = targets[:,1] * Py
+    Gy += Py
+    Gw = np.exp(targets[:,2])
+    Gw *= Pw
+    Gw *= 0.5
+    Gh = np.exp(targets[:,3])
+    Gh *= Ph
+    Gh *= 0.5
+
+    np.subtract(Gx, Gw, out=result[:,0])
+    np.subtract(Gy, Gh, out=result[:,1])
+    np.add(Gx, Gw, out=result[:,2])
+    np.add(Gy, Gh, out=result[:,3])
+    result[:,4] = bboxes[:,4]
+    return result
@@ -0,0 +1,235 @@
+import os
+import json
+import shutil
+import collections
+
+import numpy as np
+import proposal_filter
+
+from scipy.io import loadmat
+from settings import *
+
+################################################################
+# Dataset manifest
+#   The GT bboxes and selective search regions of a phase, converted
+#   once from the Matlab files (<phase>_ims.mat and
+#   ssearch_<phase>.mat) into plain .npy files in ML_DIR/manifest_<phase>:
+#
+#     names.npy - image names
+#     labels.npy, gt_bboxes.npy - class and bbox of the GT bboxes of all images
+#     gt_offsets.npy - the GT bboxes of image i are rows gt_offsets[i]:gt_offsets[i+1]
+#     regions.npy - regions of all images (N x 4, int32)
+#     region_offsets.npy - the regions of image i are rows region_offsets[i]:region_offsets[i+1]
+#     meta.json - modification time and size of the Matlab files
+#     kept.npy, kept_offsets.npy, kept.json - proposals kept by the
+#       filter settings in kept.json (see proposal_filter.py), as
+#       indices into the regions of every image
+#
+#   The arrays are memory-mapped and sliced when an image is looked up,
+#   so reading a phase does not load the Matlab files nor build one
+#   array per image. The manifest is rebuilt when a Matlab file
+#   changes, and the kept proposals when the filter settings change.
+#
+
+MANIFEST_VERSION = 1
+MANIFEST_ARRAYS = ['names', 'labels', 'gt_bboxes', 'gt_offsets', 'regions', 'region_offsets']
+
+def manifestPath(phase, ml_dir=ML_DIR):
+    return os.path.join(ml_dir, 'manifest_%s'%phase)
+
+def sourceFiles(phase, ml_dir=ML_DIR):
+    return [os.path.join(ml_dir, phase + "_ims.mat"), os.path.join(ml_dir, "ssearch_" + phase + ".mat")]
+
+# Identifies the Matlab files a manifest was built from
+def sourceSignature(phase, ml_dir=ML_DIR):
+    signature = {'version': MANIFEST_VERSION, 'sources': []}
+    for file_name in sourceFiles(phase, ml_dir):
+        stat = os.stat(file_name)
+        signature['sources'].append([os.path.basename(file_name), stat.st_mtime, stat.st_size])
+    return signature
+
+################################################################
+# buildManifest(phase)
+#   Reads the Matlab files of a phase into the manifest arrays
+#
+# Output: arrays (dictionary name -> array, see above)
+#
+def buildManifest(phase, ml_dir=ML_DIR):
+    ims_file_name, ssearch_file_name = sourceFiles(phase, ml_dir)
+    raw_ims = loadmat(ims_file_name)["images"]
+    raw_ssearch = loadmat(ssearch_file_name)["ssearch_boxes"]
+
+    names, labels, gt_bboxes, regions = [], [], [], []
+    for i in xrange(raw_ims.shape[1]):
+        filename, image_labels, bboxes = raw_ims[0,i]
+        names.append(filename[0])
+        labels.append(np.ravel(image_labels))
+        gt_bboxes.append(bboxes.astype(np.int32).reshape((-1, 4)))
+        regions.append(raw_ssearch[0,i].astype(np.int32).reshape((-1, 4)))
+
+    return {
+        'names': np.array(names, dtype=np.unicode_),
+        'labels': np.concatenate(labels),
+        'gt_bboxes': np.vstack(gt_bboxes),
+        'gt_offsets': np.cumsum([0] + [l.shape[0] for l in labels]),
+        'regions': np.vstack(regions),
+        'region_offsets': np.cumsum([0] + [r.shape[0] for r in regions]),
+    }
+
+# Writes the manifest into a temporary directory renamed to path, so
+# that other processes never read a partial manifest
+def writeManifest(path, arrays, signature):
+    tmp_path = '%s.tmp.%d'%(path, os.getpid())
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name in MANIFEST_ARRAYS:
+        np.save(os.path.join(tmp_path, name + '.npy'), arrays[name])
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as fp:
+        json.dump(signature, fp)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process wrote it first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+# Memory-maps the arrays of the manifest in path, None if it is missing
+# or was built from other Matlab files
+def readManifest(path, signature):
+    try:
+        with open(os.path.join(path, 'meta.json')) as fp:
+            if json.load(fp) != signature:
+                return None
+        return dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r')) for name in MANIFEST_ARRAYS)
+    except (IOError, OSError, ValueError):
+        return None
+
+# Saves an array under path, renamed into place once complete
+def saveArray(path, name, array):
+    tmp_file_name = os.path.join(path, '%s.tmp.%d.npy'%(name, os.getpid()))
+    np.save(tmp_file_name, array)
+    os.rename(tmp_file_name, os.path.join(path, name + '.npy'))
+
+# Returns the indices of the proposals the filter settings keep in every
+# image, concatenated, and their offsets
+def computeKept(arrays, settings):
+    kept = []
+    offsets = arrays['region_offsets']
+    for i in xrange(offsets.shape[0] - 1):
+        kept.append(proposal_filter.filterProposals(np.asarray(arrays['regions'][offsets[i]:offsets[i+1]]), settings))
+    return np.concatenate(kept).astype(np.int32), np.cumsum([0] + [k.shape[0] for k in kept])
+
+# Memory-maps the kept proposals of the manifest in path, None if they
+# are missing or were filtered with other settings
+def readKept(path, settings):
+    try:
+        with open(os.path.join(path, 'kept.json')) as fp:
+            if json.load(fp) != settings:
+                return None
+        return np.load(os.path.join(path, 'kept.npy'), mmap_mode='r'), np.load(os.path.join(path, 'kept_offsets.npy'), mmap_mode='r')
+    except (IOError, OSError, ValueError):
+        return None
+
+# The settings are written last, so a reader never sees them with the
+# kept proposals of other settings
+def writeKept(path, kept, offsets, settings):
+    if os.path.isfile(os.path.join(path, 'kept.json')):
+        os.remove(os.path.join(path, 'kept.json'))
+    saveArray(path, 'kept', kept)
+    saveArray(path, 'kept_offsets', offsets)
+    tmp_file_name = os.path.join(path, 'kept.json.tmp.%d'%os.getpid())
+    with open(tmp_file_name, 'w') as fp:
+        json.dump(settings, fp)
+    os.rename(tmp_file_name, os.path.join(path, 'kept.json'))
+
+################################################################
+# ManifestView(names, entry)
+#   Read-only dictionary image_name -> entry(i) of the images of a
+#   manifest (i is the index of the image in the manifest)
+#
+class ManifestView(collections.Mapping):
+    def __init__(self, names, entry):
+        self.names = names
+        self.index = dict((image_name, i) for i, image_name in enumerate(names))
+        self.entry = entry
+
+    def __getitem__(self, image_name):
+        return self.entry(self.index[image_name])
+
+    def __contains__(self, image_name):
+        return image_name in self.index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return list(self.names)
+
+# GT of an image in the format of the Matlab files (1 x k labels and
+# k x 4 bboxes, both 0 x 0 when the image has no GT bbox)
+def gtEntry(arrays, i):
+    start, end = arrays['gt_offsets'][i], arrays['gt_offsets'][i+1]
+    if start == end:
+        return (np.zeros((0, 0), dtype=arrays['labels'].dtype), np.zeros((0, 0), dtype=np.int32))
+    return (np.asarray(arrays['labels'][start:end]).reshape((1, end - start)), np.asarray(arrays['gt_bboxes'][start:end]))
+
+def regionsEntry(arrays, i):
+    return np.asarray(arrays['regions'][arrays['region_offsets'][i]:arrays['region_offsets'][i+1]])
+
+# Kept proposals of an image, as indices into its regions
+def keptEntry(arrays, kept, i):
+    if kept is None:
+        return np.arange(arrays['region_offsets'][i+1] - arrays['region_offsets'][i])
+    kept, offsets = kept
+    return np.asarray(kept[offsets[i]:offsets[i+1]])
+
+################################################################
+# readDataset(phase)
+#   Returns the GT and regions of a phase (see util.readMatrixData),
+#   building the manifest first if it is missing or stale. If the
+#   manifest cannot be written (e.g. ML_DIR is read-only), the
+#   Matlab files are read every time. The regions are the proposals
+#   kept by the filter settings
+#
+# Output: data (dictionary with "gt", "ssearch" and "proposal_index"
+#         ManifestViews, the proposal index holds the rows of the
+#         ssearch file the regions of an image come from)
+#
+def readDataset(phase, ml_dir=ML_DIR, settings=None):
+    if settings is None:
+        settings = proposal_filter.filterSettings()
+    path = manifestPath(phase, ml_dir)
+    signature = sourceSignature(phase, ml_dir)
+    arrays = readManifest(path, signature)
+    if arrays is None:
+        arrays = buildManifest(phase, ml_dir)
+        try:
+            writeManifest(path, arrays, signature)
+        except (IOError, OSError) as e:
+            print '[WARNING] Could not write the dataset manifest %s: %s'%(path, e)
+
+    kept = None
+    if not proposal_filter.keepsAll(settings):
+        kept = readKept(path, settings)
+        if kept is None:
+            kept = computeKept(arrays, settings)
+            try:
+                writeKept(path, kept[0], kept[1], settings)
+            except (IOError, OSError) as e:
+                print '[WARNING] Could not write the kept proposals in %s: %s'%(path, e)
+
+    names = arrays['names'].tolist()
+    data = {}
+    data["gt"] = ManifestView(names, lambda i: gtEntry(arrays, i))
+    if kept is None:
+        data["ssearch"] = ManifestView(names, lambda i: regionsEntry(arrays, i))
+    else:
+        data["ssearch"] = ManifestView(names, lambda i: regionsEntry(arrays, i)[keptEntry(arrays, kept, i)])
+    data["proposal_index"] = ManifestView(names, lambda i: keptEntry(arrays, kept, i))
+    return data
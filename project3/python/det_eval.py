@@ -44,57 +44,47 @@ def det_eval(gt_bboxes, pred_bboxes):
     #   ap: average precision
     #   prec: The precision at each point on the PR curve
     #   rec: The recall at each point on the PR curve.
+    #
+    # Same results as starter_code/det_eval.m, but the predictions are
+    # grouped by image and matched to the GT bboxes of their image with
+    # one overlap matrix per image
     minoverlap = 0.5
     assert(len(gt_bboxes) == len(pred_bboxes))
-    num_images = len(gt_bboxes)
 
     num_gt_boxes = np.sum([x.shape[0] for x in gt_bboxes])
-    num_pred_boxes = np.sum([x.shape[0] for x in pred_bboxes])
     [all_pred_bboxes, image_ids] = sort_bboxes(pred_bboxes)
-
-    tp = np.zeros((num_pred_boxes, 1))
-    fp = np.zeros((num_pred_boxes, 1))
-
-    detected_pred_bboxes = [None]*num_images
-    detected = [None]*num_images
-
-    for pred_ind in xrange(num_pred_boxes):
-        # if mod(pred_ind, 4096) == 0:
-        #     fprintf(mstring('calculating detection box %d of %d\\n'), pred_ind, num_pred_boxes)
-        # end
-        num_gt_im_boxes = len(gt_bboxes[image_ids[pred_ind]])
-        if detected[image_ids[pred_ind][0]] is None:
-            detected[image_ids[pred_ind][0]] = np.zeros((num_gt_im_boxes, 1))
-        
-        bb = all_pred_bboxes[pred_ind, :]
-
-        overlaps = np.zeros((num_gt_im_boxes))
-        
-        for g in xrange(num_gt_im_boxes):
-            gt_bbox = gt_bboxes[image_ids[pred_ind]][g,:]
-            overlaps[g] = util.computeOverlap(gt_bbox, np.array([bb]))
-
-        if overlaps.size != 0:
-            jmax = np.argmax(overlaps, axis=0)
-            ovmax = overlaps[jmax]
-        else:
-            ovmax = float('-inf')
-
-        # assign detection as true positive/don't care/false positive
-        im_detected = detected[image_ids[pred_ind]]
-        if ovmax >= minoverlap:
-            if not im_detected[jmax]:
-                tp[pred_ind] = 1            #true positive
-                detected[image_ids[pred_ind]][jmax] = 1
-                if detected_pred_bboxes[image_ids[pred_ind]] is None:
-                    detected_pred_bboxes[image_ids[pred_ind]]=np.array([bb])
-                else:
-                    detected_pred_bboxes[image_ids[pred_ind]]=util.stack([detected_pred_bboxes[image_ids[pred_ind]], bb]); 
-            else:
-                fp[pred_ind] = 1            #false positive (multiple detections)
-        else:
-            fp[pred_ind] = 1        #false positive
-
+    num_pred_boxes = all_pred_bboxes.shape[0]
+
+    # GT bboxes of all images are numbered consecutively
+    gt_offsets = np.cumsum([0] + [x.shape[0] for x in gt_bboxes])
+
+    # Best overlap of every prediction, and the GT bbox it comes from
+    ovmax = -np.inf * np.ones(num_pred_boxes)
+    jmax = np.zeros(num_pred_boxes, dtype=int)
+
+    # Predictions of every image, still in decreasing score order
+    by_image = np.argsort(image_ids, kind='mergesort')
+    bounds = np.searchsorted(image_ids[by_image], np.arange(len(gt_bboxes) + 1))
+    for im_ind in xrange(len(gt_bboxes)):
+        pred_inds = by_image[bounds[im_ind]:bounds[im_ind+1]]
+        if pred_inds.size == 0 or gt_bboxes[im_ind].size == 0:
+            continue
+
+        # Overlaps are only computed for intersecting bboxes, and argmax
+        # keeps the first GT bbox on ties (like the strict ov>ovmax)
+        overlaps = util.computeOverlaps(gt_bboxes[im_ind], all_pred_bboxes[pred_inds])
+        best = np.argmax(overlaps, axis=0)
+        ovmax[pred_inds] = overlaps[best, np.arange(pred_inds.size)]
+        jmax[pred_inds] = gt_offsets[im_ind] + best
+
+    # assign detection as true positive/false positive. A GT bbox is
+    # detected by the first (highest scoring) prediction that overlaps
+    # it enough, all later ones are multiple detections
+    candidates = np.where(ovmax >= minoverlap)[0]
+    _, first = np.unique(jmax[candidates], return_index=True)
+    tp = np.zeros(num_pred_boxes)
+    tp[candidates[first]] = 1
+    fp = 1 - tp
 
     # compute precision/recall
     npos = num_gt_boxes
@@ -108,22 +98,16 @@ def det_eval(gt_bboxes, pred_bboxes):
     return ap, prec, rec
 
 def sort_bboxes(pred_bboxes):
-    num_pred_boxes = np.sum([x.shape[0] for x in pred_bboxes])
-
     bboxes = util.stack([b for b in pred_bboxes if b.size > 0])
     if bboxes is None:
-        return np.zeros((0, 5)), np.zeros((0, 1), dtype=int)
-    image_ids = np.zeros((bboxes.shape[0], 1), dtype=int)
+        return np.zeros((0, 5)), np.zeros(0, dtype=int)
 
     # Concatenate them
-    bbox_ind = 0
-    for im_ind in xrange(len(pred_bboxes)):
-        num_bbox_curr_image = pred_bboxes[im_ind].shape[0]
-        image_ids[bbox_ind:bbox_ind + num_bbox_curr_image, 0] = im_ind
-        bbox_ind = bbox_ind + num_bbox_curr_image
-
-    # Sort
-    IDX = np.argsort(-1*bboxes[:, -1])
+    image_ids = np.concatenate([im_ind * np.ones(b.shape[0], dtype=int)
+        for im_ind, b in enumerate(pred_bboxes) if b.size > 0])
+
+    # Sort. Stable, like MATLAB's sort(..., 'descend')
+    IDX = np.argsort(-1*bboxes[:, -1], kind='mergesort')
     bboxes = bboxes[IDX, :]
     image_ids = image_ids[IDX]
 
@@ -134,9 +118,9 @@ def VOCap(rec, prec):
     mrec = np.concatenate((np.array([0]), rec, np.array([1])))
     mpre = np.concatenate((np.array([0]), prec, np.array([0])))
 
-    for i in xrange(len(mpre)-2,-1,-1):
-        mpre[i] = max(mpre[i], mpre[i + 1])
-    
+    # Precision envelope. fmax ignores NaN like MATLAB's max
+    mpre = np.fmax.accumulate(mpre[::-1])[::-1]
+
     i = np.where(mrec[1:] != mrec[0:-1])[0] + 1;
     ap = np.sum(np.multiply((mrec[i]-mrec[i-1]), mpre[i]))
 
@@ -0,0 +1,223 @@
+import os.path
+import sys
+import time
+import threading
+import traceback
+import Queue
+
+import numpy as np
+import warping
+
+from settings import *
+
+################################################################
+# extractFeaturesPipelined(backend, jobs, img_mean, save_features)
+#   Extracts the region features of a list of images. A producer
+#   thread decodes and warps the images into CNN batches while
+#   the backend runs the forward pass of the previous batch. At
+#   most prefetch_depth warped batches wait for the backend.
+#
+#   Batches are packed across image boundaries, so only the very
+#   last batch can be partially full. The features of an image are
+#   saved as soon as all of its regions have been extracted.
+#
+# Input: backend (CNN backend, see cnn_backends.py)
+#        jobs (list or generator of (image_name, regions), regions is a
+#              matrix where each row is a 1-indexed bbox. A job can also
+#              be (image_name, regions, img) with the image already
+#              loaded by backend.loadImage)
+#        img_mean (CNN_INPUT_SIZE x CNN_INPUT_SIZE x 3 mean image)
+#        save_features (function called with (image_name, features))
+#        prefetch_depth (number of batches that can be prepared ahead)
+#        pool (optional thread pool used to warp the regions)
+# Output: stats (dictionary with the number of images and batches, the
+#         time spent in the backend, the time the producer spent loading
+#         and warping images, and the time the backend waited for the
+#         producer)
+#
+def extractFeaturesPipelined(backend, jobs, img_mean, save_features, prefetch_depth=PREFETCH_DEPTH, pool=None, debug=False):
+    # One buffer is being filled, prefetch_depth are waiting in the queue
+    # and one is used by the backend
+    free_buffers = Queue.Queue()
+    for i in xrange(prefetch_depth + 2):
+        free_buffers.put(np.zeros((CNN_BATCH_SIZE, CNN_INPUT_SIZE, CNN_INPUT_SIZE, 3), dtype=np.float32))
+    full_batches = Queue.Queue(maxsize=prefetch_depth)
+    producer_error = []
+
+    # Name and number of regions of every job, filled in by the producer
+    # before the first batch containing the job is queued
+    job_info = {}
+    producer_stats = {'warp_time': 0.0}
+
+    # Each batch is sent with its segments: (job id, index of the first
+    # region in the image, index of the first slot in the batch, count)
+    def produce():
+        try:
+            buf = free_buffers.get()
+            filled = 0
+            segments = []
+            for job_id, job in enumerate(jobs):
+                start = time.time()
+                image_name, regions = job[0:2]
+                job_info[job_id] = (image_name, regions.shape[0])
+                if len(job) > 2:
+                    img = job[2]
+                else:
+                    img = backend.loadImage(os.path.join(IMG_DIR, image_name))
+
+                # Subtract one because bboxs are indexed starting at 1 but numpy is at 0
+                regions = regions - 1
+                num_regions = regions.shape[0]
+                if num_regions == 0:
+                    segments.append((job_id, 0, filled, 0))
+
+                done = 0
+                while done < num_regions:
+                    count = min(CNN_BATCH_SIZE - filled, num_regions - done)
+                    warping.warpRegions(img, regions[done:done+count], img_mean,
+                        out=buf[filled:filled+count], pool=pool)
+                    segments.append((job_id, done, filled, count))
+                    filled += count
+                    done += count
+
+                    if filled == CNN_BATCH_SIZE:
+                        producer_stats['warp_time'] += time.time() - start
+                        full_batches.put((buf, filled, segments))
+                        buf = free_buffers.get()
+                        filled = 0
+                        segments = []
+                        start = time.time()
+                producer_stats['warp_time'] += time.time() - start
+
+            if len(segments) > 0:
+                full_batches.put((buf, filled, segments))
+        except Exception:
+            producer_error.append(traceback.format_exc())
+        full_batches.put(None)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+
+    stats = {'images': 0, 'batches': 0, 'backend_time': 0.0, 'wait_time': 0.0}
+    features = {}
+    remaining = {}
+    while True:
+        start = time.time()
+        item = full_batches.get()
+        stats['wait_time'] += time.time() - start
+        if item is None:
+            break
+
+        buf, filled, segments = item
+        start = time.time()
+        if filled > 0:
+            batch_features = backend.extract(buf[0:filled])
+        else:
+            # Only images without regions
+            batch_features = np.zeros((0, backend.num_features))
+        stats['backend_time'] += time.time() - start
+        stats['batches'] += 1
+        free_buffers.put(buf)
+
+        # Scatter the batch back to the images
+        for job_id, region_start, batch_start, count in segments:
+            if job_id not in features:
+                num_regions = job_info[job_id][1]
+                features[job_id] = np.zeros((num_regions, backend.num_features))
+                remaining[job_id] = num_regions
+            features[job_id][region_start:region_start+count,:] = batch_features[batch_start:batch_start+count,:]
+            remaining[job_id] -= count
+
+            if remaining[job_id] == 0:
+                save_features(job_info[job_id][0], features.pop(job_id))
+                del remaining[job_id]
+                del job_info[job_id]
+                stats['images'] += 1
+
+        if debug:
+            print "\tBatch %i: %f seconds" % (stats['batches'], time.time() - start)
+
+    producer.join()
+    if len(producer_error) > 0:
+        print >> sys.stderr, producer_error[0]
+        raise RuntimeError('Feature extraction producer failed')
+
+    stats.update(producer_stats)
+    return stats
+
+################################################################
+# extractFeaturesShared(backend, jobs, save_features)
+#   Extracts the region features of a list of images with a shared
+#   convolution backend (see cnn_backends.py). A producer thread
+#   loads the next images and prepares them for the backend (e.g.
+#   rescales them) while the backend extracts all regions of the
+#   previous image at once. At most prefetch_depth prepared images
+#   wait for the backend.
+#
+# Input: backend (shared convolution backend, backend.shared_conv is True)
+#        jobs, save_features, prefetch_depth (see extractFeaturesPipelined)
+# Output: stats (see extractFeaturesPipelined, batches are images)
+#
+def extractFeaturesShared(backend, jobs, save_features, prefetch_depth=PREFETCH_DEPTH, debug=False):
+    prepared_images = Queue.Queue(maxsize=prefetch_depth)
+    producer_error = []
+    producer_stats = {'warp_time': 0.0}
+
+    def produce():
+        try:
+            for job in jobs:
+                start = time.time()
+                image_name, regions = job[0:2]
+                if len(job) > 2:
+                    img = job[2]
+                else:
+                    img = backend.loadImage(os.path.join(IMG_DIR, image_name))
+
+                # Subtract one because bboxs are indexed starting at 1 but numpy is at 0
+                prepared = backend.prepareImage(img)
+                producer_stats['warp_time'] += time.time() - start
+                prepared_images.put((image_name, regions - 1, prepared))
+        except Exception:
+            producer_error.append(traceback.format_exc())
+        prepared_images.put(None)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+
+    stats = {'images': 0, 'batches': 0, 'backend_time': 0.0, 'wait_time': 0.0}
+    while True:
+        start = time.time()
+        item = prepared_images.get()
+        stats['wait_time'] += time.time() - start
+        if item is None:
+            break
+
+        image_name, regions, prepared = item
+        start = time.time()
+        features = backend.extractRegions(prepared, regions)
+        stats['backend_time'] += time.time() - start
+        stats['batches'] += 1
+
+        save_features(image_name, features)
+        stats['images'] += 1
+
+        if debug:
+            print "\tImage %i: %f seconds" % (stats['images'], time.time() - start)
+
+    producer.join()
+    if len(producer_error) > 0:
+        print >> sys.stderr, producer_error[0]
+        raise RuntimeError('Feature extraction producer failed')
+
+    stats.update(producer_stats)
+    return stats
+
+# Extracts the region features of a list of images with any backend:
+# extractFeaturesShared for shared convolution backends, and
+# extractFeaturesPipelined (warped regions) otherwise
+def extractFeatures(backend, jobs, img_mean, save_features, prefetch_depth=PREFETCH_DEPTH, pool=None, debug=False):
+    if getattr(backend, 'shared_conv', False):
+        return extractFeaturesShared(backend, jobs, save_features, prefetch_depth, debug)
+    return extractFeaturesPipelined(backend, jobs, img_mean, save_features, prefetch_depth, pool, debug)
@@ -0,0 +1,252 @@
+import os
+import sys
+import glob
+import json
+
+import numpy as np
+
+from settings import *
+
+################################################################
+# Feature store
+#   Packs the region features of all images into a few large
+#   binary shards that are memory-mapped for reading. Rows are
+#   stored in FEATURE_STORE_DTYPE (float32 or float16) in the same
+#   order as before: the GT bboxes first, then the selective
+#   search regions.
+#
+#   Every extraction process writes its own shards and its own
+#   index (one line per image: name, shard, first row, number of
+#   rows, number of GT rows), so concurrent writers never touch the
+#   same file. Both are append-only. A row range only becomes
+#   visible once its index line is written, so a writer that dies
+#   half way through an image leaves nothing behind.
+#
+#   A store can hold several layers of the same regions (see
+#   cnn_backends.py), extracted in one forward pass. Every layer
+#   has its own shards, with the same rows as the shards named in
+#   the index, and the store meta file records the name and number
+#   of features of every layer. The first layer uses the shards
+#   named in the index, so stores of a single layer are unchanged.
+#   Readers open one layer by name (FEATURE_LAYER by default).
+#
+#   Directories that only contain the old per-image .npy files are
+#   still readable (see --mode pack to convert them).
+#
+
+STORE_META_FILE = "store_meta.json"
+
+# Shard of a layer, for a shard named in the index
+def layerShardFile(shard_file, layers, layer):
+    if layer == layers[0][0]:
+        return shard_file
+    return '%s.%s.bin'%(shard_file[:-len('.bin')], layer)
+
+################################################################
+# FeatureStoreWriter(path, writer_name)
+#   Appends the features of images to the shards of one writer
+#
+# Input: path (directory of the store)
+#        writer_name (unique name of the writing process, e.g. gpu0)
+#        dtype (type the features are stored in)
+#        shard_rows (a new shard is started after this many rows)
+#        layers (list of (layer, num_features) of the features, see
+#                backend.layer_sizes in cnn_backends.py)
+#
+class FeatureStoreWriter:
+    def __init__(self, path, writer_name, dtype=FEATURE_STORE_DTYPE, shard_rows=FEATURE_SHARD_ROWS, layers=[(FEATURE_LAYER, NUM_CNN_FEATURES)]):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.writer_name = writer_name
+        self.shard_rows = shard_rows
+        self.dtype, self.layers = createStoreMeta(path, dtype, layers)
+        self.num_features = sum(num_features for _, num_features in self.layers)
+
+        # Continue after the last image in the index. Anything written
+        # after it (a crash before the index line) is dropped
+        self.shard_id, self.shard_end = 0, 0
+        index_file_name = os.path.join(path, 'index_%s.txt'%writer_name)
+        for image_name, shard_file, start, count, num_gt in readIndexFile(index_file_name):
+            self.shard_id = int(shard_file[len(writer_name)+1:-len('.bin')])
+            self.shard_end = start + count
+
+        self.shards = []
+        for layer, num_features in self.layers:
+            shard = open(self.shardPath(layer), 'ab' if self.shard_end > 0 else 'wb')
+            shard.truncate(self.shard_end * np.dtype(self.dtype).itemsize * num_features)
+            shard.seek(0, os.SEEK_END)
+            self.shards.append(shard)
+
+        # Also drop an index line cut off by a crash
+        self.index = open(index_file_name, 'a+')
+        self.index.seek(0)
+        contents = self.index.read()
+        self.index.truncate(contents.rfind('\n') + 1)
+        self.index.seek(0, os.SEEK_END)
+
+    def shardFile(self):
+        return '%s_%04d.bin'%(self.writer_name, self.shard_id)
+
+    def shardPath(self, layer):
+        return os.path.join(self.path, layerShardFile(self.shardFile(), self.layers, layer))
+
+    # features - n x num_features matrix (the layers side by side), the
+    # first num_gt rows are the GT bboxes
+    def append(self, image_name, features, num_gt):
+        if features.shape[1] != self.num_features:
+            raise ValueError('Features of \'%s\' have %d columns, not %d'%(image_name, features.shape[1], self.num_features))
+
+        num_rows = features.shape[0]
+        if self.shard_end > 0 and self.shard_end + num_rows > self.shard_rows:
+            for shard in self.shards:
+                shard.close()
+            self.shard_id += 1
+            self.shard_end = 0
+            self.shards = [open(self.shardPath(layer), 'wb') for layer, _ in self.layers]
+
+        # Every layer is written before the index line
+        start = 0
+        for shard, (layer, num_features) in zip(self.shards, self.layers):
+            shard.write(np.ascontiguousarray(features[:,start:start+num_features], dtype=self.dtype).tostring())
+            shard.flush()
+            start += num_features
+        print >> self.index, '%s\t%s\t%d\t%d\t%d'%(image_name, self.shardFile(), self.shard_end, num_rows, num_gt)
+        self.index.flush()
+        self.shard_end += num_rows
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.index.close()
+
+################################################################
+# FeatureStore(path, layer)
+#   Read access to one layer of a feature store (the first layer of
+#   the store when layer is None). get() returns a read-only view
+#   into the memory-mapped shard, so nothing is copied until the
+#   rows are used. float16 stores are converted to float32 on read,
+#   as sklearn would otherwise compute in float16
+#
+class FeatureStore:
+    def __init__(self, path=FEATURES_DIR, layer=FEATURE_LAYER):
+        self.path = path
+        self.dtype, self.layers = readStoreMeta(path)
+        if layer is None:
+            layer = self.layers[0][0]
+        if layer not in dict(self.layers):
+            raise ValueError('Feature store \'%s\' has no layer \'%s\', it holds %s'%(path, layer, layersString(self.layers)))
+        self.layer = layer
+        self.num_features = dict(self.layers)[layer]
+        self.shards = {}
+
+        # When an image was written more than once (a reassigned
+        # extraction), any copy will do
+        self.index = {}
+        for index_file_name in sorted(glob.glob(os.path.join(path, 'index_*.txt'))):
+            for image_name, shard_file, start, count, num_gt in readIndexFile(index_file_name):
+                self.index[image_name] = (shard_file, start, count, num_gt)
+
+    def __contains__(self, image_name):
+        return image_name in self.index or os.path.isfile(self.npyPath(image_name))
+
+    def npyPath(self, image_name):
+        return os.path.join(self.path, image_name + '.npy')
+
+    # Names of the images in the store (without the old .npy files)
+    def imageNames(self):
+        return self.index.keys()
+
+    # Number of GT rows at the start of the features of an image
+    def numGT(self, image_name):
+        return self.index[image_name][3]
+
+    def openShard(self, shard_file, num_rows):
+        # Reopen the shard if a writer appended to it since it was mapped
+        if shard_file not in self.shards or self.shards[shard_file].shape[0] < num_rows:
+            file_name = os.path.join(self.path, layerShardFile(shard_file, self.layers, self.layer))
+            total_rows = os.path.getsize(file_name) / (np.dtype(self.dtype).itemsize * self.num_features)
+            self.shards[shard_file] = np.memmap(file_name, dtype=self.dtype, mode='r',
+                shape=(total_rows, self.num_features))
+        return self.shards[shard_file]
+
+    # Returns the n x num_features features of an image (GT rows first)
+    def get(self, image_name):
+        if image_name not in self.index:
+            return np.load(self.npyPath(image_name))
+
+        shard_file, start, count, num_gt = self.index[image_name]
+        if count == 0:
+            return np.zeros((0, self.num_features), dtype=np.float32)
+        features = self.openShard(shard_file, start + count)[start:start+count]
+        if features.dtype != np.float32:
+            features = features.astype(np.float32)
+        return features
+
+# Stores opened by openFeatureStore, so the shards are only mapped once
+feature_stores = {}
+
+################################################################
+# openFeatureStore(path, layer)
+#   Returns the (cached) feature store of a layer in path
+#
+def openFeatureStore(path=FEATURES_DIR, layer=FEATURE_LAYER):
+    key = (os.path.abspath(path), layer)
+    if key not in feature_stores:
+        feature_stores[key] = FeatureStore(key[0], layer)
+    return feature_stores[key]
+
+def layersString(layers):
+    return ', '.join('%s (%d features)'%(layer, num_features) for layer, num_features in layers)
+
+# Reads the type and the layers (list of (layer, num_features)) of the
+# store in path. The defaults are returned when the store does not exist
+# yet. Stores written before layers were recorded hold FEATURE_LAYER
+def readStoreMeta(path):
+    meta_file_name = os.path.join(path, STORE_META_FILE)
+    if not os.path.isfile(meta_file_name):
+        return FEATURE_STORE_DTYPE, [(FEATURE_LAYER, NUM_CNN_FEATURES)]
+    with open(meta_file_name) as fp:
+        meta = json.load(fp)
+    if 'layers' not in meta:
+        return str(meta['dtype']), [(FEATURE_LAYER, int(meta['num_features']))]
+    return str(meta['dtype']), [(str(layer), int(num_features)) for layer, num_features in meta['layers']]
+
+# Creates the meta file of a new store, or checks that an existing
+# store uses dtype and holds the same layers
+def createStoreMeta(path, dtype, layers):
+    layers = [(layer, int(num_features)) for layer, num_features in layers]
+    meta_file_name = os.path.join(path, STORE_META_FILE)
+    if os.path.isfile(meta_file_name):
+        store_dtype, store_layers = readStoreMeta(path)
+        if np.dtype(store_dtype) != np.dtype(dtype) or store_layers != layers:
+            raise ValueError('Feature store \'%s\' holds %s %s, not %s %s'%(
+                path, store_dtype, layersString(store_layers), np.dtype(dtype).name, layersString(layers)))
+        return store_dtype, store_layers
+
+    # num_features is the number of features of the first layer, whose
+    # shards are the ones of a single layer store
+    with open(meta_file_name, 'w') as fp:
+        json.dump({'dtype': np.dtype(dtype).name, 'num_features': layers[0][1], 'layers': layers}, fp)
+    return np.dtype(dtype).name, layers
+
+# Stops when the features of an image do not have one row per GT bbox and
+# region (e.g. they were extracted with other proposal filter settings)
+def checkImageFeatures(image_name, features, num_gt, num_regions):
+    if features.shape[0] != num_gt + num_regions:
+        print 'ERROR: The features of \'%s\' have %d rows, not %d GT bboxes + %d regions. Extract them again after changing the proposal filter'%(
+            image_name, features.shape[0], num_gt, num_regions)
+        sys.exit(1)
+
+# Yields (image_name, shard_file, start, count, num_gt) for every line
+# of an index file
+def readIndexFile(index_file_name):
+    if not os.path.isfile(index_file_name):
+        return
+    with open(index_file_name) as fp:
+        for line in fp:
+            # Skip a line cut off by a crash
+            if not line.endswith('\n'):
+                continue
+            fields = line[:-1].split('\t')
+            yield fields[0], fields[1], int(fields[2]), int(fields[3]), int(fields[4])
@@ -1,13 +1,316 @@
 import os
+import json
+import math
+import time
+import random
+import argparse
+import multiprocessing
 import util
-import sys
 
+from sklearn import preprocessing
 from train_rcnn import *
 from test_rcnn import *
 
+################################################################
+# Hyperparameter search of the SVM detector
+#   The grid (C, B, W, N) is searched in three rungs of successive
+#   halving, and only the best 1/eta cells of a rung go on to the
+#   next one:
+#     rung 0 - all cells train the CAR SVM
+#     rung 1 - the survivors train the CAT and PERSON SVMs
+#     rung 2 - the survivors are tested and ranked by mAP
+#   Cells are ranked by their mean balanced validation accuracy
+#   ((positive + negative accuracy) / 2) until they have a mAP.
+#
+#   The expensive parts are shared between cells:
+#   - The training and validation sets of every class are built
+#     once, with a fixed validation split, and memory-mapped from
+#     parent_dir/cache by every worker. The scaler of every class
+#     is fitted on them once as well
+#   - Hard negatives only depend on the class and on N (memory
+#     size). They are mined once per (class, N) with the default
+#     hyperparameters of trainClassifierForClass and cached, so a
+#     cell only trains its final SVM
+#
+#   Cells and mining tasks run on a process pool that hands out
+#   one task at a time. Every cell writes its results to
+#   <cell>/hyperparams_result.json as soon as a class is trained,
+#   and an interrupted search continues where it stopped.
+#
+#   python hyperparam_tuning.py --num_procs 8 (search)
+#   python hyperparam_tuning.py --process (tuning_results.csv/.json)
+#
+
+SEARCH_CACHE_DIR = "cache"
+TRAINING_SETS_FILE = "training_sets.json"
+RESULT_FILE = "hyperparams_result.json"
+
+TRAINING_SET_PARTS = ['pos', 'neg', 'pos_val', 'neg_val']
+
+# Hyperparameters the shared hard negatives are mined with
+MINING_C = 0.01
+MINING_B = 50
+MINING_W = {1:10}
+
+# Data of the search, inherited by the worker processes
+search_data = {}
+
+def getArgs():
+    parser = argparse.ArgumentParser(description='Hyperparameter search of the SVM detector')
+    parser.add_argument("--process", action='store_true', help="Only collect the results of the cells into tuning_results.csv and tuning_results.json")
+    parser.add_argument("--num_procs", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--eta", type=int, default=3, help="Keep the best 1/eta cells after every rung (1 searches the full grid)")
+    parser.add_argument("--num_val", type=int, default=100, help="Number of training images used for validation")
+    parser.add_argument("--parent_dir", default='../models/hyperparams/', help="Directory of the results and cache")
+    return parser.parse_args()
+
+def weightName(w):
+    if w != 'auto':
+        return w[1]
+    return w
+
+# Directory name of a cell, e.g. svm_000-01000_50_0010_30000
+def cellName(hyperparam):
+    c, b, w, n = hyperparam
+    if w != 'auto':
+        w_str = '%04d'%w[1]
+    else:
+        w_str = w
+    c_str = '%0.5f'%c
+    tmp = c_str.split('.')
+    c_str = ('000' + tmp[0])[-3:] + '-' + tmp[1]
+    return 'svm_%s_%02d_%s_%05d'%(c_str,b,w_str,n)
+
+def readJSON(file_name, default=None):
+    if not os.path.isfile(file_name):
+        return default
+    with open(file_name) as fp:
+        return json.load(fp)
+
+def writeJSON(file_name, contents):
+    with open(file_name + '.tmp', 'w') as fp:
+        json.dump(contents, fp, indent=1, sort_keys=True)
+    os.rename(file_name + '.tmp', file_name)
+
+################################################################
+# buildTrainingSets(data, cache_dir)
+#   Writes the positive and negative features of the training and
+#   validation images of every class to cache_dir (one raw float32
+#   file per class and part), image by image so the sets never have
+#   to fit in memory, and fits the scaler of every class on its
+#   training set. Nothing is done when they already exist for the
+#   same split and FEATURE_LAYER
+#
+# Input: data (training data, see util.readMatrixData)
+#        cache_dir (directory of the cached sets)
+#        num_val (number of validation images)
+#        seed (seed of the validation split)
+# Output: meta (validation images, number of features and rows of every set)
+#
+def buildTrainingSets(data, cache_dir, num_val=100, seed=0, debug=False):
+    file_name = os.path.join(cache_dir, TRAINING_SETS_FILE)
+    meta = readJSON(file_name)
+    if meta is not None and meta['seed'] == seed and len(meta['val_images']) == num_val and meta.get('layer') == FEATURE_LAYER and \
+            all(os.path.isfile(scalerPath(cache_dir, class_id)) for class_id in xrange(1, NUM_CLASSES+1)):
+        return meta
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    image_names = sorted(data["gt"].keys())
+    val_set_images = sorted(random.Random(seed).sample(image_names, num_val))
+    train_set_images = sorted(set(image_names) - set(val_set_images))
+
+    store = feature_store.openFeatureStore()
+    overlaps = overlap_index.getOverlapIndex(data)
+    meta = {'seed': seed, 'val_images': val_set_images, 'layer': FEATURE_LAYER, 'num_features': store.num_features, 'rows': {}}
+    for class_id in xrange(1, NUM_CLASSES+1):
+        start_time = time.time()
+        rows = dict((part, 0) for part in TRAINING_SET_PARTS)
+        scaler = preprocessing.StandardScaler()
+        files = dict((part, open(trainingSetPath(cache_dir, class_id, part), 'wb')) for part in TRAINING_SET_PARTS)
+        for suffix, images in [('', train_set_images), ('_val', val_set_images)]:
+            for image_name in images:
+                X_pos, X_neg = getImageSamples(image_name, data, class_id, store, overlaps)
+                for part, X in [('pos' + suffix, X_pos), ('neg' + suffix, X_neg)]:
+                    files[part].write(np.ascontiguousarray(X, dtype=np.float32).tostring())
+                    rows[part] += X.shape[0]
+                    if suffix == '' and X.shape[0] > 0:
+                        scaler.partial_fit(X)
+        for part in TRAINING_SET_PARTS:
+            files[part].close()
+        with open(scalerPath(cache_dir, class_id), 'wb') as fp:
+            cp.dump(scaler, fp)
+        meta['rows'][str(class_id)] = rows
+        if debug: print '[INFO] Training sets of class %d: %s (%0.1fs)'%(class_id, rows, time.time() - start_time)
+
+    writeJSON(file_name, meta)
+    return meta
+
+def trainingSetPath(cache_dir, class_id, part):
+    return os.path.join(cache_dir, 'class_%d_%s.bin'%(class_id, part))
+
+# Memory-maps one of the sets written by buildTrainingSets
+def openTrainingSet(cache_dir, meta, class_id, part):
+    num_rows = meta['rows'][str(class_id)][part]
+    if num_rows == 0:
+        return np.zeros((0, meta['num_features']), dtype=np.float32)
+    return np.memmap(trainingSetPath(cache_dir, class_id, part), dtype=np.float32, mode='r',
+        shape=(num_rows, meta['num_features']))
+
+def scalerPath(cache_dir, class_id):
+    return os.path.join(cache_dir, 'scaler_%d.pkl'%class_id)
+
+def readScaler(cache_dir, class_id):
+    with open(scalerPath(cache_dir, class_id), 'rb') as fp:
+        return cp.load(fp)
+
+def hardNegativesPath(cache_dir, class_id, memory_size):
+    return os.path.join(cache_dir, 'hard_negs_%d_%05d.npy'%(class_id, memory_size))
+
+# Pool task: mines and caches the hard negatives of a class for memory_size
+def mineTask(task):
+    cache_dir, meta, class_id, memory_size = task
+    file_name = hardNegativesPath(cache_dir, class_id, memory_size)
+    if os.path.isfile(file_name):
+        return task[2:]
+
+    # The same negatives whichever process mines them
+    np.random.seed(class_id * 100003 + memory_size)
+    X_pos = openTrainingSet(cache_dir, meta, class_id, 'pos')
+    X_neg = openTrainingSet(cache_dir, meta, class_id, 'neg')
+    hard_negs = mineHardNegatives(X_pos, lambda: iterBlocks(X_neg), readScaler(cache_dir, class_id),
+        memory_size=memory_size, C=MINING_C, B=MINING_B, W=MINING_W, output_dir=cache_dir)
+
+    with open(file_name + '.tmp', 'wb') as fp:
+        np.save(fp, hard_negs)
+    os.rename(file_name + '.tmp', file_name)
+    return task[2:]
+
+################################################################
+# cellTask(task)
+#   Pool task: trains the SVMs of class_ids for one cell (and tests
+#   the cell when run_test is set). Work already recorded in the
+#   result file of the cell is skipped
+#
+# Input: task (tuple of parent_dir, cache_dir, meta, hyperparam, class_ids, run_test)
+# Output: cell name, result (contents of the result file)
+#
+def cellTask(task):
+    parent_dir, cache_dir, meta, hyperparam, class_ids, run_test = task
+    c, b, w, n = hyperparam
+    output_path = os.path.join(parent_dir, cellName(hyperparam))
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+
+    result_file_name = os.path.join(output_path, RESULT_FILE)
+    result = readJSON(result_file_name, {'C': c, 'B': b, 'W': weightName(w), 'N': n, 'classes': {}})
+
+    for class_id in class_ids:
+        if classes[class_id-1] in result['classes']:
+            continue
+
+        X_pos = openTrainingSet(cache_dir, meta, class_id, 'pos')
+        hard_negs = np.load(hardNegativesPath(cache_dir, class_id, n), mmap_mode='r')
+        model, scaler, train_acc = trainSVM(X_pos, hard_negs, C=c, B=b, W=w, scaler=readScaler(cache_dir, class_id),
+            output_dir=output_path, evaluate=True, debug=True)
+        val_acc = getValidationAccuracy(model, scaler,
+            openTrainingSet(cache_dir, meta, class_id, 'pos_val'),
+            openTrainingSet(cache_dir, meta, class_id, 'neg_val'),
+            evaluate=True, output_dir=output_path)
+
+        model_file_name = os.path.join(output_path, 'svm_%d_%s.mdl'%(class_id, FEATURE_LAYER))
+        with open(model_file_name, 'w') as fp:
+            cp.dump((model, scaler), fp)
+
+        result['classes'][classes[class_id-1]] = {'train_accuracy': list(train_acc), 'val_accuracy': list(val_acc)}
+        writeJSON(result_file_name, result)
+
+    if run_test and 'mAP' not in result:
+        if "test" not in search_data:
+            search_data["test"] = util.readMatrixData("test")
+        evaluation, mAP = test(search_data, models_dir=output_path)
+        result['ap'] = dict((c, e[0]) for c, e in evaluation)
+        result['mAP'] = mAP
+        writeJSON(result_file_name, result)
+
+    return cellName(hyperparam), result
+
+# Ranks a cell: mAP once it is tested, before that the mean balanced
+# validation accuracy of the classes it has trained
+def cellScore(result):
+    if 'mAP' in result:
+        return (1, result['mAP'])
+    val_accs = [r['val_accuracy'] for r in result['classes'].values()]
+    if len(val_accs) == 0:
+        return (0, 0.0)
+    return (0, np.mean([(pos_acc + neg_acc) / 2 for pos_acc, neg_acc, _ in val_accs]))
+
+# Runs function on every task, handing out one task at a time
+def runTasks(function, tasks, num_procs):
+    if num_procs <= 1 or len(tasks) <= 1:
+        return [function(task) for task in tasks]
+    pool = multiprocessing.Pool(min(num_procs, len(tasks)))
+    try:
+        return list(pool.imap_unordered(function, tasks, chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
+
+################################################################
+# search(hyperparams, parent_dir, num_procs)
+#   Successive halving search of the grid (see the top of the file)
+#
+# Input: hyperparams (list of (C, B, W, N) cells)
+#        parent_dir (directory of the results and cache)
+#        num_procs (number of worker processes)
+#        eta (only the best 1/eta cells of a rung go on)
+# Output: results (dictionary cell name -> result of the cell)
+#
+def search(hyperparams, parent_dir, num_procs, eta=3, num_val=100, debug=True):
+    search_data["train"] = util.readMatrixData("train")
+    search_data["test"] = util.readMatrixData("test")
+
+    cache_dir = os.path.join(parent_dir, SEARCH_CACHE_DIR)
+    meta = buildTrainingSets(search_data["train"], cache_dir, num_val=num_val, debug=debug)
+
+    rungs = [([1], False), ([2, 3], False), ([], True)]
+    candidates = list(hyperparams)
+    results = {}
+    for rung, (class_ids, run_test) in enumerate(rungs):
+        if rung > 0:
+            candidates = sorted(candidates, key=lambda h: cellScore(results[cellName(h)]), reverse=True)
+            candidates = candidates[0:int(math.ceil(1.0 * len(candidates) / eta))]
+        start_time = time.time()
+
+        memory_sizes = sorted(set(n for _, _, _, n in candidates))
+        runTasks(mineTask, [(cache_dir, meta, class_id, n) for class_id in class_ids for n in memory_sizes], num_procs)
+
+        tasks = [(parent_dir, cache_dir, meta, hyperparam, class_ids, run_test) for hyperparam in candidates]
+        results.update(runTasks(cellTask, tasks, num_procs))
+
+        if debug: print '[INFO] Rung %d: %d cells (%0.1fs)'%(rung, len(candidates), time.time() - start_time)
+
+    process_results(hyperparams, parent_dir)
+    return results
+
+################################################################
+# process_results(hyperparams, parent_dir)
+#   Collects the result files of all cells into tuning_results.csv
+#   (one row per cell, empty fields for the parts a cell did not
+#   reach) and tuning_results.json (sorted from best to worst)
+#
 def process_results(hyperparams, parent_dir):
     print 'Processing results...'
 
+    results = []
+    for hyperparam in hyperparams:
+        result = readJSON(os.path.join(parent_dir, cellName(hyperparam), RESULT_FILE))
+        if result is not None:
+            results.append(result)
+    results.sort(key=cellScore, reverse=True)
+    writeJSON(os.path.join(parent_dir, 'tuning_results.json'), results)
+
     with open(os.path.join(parent_dir,'tuning_results.csv'), 'w') as wp:
         print >> wp, 'Cost, Bias, Positive Weight, Negative memory, \
         CAR Train Pos accuracy, CAR Train Neg accuracy, CAR Train total accuracy, \
@@ -18,137 +321,23 @@ def process_results(hyperparams, parent_dir):
         PERSON Validation Pos accuracy, PERSON Validation Neg accuracy, PERSON Validation total accuracy, \
         CAR AP, CAT_AP, PERSON_AP, mAP'
 
-    for i,hyperparam in enumerate(hyperparams):
-        c, b, w, n = hyperparam
-        if w != 'auto':
-            w_str = '%04d'%w[1]
-        else:
-            w_str = w
-        c_str = '%0.5f'%c
-        tmp = c_str.split('.')
-        c_str = ('000' + tmp[0])[-3:] + '-' + tmp[1]
-        folder_name = 'svm_%s_%02d_%s_%05d'%(c_str,b,w_str,n)
-        output_path = os.path.join(parent_dir, folder_name)
-
-        with open(os.path.join(output_path, 'hyperparams_result.txt'), 'r') as fp:
-            c_f = float(fp.next().strip().split(':')[-1])
-            b_f = int(fp.next().strip().split(':')[-1])
-
-            t_w = fp.next().strip().split(':')
-            if len(t_w) == 2:
-                w_f = 'auto'
+        for result in results:
+            fields = ['%f'%result['C'], '%d'%result['B'], str(result['W']), '%d'%result['N']]
+            for c in classes:
+                if c in result['classes']:
+                    accs = result['classes'][c]['train_accuracy'] + result['classes'][c]['val_accuracy']
+                    fields += ['%f'%x for x in accs]
+                else:
+                    fields += ['']*6
+            if 'mAP' in result:
+                fields += ['%f'%result['ap'][c] for c in classes] + ['%f'%result['mAP']]
             else:
-                w_f = str(int(t_w[-1][:-1]))
-            n_f = int(fp.next().strip().split(':')[-1])
-
-            # print c,c_f,' ',b,b_f,' ',w,w_f,' ',n,n_f,' '
-            fp.next() # Read ---------------
-            fp.next() # Read Class: CAR
-            car_train_pos, car_train_neg, car_train_tot = tuple([float(x) for x in fp.next().strip().split(':')[1].split(',')])
-            car_val_pos, car_val_neg, car_val_tot = tuple([float(x) for x in fp.next().strip().split(':')[1].split(',')])
-
-            fp.next() # Read \n
-            fp.next() # Read \n
-            fp.next() # Read Class: CAT
-            cat_train_pos, cat_train_neg, cat_train_tot = tuple([float(x) for x in fp.next().strip().split(':')[1].split(',')])
-            cat_val_pos, cat_val_neg, cat_val_tot = tuple([float(x) for x in fp.next().strip().split(':')[1].split(',')])
-
-            fp.next() # Read \n
-            fp.next() # Read \n
-            fp.next() # Read Class: PERSON
-            person_train_pos, person_train_neg, person_train_tot = tuple([float(x) for x in fp.next().strip().split(':')[1].split(',')])
-            person_val_pos, person_val_neg, person_val_tot = tuple([float(x) for x in fp.next().strip().split(':')[1].split(',')])
-
-
-            fp.next() # Read \n
-            fp.next() # Read \n
-            fp.next() # Read Class: Average Precision:
-            car_ap = float(fp.next().strip().split(':')[-1])
-            cat_ap = float(fp.next().strip().split(':')[-1])
-            person_ap = float(fp.next().strip().split(':')[-1])
-            mAP = float(fp.next().strip().split(':')[-1])
-
-            with open(os.path.join(parent_dir,'tuning_results.csv'), 'a') as wp:
-                print >> wp, '%f,%d,%s,%d,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f,%f'%(
-                    c_f, b_f, w_f, n_f,
-                    car_train_pos, car_train_neg, car_train_tot, car_val_pos, car_val_neg, car_val_tot,
-                    cat_train_pos, cat_train_neg, cat_train_tot, cat_val_pos, cat_val_neg, cat_val_tot,
-                    person_train_pos, person_train_neg, person_train_tot, person_val_pos, person_val_neg, person_val_tot,
-                    car_ap, cat_ap, person_ap, mAP)
-
- 
-def tune_params(hyperparams, num_procs, process_id, parent_dir):
-    data = {}
-    data["train"] = util.readMatrixData("train")
-    data["test"] = util.readMatrixData("test")
-
-    for i,hyperparam in enumerate(hyperparams):
-        if (i%num_procs) != process_id:
-            continue
-        c, b, w, n = hyperparam
-        if w != 'auto':
-            w_str = '%04d'%w[1]
-        else:
-            w_str = w
-        c_str = '%0.5f'%c
-        tmp = c_str.split('.')
-        c_str = ('000' + tmp[0])[-3:] + '-' + tmp[1]
-
-        folder_name = 'svm_%s_%02d_%s_%05d'%(c_str,b,w_str,n)
-        output_path = os.path.join(parent_dir, folder_name)
-
-        # For each object class
-        models = []
-        threads = []
-
-        # Make directory creating thread safe
-        # Sometimes many threads don't fine MODELS_DIR
-        # but only one can create it
-        try:
-            if not os.path.isdir(output_path):
-                os.makedirs(output_path)
-        except:
-            pass
-
-        with open(os.path.join(output_path, 'hyperparams_result.txt'), 'w') as fp:
-            print >> fp, "C:", c
-            print >> fp, "Bias:", b
-            print >> fp, "Positive Class weight:", w
-            print >> fp, "Negative examples memory:", n
-            print >> fp, "-------------------------------------"
-
-        classes = ['CAR', 'CAT', 'PERSON']
-        for class_id in [1,2,3]:
-            # Train a SVM for this class
-            model, scaler, train_acc, val_acc = trainClassifierForClass(data, class_id, memory_size=n, C=c, B=b, W=w, evaluate=True, output_dir=output_path)
-            model = (model, scaler)
-            model_file_name = os.path.join(output_path, 'svm_%d_%s.mdl'%(class_id, FEATURE_LAYER))
-            with open(model_file_name, 'w') as fp:
-                cp.dump(model, fp)
-
-            with open(os.path.join(output_path, 'hyperparams_result.txt'), 'a') as fp:
-                print >> fp, "Class:", classes[class_id-1]
-                print >> fp, "Training Accuracy (Pos, Neg, Total): %0.4f, %0.4f, %0.4f"%train_acc 
-                print >> fp, "Validation Accuracy (Pos, Neg, Total): %0.4f, %0.4f, %0.4f"%val_acc
-                print >> fp, "\n"
-
-        evaluation, mAP = test(data, models_dir=output_path)
-
-        with open(os.path.join(output_path, 'hyperparams_result.txt'), 'a') as fp:
-            print >> fp, "Average Precision:"
-            for c,e in evaluation:
-                ap, _, _ = e
-                print >> fp, '%s: %0.4f'%(c, ap)
-            print >> fp, '%s: %0.4f'%('mAP', mAP)       
+                fields += ['']*4
+            print >> wp, ','.join(fields)
 
 def main():
-    if len(sys.argv) != 3 and len(sys.argv) != 2:
-        print 'Usage: python hyperparam_tuning.py --process'
-        print '\t\t\t or'
-        print 'Usage: python hyperparam_tuning.py <num-procs> <process-id>'
-        sys.exit(1)
+    args = getArgs()
 
-    parent_dir = '../models/hyperparams/'
     C = [0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0, 100.0]
     B = [1, 5, 10, 50]
     W = [{1:1}, {1:2}, {1:5}, {1:6}, {1:10}, {1:50}, 'auto']
@@ -161,12 +350,10 @@ def main():
                 for n in N:
                     hyperparams.append((c,b,w,n))
 
-    if len(sys.argv) == 3:
-        num_procs = int(sys.argv[1])
-        process_id = int(sys.argv[2])
-        tune_params(hyperparams, num_procs, process_id, parent_dir)
+    if args.process:
+        process_results(hyperparams, args.parent_dir)
     else:
-        process_results(hyperparams, parent_dir)
+        search(hyperparams, args.parent_dir, args.num_procs, eta=args.eta, num_val=args.num_val)
 
 if __name__ == '__main__':
     main()
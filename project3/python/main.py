@@ -7,37 +7,57 @@ from settings import *
 
 import cPickle as cp
 import numpy as np
-
+import warping
+import extractor
+import scheduler
+import cnn_backends
+import compact_model
+import feature_store
+import overlap_index
+import proposal_filter
+import stream_detector
+
+from multiprocessing.pool import ThreadPool
 from train_rcnn import *
 from test_rcnn import *
 from train_bbox import *
 
-try:
-    import caffe
-    extraction_enabled = True
-except ImportError:
-    print '[WARNING] Caffe not found, extract mode will not function'
-    extraction_enabled = False
+if not cnn_backends.caffe_available:
+    print '[WARNING] Caffe not found, extract mode will only work with --backend numpy or numpy_roi'
 
 original_img_mean = None
 
 def main():
+    global original_img_mean
     parser = argparse.ArgumentParser(description='R-CNN object Classification.')
-    parser.add_argument("--mode", choices=['extract', 'train', 'trainsgd', 'test', 'trainbbox', 'testbbox'], help="extract, train, trainsgd, test, or trainbbox", required=True)
+    parser.add_argument("--mode", choices=['extract', 'pack', 'train', 'trainsgd', 'test', 'trainbbox', 'testbbox', 'export', 'detect'], help="extract, pack, train, trainsgd, test, trainbbox, export, or detect", required=True)
 
     # Extract mode
     parser.add_argument("--num_gpus", help="For feature extraction, total number of GPUs you will use")
     parser.add_argument("--gpu_id", help="For feature extraction, GPU ID [0,num_gpus) for which part to run")
+    parser.add_argument("--num_workers", type=int, help="For feature extraction, number of worker processes sharing a dynamic task queue (worker i uses GPU i). Replaces --num_gpus/--gpu_id, and skips the images already in the feature store")
+    parser.add_argument("--backend", default=CNN_BACKEND, choices=sorted(cnn_backends.CNN_BACKENDS.keys()), help="For feature extraction, CNN used to compute the features (the _roi backends share the convolutions of all regions of an image, numpy and numpy_roi are CPU stand-ins for testing)")
+    parser.add_argument("--prefetch", type=int, default=PREFETCH_DEPTH, help="For feature extraction, number of warped batches prepared ahead of the CNN")
+    parser.add_argument("--layers", nargs='+', default=FEATURE_LAYERS, help="For feature extraction, layers extracted in the same forward pass (each stored in its own shards). Training and testing use FEATURE_LAYER")
 
     # Test mode
     parser.add_argument("--bbox_regression", default='none', choices=['none', 'normal', 'multivariate'], help="none, normal, multivariate")
+    parser.add_argument("--compact", action='store_true', help="For testing, use the models exported by --mode export instead of the pickled models")
+
+    # Detect mode (also uses --backend, --prefetch, --bbox_regression and --compact)
+    parser.add_argument("--images", help="For detection, directory of the images to detect, or - to read image paths from stdin")
+    parser.add_argument("--proposals", help="For detection, .npz file of the region proposals of every image name (1-indexed bboxes). Regions are generated when not given")
+    parser.add_argument("--output", help="For detection, file the detections are written to (one JSON line per image)")
+
+    # Trainbbox mode
+    parser.add_argument("--bbox_alphas", type=float, nargs='+', default=[RIDGE_ALPHA], help="For bbox regressor training, regularizations to sweep (the best one on held out images is used)")
     args = parser.parse_args()
 
     if args.mode == "extract":
         print 'EXTRACT MODE'
         print '------------'
-        if not extraction_enabled:
-            print '[ERROR] You do not have pycaffe installed. Aborting...'
+        if args.backend not in cnn_backends.availableBackends():
+            print '[ERROR] %s. Aborting...'%cnn_backends.unavailableReason(args.backend)
             sys.exit(1)
 
         if args.num_gpus is None:
@@ -49,12 +69,79 @@ def main():
             args.gpu_id = 0
         
         print '[INFO] Features will be extracted into %s'%FEATURES_DIR
-        print '[INFO] CNN params will be loaded from %s'%MODEL_DEPLOY
-        print '[INFO] Trained CNN will be loaded from %s'%MODEL_SNAPSHOT
+        print '[INFO] CNN backend: %s'%args.backend
+        print '[INFO] Layers: %s'%', '.join(args.layers)
+        if not proposal_filter.keepsAll(proposal_filter.filterSettings()):
+            print '[INFO] Proposals are filtered before extraction: %s'%proposal_filter.filterSettings()
+        if args.backend == 'caffe':
+            print '[INFO] CNN params will be loaded from %s'%MODEL_DEPLOY
+            print '[INFO] Trained CNN will be loaded from %s'%MODEL_SNAPSHOT
+        if args.backend == 'caffe_roi':
+            print '[INFO] CNN params (with RoI pooling) will be loaded from %s'%MODEL_ROI_DEPLOY
+            print '[INFO] Trained CNN will be loaded from %s'%MODEL_SNAPSHOT
+        if getattr(cnn_backends.CNN_BACKENDS[args.backend], 'shared_conv', False):
+            print '[INFO] Shared convolutions at scales %s (maximum size %d)'%(ROI_SCALES, ROI_MAX_SIZE)
 
         num_gpus = int(args.num_gpus)
         gpu_id = int(args.gpu_id)
 
+    # Writes the SVMs (and bbox regressors, if trained) of all classes into
+    # one archive for NumPy inference (see compact_model.py)
+    if args.mode == "export":
+        print 'EXPORT MODE'
+        print '-----------'
+        svm_models = dict()
+        for class_id in [1,2,3]:
+            model_file_name = os.path.join(MODELS_DIR, 'svm_%d_%s.mdl'%(class_id, FEATURE_LAYER))
+            with open(model_file_name) as fp:
+                svm_models[class_id] = cp.load(fp)
+
+        regression_models = None
+        model_file_name = os.path.join(MODELS_DIR, 'bbox_ridge_reg.mdl')
+        if os.path.isfile(model_file_name):
+            with open(model_file_name) as fp:
+                regression_models = cp.load(fp)
+            print '[INFO] Including the bbox regressors of %s'%(model_file_name)
+
+        compact_model.exportCompactModel(compact_model.compactModelPath(), svm_models, regression_models)
+        print '[INFO] Models exported to %s'%(compact_model.compactModelPath())
+        return
+
+    # Detects new images from their pixels, without extracted features
+    # (see stream_detector.py)
+    if args.mode == "detect":
+        print 'DETECT MODE'
+        print '-----------'
+        if args.images is None:
+            print '[ERROR] --images is required in detect mode'
+            sys.exit(1)
+        if args.backend not in cnn_backends.availableBackends():
+            print '[ERROR] %s. Aborting...'%cnn_backends.unavailableReason(args.backend)
+            sys.exit(1)
+
+        detector = loadDetector([1,2,3], args.bbox_regression, compact=args.compact)
+        if detector is None:
+            sys.exit(1)
+        proposals = None
+        if args.proposals is not None:
+            proposals = stream_detector.readProposals(args.proposals)
+            print '[INFO] Proposals of %d images loaded from %s'%(len(proposals), args.proposals)
+        print '[INFO] CNN backend: %s'%args.backend
+
+        original_img_mean = cnn_backends.loadImageMean().astype(np.uint8)
+        backend = cnn_backends.createBackend(args.backend)
+        pool = ThreadPool(WARP_THREADS) if WARP_THREADS > 1 else None
+        output = open(args.output, 'w') if args.output is not None else None
+
+        stats = stream_detector.detectStream(backend, detector, stream_detector.iterImagePaths(args.images),
+            original_img_mean, proposals, bbox_regression=(args.bbox_regression != 'none'),
+            output=output, prefetch_depth=args.prefetch, pool=pool)
+        if output is not None:
+            output.close()
+            print '[INFO] Detections written to %s'%args.output
+        stream_detector.printDetectStats(stats)
+        return
+
     # Read the Matlab data files
     # data["train"]["gt"]["2008_007640.jpg"] = tuple( class_labels, gt_bboxes )
     # data["train"]["gt"]["2008_007640.jpg"] = tuple( [[2]] , [[ 90,  85, 500, 366]] )
@@ -63,6 +150,27 @@ def main():
     data["train"] = util.readMatrixData("train")
     data["test"] = util.readMatrixData("test")
 
+    # One-time preprocessing: overlaps of the training regions with the GT bboxes
+    if args.mode in ["train", "trainsgd", "trainbbox"]:
+        overlap_index.getOverlapIndex(data["train"], debug=True)
+
+    # Moves the features of the old per-image .npy files into the feature store
+    if args.mode == "pack":
+        print 'PACK MODE'
+        print '---------'
+        print '[INFO] Features in %s will be packed into %s shards'%(FEATURES_DIR, FEATURE_STORE_DTYPE)
+        store = feature_store.FeatureStore(FEATURES_DIR)
+        writer = feature_store.FeatureStoreWriter(FEATURES_DIR, 'packed')
+        num_packed = 0
+        for EXTRACT_MODE in ["train", "test"]:
+            for image_name, regions, num_gt in getExtractionTasks(data[EXTRACT_MODE]):
+                if image_name in store.index or not os.path.isfile(store.npyPath(image_name)):
+                    continue
+                writer.append(image_name, np.load(store.npyPath(image_name)), num_gt)
+                num_packed += 1
+        writer.close()
+        print '[INFO] Packed %d images. The .npy files can now be deleted'%num_packed
+
     if args.mode == "trainbbox":
         print 'BOUNDING BOX REGRESSOR TRAINING'
         print '-------------------------------'
@@ -73,9 +181,8 @@ def main():
 
         # Models is a dict of size 3 (one for each class)
         # each class/entry contains a list of 4 classifiers, one for each bbox parameter
-        models = dict()
-        for class_id in [1,2,3]:
-            models[class_id] = trainBboxRegressionForClass(data, class_id, bbox_regression=args.bbox_regression)
+        # All classes are trained in one pass over the features
+        models = trainBboxRegression(data["train"], [1,2,3], bbox_regression=args.bbox_regression, alphas=args.bbox_alphas)
 
         model_file_name = os.path.join(MODELS_DIR, 'bbox_ridge_reg.mdl')
         with open(model_file_name, 'w') as fp:
@@ -89,12 +196,12 @@ def main():
         num_images = len(data["train"]["gt"].keys())
         # Loop through all images and get features and bbox
         HARD_CODE_CLASS = 2
+        store = feature_store.openFeatureStore()
         for i, image_name in enumerate(data["train"]["gt"].keys()):
-            features_file_name = os.path.join(FEATURES_DIR, image_name + '.npy')
-            if not os.path.isfile(features_file_name):
-                print 'ERROR: Missing features file \'%s\''%(features_file_name) 
+            if image_name not in store:
+                print 'ERROR: Missing features for \'%s\' in %s'%(image_name, FEATURES_DIR)
             
-            features = np.load(features_file_name)
+            features = store.get(image_name)
             if len(data["train"]["gt"][image_name][0]) == 0:
                 num_gt = 0
             else:
@@ -177,7 +284,9 @@ def main():
         print "[INFO] Trained SVM's will be loaded from %s"%(MODELS_DIR)
         print '[INFO] Features will be loaded from %s'%(FEATURES_DIR)
         print '[INFO] Type of bounding box regression: %s'%(args.bbox_regression)
-        test(data, bbox_regression=args.bbox_regression)
+        if args.compact:
+            print '[INFO] Models will be loaded from %s'%(compact_model.compactModelPath())
+        test(data, bbox_regression=args.bbox_regression, compact=args.compact)
 
     # Equivalent to the starter code: extract_region_feats.m
     if args.mode == "extract":
@@ -185,35 +294,61 @@ def main():
         if not os.path.isdir(FEATURES_DIR):
             os.makedirs(FEATURES_DIR)
         
-        # Set up Caffe
-        net = initCaffeNetwork(gpu_id)
+        if args.num_workers is not None:
+            tasks = getExtractionTasks(data["train"]) + getExtractionTasks(data["test"])
+
+            print "Processing %i images with %i workers" % (len(tasks), args.num_workers)
+            start = time.time()
+            scheduler.runExtraction(tasks, args.num_workers, args.backend, args.layers, prefetch_depth=args.prefetch)
+            print "\tTotal Time: %f seconds" % (time.time() - start)
+            return
+
+        # Set up the CNN
+        original_img_mean = cnn_backends.loadImageMean().astype(np.uint8)
+        backend = cnn_backends.createBackend(args.backend, gpu_id, args.layers)
+
+        # Threads used to warp the regions of each batch
+        pool = ThreadPool(WARP_THREADS) if WARP_THREADS > 1 else None
+
+        # Every GPU writes its own shards of the feature store (and every
+        # layer its own shards)
+        writer = feature_store.FeatureStoreWriter(FEATURES_DIR, 'gpu%d'%gpu_id, layers=backend.layer_sizes)
+        num_gt = {}
+
+        def saveFeatures(image_name, features):
+            writer.append(image_name, features, num_gt[image_name])
 
         for EXTRACT_MODE in ["train", "test"]:
             # Create the workload for each GPU
-            ls = data[EXTRACT_MODE]["gt"].keys()
-            assignments = list(chunks(ls, num_gpus))
+            assignments = list(chunks(getExtractionTasks(data[EXTRACT_MODE]), num_gpus))
             payload = assignments[gpu_id]
 
-            print "Processing %i images on GPU ID %i. Total GPUs: %i" % (len(payload), gpu_id, num_gpus)
-            for i, image_name in enumerate(payload):
-                start = time.time()
-                # Do NOT use opencv to read the file. Caffe needs images in BGR format
-                # CAFFE LOADS R-G-B, thats why channel_swap needed
-                img = caffe.io.load_image(os.path.join(IMG_DIR, image_name))
-
-                # Also need to extract features from GT bboxes
-                # Sometimes an image has zero GT bboxes
-                if data[EXTRACT_MODE]["gt"][image_name][1].shape[0] > 0:
-                    regions = np.vstack((data[EXTRACT_MODE]["gt"][image_name][1], data[EXTRACT_MODE]["ssearch"][image_name]))
-                else:
-                    regions = data[EXTRACT_MODE]["ssearch"][image_name]
-
-                print "Processing Image %i: %s\tRegions: %i" % (i, image_name, regions.shape[0])
-
-                features = extractRegionFeatsFromImage(net, img, regions)
-                print "\tTotal Time: %f seconds" % (time.time() - start)
+            jobs = []
+            for image_name, regions, num_gt[image_name] in payload:
+                jobs.append((image_name, regions))
 
-                np.save(os.path.join(FEATURES_DIR, image_name + '.npy'), features)
+            print "Processing %i images on GPU ID %i. Total GPUs: %i" % (len(payload), gpu_id, num_gpus)
+            start = time.time()
+            stats = extractor.extractFeatures(backend, jobs, original_img_mean,
+                saveFeatures, prefetch_depth=args.prefetch, pool=pool)
+            print "\tTotal Time: %f seconds (CNN: %f seconds, CNN waiting for input: %f seconds)" % (
+                time.time() - start, stats['backend_time'], stats['wait_time'])
+        writer.close()
+
+# Returns the (image_name, regions, num_gt) extraction task of every image.
+# The regions are the num_gt GT bboxes followed by the selective search regions
+def getExtractionTasks(data):
+    tasks = []
+    for image_name in data["gt"].keys():
+        # Also need to extract features from GT bboxes
+        # Sometimes an image has zero GT bboxes
+        num_gt = data["gt"][image_name][1].shape[0]
+        if num_gt > 0:
+            regions = np.vstack((data["gt"][image_name][1], data["ssearch"][image_name]))
+        else:
+            regions = data["ssearch"][image_name]
+        tasks.append((image_name, regions, num_gt))
+    return tasks
 
 # Takes a list and splits it into roughly equal parts
 def chunks(items, num_gpus):
@@ -221,106 +356,45 @@ def chunks(items, num_gpus):
     for i in xrange(0, len(items), n):
         yield items[i:i+n]
 
-################################################################
-# initCaffeNetwork()
-#   Initializes Caffe and loads the appropriate model files
-# 
-# Input: None
-# Output: net (caffe network used to predict images)
-#
-def initCaffeNetwork(gpu_id):
-    # Extract the image mean and compute the cropped mean
-    global original_img_mean
-    original_img_mean = util.loadmat(os.path.join(ML_DIR, "ilsvrc_2012_mean.mat"))["image_mean"]
-    offset = np.floor((original_img_mean.shape[0] - CNN_INPUT_SIZE)/2) + 1
-    original_img_mean = original_img_mean[offset:offset+CNN_INPUT_SIZE, offset:offset+CNN_INPUT_SIZE, :]
-    # Must be in the form (3,227,227)
-    # K,H,W (https://github.com/BVLC/caffe/blob/master/python/caffe/io.py Line 136)
-    img_mean = np.swapaxes(original_img_mean,0,2)
-
-    # Used for warping
-    original_img_mean = original_img_mean.astype(np.uint8)
-
-    # Set up the Caffe network
-    # sys.path.insert(0, os.path.join(CAFFE_ROOT, 'python'))
-
-    if GPU_MODE == True:
-        caffe.set_mode_gpu()
-        #local_id = gpu_id % 4
-        caffe.set_device(0)
-    else:
-        caffe.set_mode_cpu()
-
-    # Channel Swap is because images are RGB, we want BGR
-    # Raw Scale is because sklearn (which caffe uses) loads pixels into [0,1] range
-    # Mean image is so that its subtracted from every image
-    net = caffe.Classifier(MODEL_DEPLOY, MODEL_SNAPSHOT, channel_swap=[2,1,0], mean=img_mean, raw_scale=255)
-    return net
-
-
 ################################################################
 # extractRegionFeatsFromImage(img, regions)
-#   Extract region features from an image (this runs caffe)
+#   Extract region features from a single image, without pipelining
+#   (see extractor.extractFeaturesPipelined)
 # 
-# Input: net (the caffe network)
+# Input: backend (the CNN backend, see cnn_backends.py)
 #        img (as a numpy array)
 #        regions (matrix where each row is a bbox)
+#        pool (optional thread pool used to warp the regions)
 # Output: features (matrix of NUM_REGIONS x NUM_FEATURES)
 #
-def extractRegionFeatsFromImage(net, img, regions):
+def extractRegionFeatsFromImage(backend, img, regions, pool=None):
     # Subtract one because bboxs are indexed starting at 1 but numpy is at 0
-    regions -= 1
+    regions = regions - 1
 
     num_regions = regions.shape[0]
     num_batches = int(np.ceil(1.0 * num_regions / CNN_BATCH_SIZE))
-    features = np.zeros((num_regions, NUM_CNN_FEATURES))
-
-    H, W, _ = img.shape
-
-    # Pad the image with -1's
-    # -1's indicate that this pixel will be replaced with the image mean
-    padded_img = -1 * np.ones((H + 2*INDICATOR_PAD_SIZE, W + 2*INDICATOR_PAD_SIZE, 3))
+    features = np.zeros((num_regions, backend.num_features))
 
-    # Add the region to the center of this new "padded" image
-    start = INDICATOR_PAD_SIZE
-    padded_img[start:start+H, start:start+W, :] = img
+    # The batch is allocated once and reused for every batch of the image
+    img_batch = np.zeros((CNN_BATCH_SIZE, CNN_INPUT_SIZE, CNN_INPUT_SIZE, 3), dtype=np.float32)
 
     # Extract batches from original image
     for b in xrange(num_batches):
         # Create the CNN input batch
-        img_batch = []
-        num_in_this_batch = 0
+        start_idx = b*CNN_BATCH_SIZE
+        num_in_this_batch = min(CNN_BATCH_SIZE, num_regions - start_idx)
         start = time.time()
-        for j in xrange(CNN_BATCH_SIZE):
-            # Index into the regions array
-            idx = b * CNN_BATCH_SIZE + j
-
-            # If we've exhausted all examples
-            if idx < num_regions:
-                num_in_this_batch += 1
-            else:
-                break
-            
-            warped = warpRegion(padded_img, regions[idx])
-            #padded_region_img = getPaddedRegion(img, regions[idx])
-            #resized = cv2.resize(padded_region_img, (CNN_INPUT_SIZE, CNN_INPUT_SIZE))
-
-            # Swap W,H to H,W -> pycaffe expects this 
-            warped = np.swapaxes(warped,0,1) 
-            img_batch.append(warped)
+        warping.warpRegions(img, regions[start_idx:start_idx+num_in_this_batch],
+            original_img_mean, out=img_batch[0:num_in_this_batch], pool=pool)
 
         #print "\tBatch %i creation: %f seconds" % (b, time.time() - start)
         # Run the actual CNN to extract features
         start = time.time()
 
-        # Turn off oversampling so that all our images are processed
-        scores = net.predict(img_batch, oversample=False)
+        # The last batch will not be completely full so we only pass the filled part
+        features[start_idx:start_idx+num_in_this_batch,:] = backend.extract(img_batch[0:num_in_this_batch])
         print "\tBatch %i / %i: %f seconds" % (b+1, num_batches, time.time() - start)
 
-        # The last batch will not be completely full so we don't want to save all of them
-        start_idx = b*CNN_BATCH_SIZE
-        features[start_idx:start_idx+num_in_this_batch,:] = net.blobs[FEATURE_LAYER].data[0:num_in_this_batch,:]
-
     return features
 
 ################################################################
@@ -334,6 +408,9 @@ def extractRegionFeatsFromImage(net, img, regions):
 #        bbox (vector of length 4)
 # Output: resized_img (227x227 warped image)
 #
+# NOTE: Extraction uses the batched warping.warpRegions, this version
+# is kept for debugging a single region
+#
 def warpRegion(padded_img, bbox, debug=False):
     global original_img_mean
     
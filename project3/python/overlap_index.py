@@ -0,0 +1,137 @@
+import os
+import threading
+
+import numpy as np
+import util
+
+from settings import *
+
+################################################################
+# Overlap index
+#   For every selective search region of every image, the highest
+#   overlap with a GT bbox of each class and the GT bbox it comes
+#   from. It only depends on the GT and regions, so it is computed
+#   once and cached in FEATURES_DIR next to the feature store.
+#   Training then selects its positives, negatives and regression
+#   targets with a lookup instead of recomputing the overlaps for
+#   every class, every call and every hyperparameter combination.
+#
+#   data["overlaps"][image_name] = tuple( max_overlaps, argmax_gt )
+#     max_overlaps - n x NUM_CLASSES matrix, column class_id-1 holds the
+#                    highest overlap of each region with a GT bbox of
+#                    class_id (0 when the image has none)
+#     argmax_gt - n x NUM_CLASSES matrix of the index (into the GT bboxes
+#                 of the image) of that GT bbox, -1 when there is none
+#
+
+OVERLAP_INDEX_FILE = "overlap_index.npz"
+
+# Only one thread builds the index when the classes are trained in parallel
+overlap_index_lock = threading.Lock()
+
+################################################################
+# computeImageOverlaps(labels, gt_bboxes, regions)
+#   Computes the index entry of a single image
+#
+# Input: labels (class of every GT bbox)
+#        gt_bboxes (k x 4 matrix of GT bboxes)
+#        regions (n x 4 matrix of region proposals)
+# Output: max_overlaps (n x NUM_CLASSES matrix)
+#         argmax_gt (n x NUM_CLASSES matrix)
+#
+def computeImageOverlaps(labels, gt_bboxes, regions):
+    num_regions = regions.shape[0]
+    max_overlaps = np.zeros((num_regions, NUM_CLASSES))
+    argmax_gt = -1 * np.ones((num_regions, NUM_CLASSES), dtype=np.int32)
+
+    labels = np.array(labels).ravel()
+    if num_regions == 0:
+        return max_overlaps, argmax_gt
+
+    for class_id in xrange(1, NUM_CLASSES+1):
+        IDX = np.where(labels == class_id)[0]
+        if len(IDX) == 0:
+            continue
+
+        overlaps = util.computeOverlaps(regions, gt_bboxes[IDX])
+        best = overlaps.argmax(axis=1)
+        max_overlaps[:,class_id-1] = overlaps[np.arange(num_regions), best]
+        argmax_gt[:,class_id-1] = IDX[best]
+
+    return max_overlaps, argmax_gt
+
+# Identifies the GT and regions an index entry was computed from, so
+# that stale entries are recomputed
+def imageSignature(gt_bboxes, regions):
+    return np.array([regions.shape[0], gt_bboxes.shape[0],
+        regions.astype(np.int64).sum(), gt_bboxes.astype(np.int64).sum()], dtype=np.int64)
+
+# Reads the cached index: image_name -> (signature, max_overlaps, argmax_gt)
+def readOverlapIndex(file_name):
+    if not os.path.isfile(file_name):
+        return {}
+
+    cached = np.load(file_name)
+    names = cached["names"]
+    offsets = cached["offsets"]
+    signatures = cached["signatures"]
+    max_overlaps = cached["max_overlaps"]
+    argmax_gt = cached["argmax_gt"]
+
+    entries = {}
+    for i, image_name in enumerate(names):
+        start, end = offsets[i], offsets[i+1]
+        entries[str(image_name)] = (signatures[i], max_overlaps[start:end], argmax_gt[start:end])
+    return entries
+
+# Writes all entries into a single file, regions of all images concatenated
+def writeOverlapIndex(file_name, entries):
+    names = sorted(entries.keys())
+    offsets = np.cumsum([0] + [entries[image_name][1].shape[0] for image_name in names])
+    tmp_file_name = file_name + '.tmp.npz'
+    np.savez(tmp_file_name,
+        names=np.array(names),
+        offsets=offsets,
+        signatures=np.array([entries[image_name][0] for image_name in names]),
+        max_overlaps=util.stack([entries[image_name][1] for image_name in names]),
+        argmax_gt=util.stack([entries[image_name][2] for image_name in names]))
+    os.rename(tmp_file_name, file_name)
+
+################################################################
+# getOverlapIndex(data)
+#   Returns the overlap index of all images in data (for example
+#   data["train"]). It is computed on first use, stored in
+#   data["overlaps"], and cached in features_dir for later runs
+#
+# Input: data (dictionary with "gt" and "ssearch", see util.readMatrixData)
+#        features_dir (directory of the cached index)
+# Output: overlaps (dictionary image_name -> (max_overlaps, argmax_gt))
+#
+def getOverlapIndex(data, features_dir=FEATURES_DIR, debug=False):
+    with overlap_index_lock:
+        if "overlaps" in data:
+            return data["overlaps"]
+
+        file_name = os.path.join(features_dir, OVERLAP_INDEX_FILE)
+        entries = readOverlapIndex(file_name)
+
+        num_computed = 0
+        for image_name in data["gt"].keys():
+            labels, gt_bboxes = data["gt"][image_name]
+            regions = data["ssearch"][image_name]
+            signature = imageSignature(gt_bboxes, regions)
+            if image_name in entries and np.array_equal(entries[image_name][0], signature):
+                continue
+
+            max_overlaps, argmax_gt = computeImageOverlaps(labels, gt_bboxes, regions)
+            entries[image_name] = (signature, max_overlaps, argmax_gt)
+            num_computed += 1
+
+        if num_computed > 0:
+            if debug: print '[INFO] Computed the overlaps of %d images'%num_computed
+            if not os.path.isdir(features_dir):
+                os.makedirs(features_dir)
+            writeOverlapIndex(file_name, entries)
+
+        data["overlaps"] = dict((image_name, entries[image_name][1:]) for image_name in data["gt"].keys())
+        return data["overlaps"]
@@ -0,0 +1,59 @@
+import numpy as np
+import suppression
+
+from settings import *
+
+################################################################
+# Proposal filtering
+#   Drops selective search proposals before feature extraction:
+#   boxes smaller than PROPOSAL_MIN_SIZE pixels, slivers more
+#   elongated than PROPOSAL_MAX_ASPECT_RATIO, and near duplicates
+#   (a box overlapping an earlier kept box by PROPOSAL_DEDUP_OVERLAP
+#   or more, the proposals are visited in the order of the
+#   ssearch file). At most PROPOSAL_TOP_N boxes are kept per image.
+#
+#   The filter is applied when the dataset is read (see
+#   dataset_manifest.py), so extraction, training, testing and the
+#   overlap index all use the same kept proposals, and
+#   data["proposal_index"][image_name] maps them back to the rows of
+#   the ssearch file. The features of the kept proposals only are
+#   extracted, so the features must be extracted again when the
+#   filter changes.
+#
+
+# Current filter settings, a dictionary that identifies the kept proposals
+def filterSettings(min_size=PROPOSAL_MIN_SIZE, max_aspect_ratio=PROPOSAL_MAX_ASPECT_RATIO,
+        dedup_overlap=PROPOSAL_DEDUP_OVERLAP, top_n=PROPOSAL_TOP_N):
+    return {'min_size': min_size, 'max_aspect_ratio': max_aspect_ratio,
+        'dedup_overlap': dedup_overlap, 'top_n': top_n}
+
+# Whether the settings keep every proposal
+def keepsAll(settings):
+    return (settings['min_size'] <= 1 and settings['max_aspect_ratio'] is None
+        and settings['dedup_overlap'] is None and settings['top_n'] is None)
+
+################################################################
+# filterProposals(regions, settings)
+#   Selects the proposals of one image to extract
+#
+# Input: regions (n x 4 matrix of bboxes, in the order of the ssearch file)
+#        settings (see filterSettings)
+# Output: kept (indices of the kept regions, increasing)
+#
+def filterProposals(regions, settings):
+    kept = np.arange(regions.shape[0])
+    if regions.shape[0] == 0:
+        return kept
+
+    W = regions[:,2].astype(np.int64) - regions[:,0] + 1
+    H = regions[:,3].astype(np.int64) - regions[:,1] + 1
+    valid = np.minimum(W, H) >= settings['min_size']
+    if settings['max_aspect_ratio'] is not None:
+        valid &= np.maximum(W, H) <= settings['max_aspect_ratio'] * np.minimum(W, H)
+    kept = kept[valid]
+
+    if settings['dedup_overlap'] is not None:
+        kept = kept[suppression.nmsIndices(regions[kept], settings['dedup_overlap'], settings['top_n'])]
+    elif settings['top_n'] is not None:
+        kept = kept[0:settings['top_n']]
+    return kept
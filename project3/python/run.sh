@@ -1,8 +1 @@
-time python main.py --mode extract --num_gpus 8 --gpu_id 0 &
-time python main.py --mode extract --num_gpus 8 --gpu_id 1 &
-time python main.py --mode extract --num_gpus 8 --gpu_id 2 &
-time python main.py --mode extract --num_gpus 8 --gpu_id 3 &
-time python main.py --mode extract --num_gpus 8 --gpu_id 4 &
-time python main.py --mode extract --num_gpus 8 --gpu_id 5 &
-time python main.py --mode extract --num_gpus 8 --gpu_id 6 &
-time python main.py --mode extract --num_gpus 8 --gpu_id 7 &
\ No newline at end of file
+time python main.py --mode extract --num_workers 8
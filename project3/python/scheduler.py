@@ -0,0 +1,210 @@
+import os
+import sys
+import time
+import Queue
+import multiprocessing as mp
+
+import numpy as np
+import extractor
+import cnn_backends
+import feature_store
+
+from multiprocessing.pool import ThreadPool
+from settings import *
+
+################################################################
+# Dynamic extraction scheduler
+#   All images are put in a single task queue, largest (most
+#   regions) first, and every worker process pulls its next image
+#   as soon as it has room for it. Fast workers therefore take
+#   over the work of slow ones instead of idling at the end.
+#
+#   A worker takes a lease on an image when it pulls it, and
+#   reports it done once its features are in the feature store
+#   (every worker has its own shards). The images leased by a worker
+#   that crashed, or that held a lease for more than
+#   EXTRACT_LEASE_TIMEOUT seconds, are put back in the queue for a
+#   replacement worker. After EXTRACT_MAX_RESTARTS replacements the
+#   extraction is aborted, so that a worker failing on every start
+#   is not restarted forever. Running the extraction again skips
+#   every image already in the feature store.
+#
+#   Every worker has its own stop event. A worker only returns once
+#   its stop event is set and the task queue is empty (it has to
+#   return to flush its last, partially filled, batch). The events
+#   are set once every image left is leased by a running worker, and
+#   a stopping worker still takes the images reassigned after that.
+#
+
+################################################################
+# extractionWorker(worker_id, gpu_id, backend_name, ...)
+#   Worker process. Pulls (image_name, regions, num_gt) tasks from the task
+#   queue until it is empty and stop_event is set, and extracts them
+#   with the pipelined extractor. Leases and completions are sent to the scheduler
+#   through the message queue.
+#
+def extractionWorker(worker_id, gpu_id, backend_name, layers, features_dir, task_queue, message_queue, stop_event, prefetch_depth):
+    backend = cnn_backends.createBackend(backend_name, gpu_id, layers)
+    img_mean = cnn_backends.loadImageMean().astype(np.uint8)
+    pool = ThreadPool(WARP_THREADS) if WARP_THREADS > 1 else None
+    writer = feature_store.FeatureStoreWriter(features_dir, 'worker%d'%worker_id, layers=backend.layer_sizes)
+    num_gt = {}
+
+    def jobs():
+        while True:
+            try:
+                task = task_queue.get(timeout=0.5)
+            except Queue.Empty:
+                if stop_event.is_set():
+                    return
+                continue
+            image_name, regions, num_gt[image_name] = task
+            message_queue.put(('lease', worker_id, image_name))
+            yield image_name, regions
+
+    def saveFeatures(image_name, features):
+        writer.append(image_name, features, num_gt.pop(image_name))
+        message_queue.put(('done', worker_id, image_name))
+
+    extractor.extractFeatures(backend, jobs(), img_mean, saveFeatures,
+        prefetch_depth=prefetch_depth, pool=pool)
+    writer.close()
+
+################################################################
+# runExtraction(tasks, num_workers, backend_name)
+#   Extracts the features of all tasks with num_workers worker
+#   processes, and skips the images already in the feature store
+#
+# Input: tasks (list of (image_name, regions, num_gt), regions is a matrix
+#               where each row is a 1-indexed bbox, the first num_gt rows
+#               are the GT bboxes)
+#        num_workers (number of worker processes, worker i uses GPU i)
+#        backend_name (CNN backend, see cnn_backends.py)
+#        layers (names of the layers to extract)
+#        features_dir (directory of the feature store)
+#        max_restarts (number of worker restarts after which a
+#                      RuntimeError is raised)
+# Output: completed (set of extracted images)
+#
+def runExtraction(tasks, num_workers, backend_name, layers=FEATURE_LAYERS, features_dir=FEATURES_DIR, prefetch_depth=PREFETCH_DEPTH, lease_timeout=EXTRACT_LEASE_TIMEOUT, max_restarts=EXTRACT_MAX_RESTARTS, debug=False):
+    if not os.path.isdir(features_dir):
+        os.makedirs(features_dir)
+
+    completed = set(feature_store.FeatureStore(features_dir, layer=None).imageNames())
+    remaining = dict((task[0], task) for task in tasks if task[0] not in completed)
+    print '[INFO] %d images already extracted, %d left'%(len(completed), len(remaining))
+
+    # Largest images first, so that the small ones fill the gaps at the end
+    order = sorted(remaining.keys(), key=lambda image_name: -remaining[image_name][1].shape[0])
+
+    task_queue = mp.Queue()
+    message_queue = mp.Queue()
+    for image_name in order:
+        task_queue.put(remaining[image_name])
+
+    workers = {}
+    leases = {} # worker_id -> {image_name: lease start time}
+    stop_events = {}
+    next_worker_id = [0]
+
+    def startWorker():
+        worker_id = next_worker_id[0]
+        next_worker_id[0] += 1
+        stop_events[worker_id] = mp.Event()
+        worker = mp.Process(target=extractionWorker, args=(worker_id, worker_id % num_workers,
+            backend_name, layers, features_dir, task_queue, message_queue,
+            stop_events[worker_id], prefetch_depth))
+        worker.daemon = True
+        worker.start()
+        workers[worker_id] = worker
+        leases[worker_id] = {}
+
+    def restartWorker():
+        if next_worker_id[0] - num_started >= max_restarts:
+            for worker in workers.values():
+                worker.terminate()
+            raise RuntimeError('Feature extraction workers were restarted %d times, %d images were not extracted'%(max_restarts, len(remaining)))
+        startWorker()
+
+    for i in xrange(min(num_workers, len(order))):
+        startWorker()
+    num_started = next_worker_id[0]
+
+    start_time = time.time()
+    last_check = time.time()
+    unleased = set()
+    while len(remaining) > 0:
+        try:
+            message, worker_id, image_name = message_queue.get(timeout=1.0)
+            # Late messages can come from a worker that was already replaced
+            worker_leases = leases.get(worker_id, {})
+            if message == 'lease':
+                worker_leases[image_name] = time.time()
+            elif message == 'done':
+                worker_leases.pop(image_name, None)
+                if image_name in remaining:
+                    del remaining[image_name]
+                    completed.add(image_name)
+                    if debug or len(completed) % 50 == 0:
+                        print "Extracted %i images, %i left.\tElapsed: %f" % (len(completed), len(remaining), time.time() - start_time)
+        except Queue.Empty:
+            pass
+
+        # Reassign the images of crashed and stuck workers
+        now = time.time()
+        if now - last_check < 1.0:
+            continue
+        last_check = now
+        for worker_id in workers.keys():
+            worker = workers[worker_id]
+            expired = [t for t in leases[worker_id].values() if now - t > lease_timeout]
+            if worker.is_alive() and len(expired) == 0:
+                continue
+            if worker.is_alive():
+                print '[WARNING] Worker %d held a lease for more than %d seconds, restarting it'%(worker_id, lease_timeout)
+                worker.terminate()
+            worker.join()
+
+            lost = [image_name for image_name in leases[worker_id] if image_name in remaining]
+            del workers[worker_id]
+            del leases[worker_id]
+            del stop_events[worker_id]
+            if worker.exitcode != 0 or len(lost) > 0:
+                print '[WARNING] Worker %d stopped (exit code %s), reassigning %d images'%(worker_id, worker.exitcode, len(lost))
+                for image_name in lost:
+                    task_queue.put(remaining[image_name])
+                restartWorker()
+
+        if not task_queue.empty():
+            unleased = set()
+            continue
+        leased = set()
+        for worker_leases in leases.values():
+            leased.update(worker_leases.keys())
+        missing = set(remaining.keys()) - leased
+
+        # Every image left is held by a running worker: the workers
+        # can stop once they are done with them
+        if len(missing) == 0:
+            for stop_event in stop_events.values():
+                stop_event.set()
+
+        # Images that were pulled but never leased (crash right after
+        # pulling) are neither in the queue nor held by a worker. They
+        # are reassigned if they are still missing at the next check,
+        # once their lease messages had time to arrive.
+        lost = missing & unleased
+        unleased = missing - lost
+        if len(lost) > 0:
+            print '[WARNING] %d images were pulled but never leased, reassigning them'%len(lost)
+            for image_name in lost:
+                task_queue.put(remaining[image_name])
+            if len(workers) == 0:
+                restartWorker()
+
+    for stop_event in stop_events.values():
+        stop_event.set()
+    for worker in workers.values():
+        worker.join()
+
+    return completed
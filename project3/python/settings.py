@@ -34,12 +34,40 @@ CNN_INPUT_SIZE = 227 # Input size of the CNN input image (after cropping)
 global CONTEXT_SIZE
 CONTEXT_SIZE = 16 # Context or 'padding' size around region proposals in pixels
 
+global WARP_THREADS
+WARP_THREADS = 4 # Number of threads used to warp the regions of a batch
+global PREFETCH_DEPTH
+PREFETCH_DEPTH = 2 # Number of warped batches prepared ahead of the CNN during extraction
+global CNN_BACKEND
+CNN_BACKEND = "caffe" # CNN used for extraction: "caffe", "caffe_roi" (shared convolutions), or "numpy"/"numpy_roi" (CPU stand-ins for testing)
+global EXTRACT_LEASE_TIMEOUT
+EXTRACT_LEASE_TIMEOUT = 600 # Seconds after which an image held by a worker is reassigned
+global EXTRACT_MAX_RESTARTS
+EXTRACT_MAX_RESTARTS = 5 # Worker restarts after which the extraction is aborted
+
+# Shared convolution extraction (caffe_roi and numpy_roi backends): the
+# convolutions run once per image and scale, and the features of every
+# region are pooled from their output (RoI pooling)
+global MODEL_ROI_DEPLOY
+MODEL_ROI_DEPLOY = "../ml/cnn_roi_deploy.prototxt" # CNN architecture with a ROIPooling layer ("rois" input) in place of pool5
+global ROI_SCALES
+ROI_SCALES = [600] # Shortest image side at every scale, e.g. [480, 576, 688, 864, 1200]. Each region uses one scale
+global ROI_MAX_SIZE
+ROI_MAX_SIZE = 1000 # Maximum longest image side at any scale
+
 # The layer and number of features to use from that layer
 # Check the deploy.prototxt file for a list of layers/feature outputs
 global FEATURE_LAYER
-FEATURE_LAYER = "fc6_ft"
+FEATURE_LAYER = "fc6_ft" # Layer training and testing use, selected by name among the layers of the feature store
 global NUM_CNN_FEATURESls
 NUM_CNN_FEATURES = 512
+global FEATURE_LAYERS
+FEATURE_LAYERS = [FEATURE_LAYER] # Layers extracted in the same forward pass, each stored in its own shards, e.g. ["pool5", "fc6_ft", "fc7_ft"]
+
+global FEATURE_STORE_DTYPE
+FEATURE_STORE_DTYPE = "float32" # Type the features are stored in: "float32", or "float16" to halve the size
+global FEATURE_SHARD_ROWS
+FEATURE_SHARD_ROWS = 250000 # Rows per feature store shard (about 500MB of float32 fc6 features)
 
 global NUM_CLASSES
 NUM_CLASSES = 3 # Number of object classes
@@ -55,5 +83,17 @@ BBOX_POSITIVE_THRESHOLD = 0.6
 global NMS_THRESHOLD
 NMS_THRESHOLD = 0.4
 
+# Proposal filtering before extraction (see proposal_filter.py). The
+# defaults keep every selective search proposal. Features must be
+# extracted again after changing these
+global PROPOSAL_MIN_SIZE
+PROPOSAL_MIN_SIZE = 0 # Minimum width and height of a kept proposal, in pixels
+global PROPOSAL_MAX_ASPECT_RATIO
+PROPOSAL_MAX_ASPECT_RATIO = None # Maximum ratio of the longest to the shortest side, e.g. 4.0 (None keeps all)
+global PROPOSAL_DEDUP_OVERLAP
+PROPOSAL_DEDUP_OVERLAP = None # Overlap with an earlier proposal above which a proposal is dropped, e.g. 0.9 (None keeps all)
+global PROPOSAL_TOP_N
+PROPOSAL_TOP_N = None # Maximum number of proposals per image (None keeps all)
+
 # END REQUIRED INPUT PARAMETERS
 ################################################################
\ No newline at end of file
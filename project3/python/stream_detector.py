@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import time
+import collections
+
+import cv2
+import numpy as np
+import extractor
+import test_rcnn
+
+from settings import *
+
+################################################################
+# Streaming detection
+#   Detects objects in new images, without features extracted
+#   beforehand by --mode extract. Every image goes through:
+#
+#     proposals - read from a proposals file, or generated by
+#                 slidingWindowProposals
+#     warp, cnn - batched warping and feature extraction by a CNN
+#                 backend, or shared convolutions (extractor.extractFeatures,
+#                 the producer thread warps or prepares the next images
+#                 while the backend runs)
+#     score     - all classes at once (test_rcnn.detectRegions)
+#     regress   - optional bbox regression of all classes at once
+#     nms       - per class
+#
+#   The detections of an image are written as soon as its features
+#   are extracted, and the time of every stage is reported with
+#   the latency of the images and the throughput.
+#
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp']
+
+MAX_PROPOSALS = 2000 # Regions generated per image by slidingWindowProposals
+PROPOSAL_SCALES = [0.1, 0.2, 0.3, 0.45, 0.6, 0.8, 1.0] # Window sizes, as a fraction of the shortest image side
+PROPOSAL_ASPECT_RATIOS = [0.5, 1.0, 2.0] # Window widths over heights
+PROPOSAL_STRIDE = 0.25 # Window step, as a fraction of the window size
+
+# Yields the paths of the images to detect: the images of a directory
+# (sorted by name), or one path per line of stdin when images is '-'
+def iterImagePaths(images):
+    if images == '-':
+        for line in iter(sys.stdin.readline, ''):
+            if line.strip() != '':
+                yield line.strip()
+    else:
+        for file_name in sorted(os.listdir(images)):
+            if os.path.splitext(file_name)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(images, file_name)
+
+# Reads a proposals file: a .npz archive with one n x 4 matrix of
+# 1-indexed bboxes per image name (like data["ssearch"])
+def readProposals(file_name):
+    with np.load(file_name) as proposals:
+        return dict((image_name, proposals[image_name].astype(np.int32)) for image_name in proposals.files)
+
+################################################################
+# slidingWindowProposals(img)
+#   Fast region proposals, a CPU stand-in for selective search.
+#   Windows of PROPOSAL_SCALES sizes and PROPOSAL_ASPECT_RATIOS
+#   slide over the image, and the windows with the highest mean
+#   gradient magnitude (computed with an integral image) are kept,
+#   the same number for every size and aspect ratio
+#
+# Input: img (H x W x 3 image)
+#        max_proposals (maximum number of regions)
+# Output: regions (n x 4 matrix of 1-indexed bboxes, int32)
+#
+def slidingWindowProposals(img, max_proposals=MAX_PROPOSALS):
+    H, W = img.shape[0:2]
+    gray = np.asarray(img, dtype=np.float32).mean(axis=2)
+    magnitude = np.abs(cv2.Sobel(gray, cv2.CV_32F, 1, 0)) + np.abs(cv2.Sobel(gray, cv2.CV_32F, 0, 1))
+    integral = cv2.integral(magnitude, sdepth=cv2.CV_64F)
+
+    shapes = [(s, r) for s in PROPOSAL_SCALES for r in PROPOSAL_ASPECT_RATIOS]
+    num_per_shape = max(max_proposals / len(shapes), 1)
+
+    regions = []
+    for scale, ratio in shapes:
+        side = scale * min(H, W)
+        w = int(min(W, max(round(side * np.sqrt(ratio)), 1)))
+        h = int(min(H, max(round(side / np.sqrt(ratio)), 1)))
+        stride = max(int(PROPOSAL_STRIDE * min(w, h)), 1)
+
+        x1, y1 = np.meshgrid(np.arange(0, W - w + 1, stride), np.arange(0, H - h + 1, stride))
+        x1, y1 = x1.ravel(), y1.ravel()
+        x2, y2 = x1 + w, y1 + h
+        density = integral[y2,x2] - integral[y1,x2] - integral[y2,x1] + integral[y1,x1]
+
+        IDX = np.argsort(-1*density, kind='mergesort')[0:num_per_shape]
+        regions.append(np.vstack((x1[IDX], y1[IDX], x2[IDX] - 1, y2[IDX] - 1)).T)
+
+    # Plus one because bboxes are indexed starting at 1
+    regions = np.vstack(regions)[0:max_proposals] + 1
+    return regions.astype(np.int32)
+
+# Detections of one image as a JSON line: class name -> list of
+# [x1, y1, x2, y2, score]
+def detectionsJSON(image_path, result, class_ids):
+    detections = dict((test_rcnn.classes[c-1], result[c].tolist()) for c in class_ids)
+    return json.dumps({'image': image_path, 'detections': detections})
+
+################################################################
+# detectStream(backend, detector, image_paths, img_mean)
+#   Detects all classes of the detector in a stream of images
+#
+# Input: backend (CNN backend, see cnn_backends.py)
+#        detector (see test_rcnn.loadDetector)
+#        image_paths (list or generator of image paths, see iterImagePaths)
+#        img_mean (CNN_INPUT_SIZE x CNN_INPUT_SIZE x 3 mean image)
+#        proposals (optional dictionary image name -> regions, see
+#                   readProposals, otherwise slidingWindowProposals)
+#        bbox_regression (whether to regress the detected bboxes)
+#        output (optional file the detections are written to, see detectionsJSON)
+#        prefetch_depth, pool (see extractor.extractFeatures)
+# Output: stats (dictionary with the number of images and regions, the
+#         wall time, the time of every stage, and the latency of every
+#         image)
+#
+def detectStream(backend, detector, image_paths, img_mean, proposals=None, bbox_regression=False,
+        output=None, prefetch_depth=PREFETCH_DEPTH, pool=None, debug=False):
+    stats = {'regions': 0, 'detections': 0, 'proposal_time': 0.0, 'score_time': 0.0,
+        'regression_time': 0.0, 'nms_time': 0.0, 'latencies': []}
+
+    # Images complete in the order of the jobs. Holds (start time,
+    # regions) of the images whose features are being extracted
+    pending = collections.deque()
+
+    def jobs():
+        for image_path in image_paths:
+            start = time.time()
+            img = backend.loadImage(image_path)
+            if proposals is None:
+                regions = slidingWindowProposals(img)
+            elif os.path.basename(image_path) in proposals:
+                regions = proposals[os.path.basename(image_path)]
+            else:
+                print '[WARNING] No proposals for \'%s\', skipping it'%image_path
+                continue
+            stats['proposal_time'] += time.time() - start
+            stats['regions'] += regions.shape[0]
+
+            pending.append((start, regions))
+            yield (image_path, regions, img)
+
+    def detect(image_path, features):
+        image_start, regions = pending.popleft()
+
+        start = time.time()
+        detections = test_rcnn.detectRegions(detector, features, regions)
+        stats['score_time'] += time.time() - start
+
+        if bbox_regression:
+            start = time.time()
+            detections = test_rcnn.regressDetections(detector, detections)
+            stats['regression_time'] += time.time() - start
+
+        start = time.time()
+        result = {}
+        for c in detector.class_ids:
+            if detections[c][0] is None:
+                result[c] = np.zeros((0,5))
+            else:
+                result[c] = test_rcnn.nms(detections[c][1])
+            stats['detections'] += result[c].shape[0]
+        stats['nms_time'] += time.time() - start
+
+        if output is not None:
+            output.write(detectionsJSON(image_path, result, detector.class_ids) + '\n')
+            output.flush()
+        stats['latencies'].append(time.time() - image_start)
+        if debug:
+            print '%s: %d regions, %d detections'%(image_path, regions.shape[0], sum(r.shape[0] for r in result.values()))
+
+    start = time.time()
+    stats.update(extractor.extractFeatures(backend, jobs(), img_mean, detect, prefetch_depth, pool))
+    stats['wall_time'] = time.time() - start
+    return stats
+
+# Prints the time of every stage of detectStream (per image), the latency
+# of the images and the throughput
+def printDetectStats(stats):
+    num_images = max(stats['images'], 1)
+    print '[INFO] Detected %d objects in %d images (%d regions)'%(stats['detections'], stats['images'], stats['regions'])
+    print '%-12s %12s %16s'%('Stage', 'Total (s)', 'Per image (ms)')
+    for name, key in [('proposals', 'proposal_time'), ('warp', 'warp_time'), ('cnn', 'backend_time'),
+            ('score', 'score_time'), ('regress', 'regression_time'), ('nms', 'nms_time')]:
+        print '%-12s %12.3f %16.2f'%(name, stats[key], 1000 * stats[key] / num_images)
+    if len(stats['latencies']) > 0:
+        latencies = 1000 * np.array(stats['latencies'])
+        print '[INFO] Latency per image: mean %0.2fms, median %0.2fms, 95th percentile %0.2fms'%(
+            latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 95))
+    print '[INFO] %0.2f images per second (%0.3fs, the backend waited %0.3fs for the producer)'%(
+        stats['images'] / max(stats['wall_time'], 1e-9), stats['wall_time'], stats['wait_time'])
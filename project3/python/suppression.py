@@ -0,0 +1,147 @@
+import numpy as np
+import util
+
+from settings import *
+
+################################################################
+# Non-maximum suppression
+#   All functions take bboxes as an n x 4 (or n x 5, with the score
+#   in the last column) matrix. Suppression works on indices, so no
+#   bbox array is rebuilt while suppressing. Overlaps come from
+#   util.computePairOverlaps, like everywhere else.
+#
+
+# Overlaps of the bboxes in rows (one row each) with the bboxes in cols
+def overlapsBetween(bboxes, rows, cols):
+    return util.computePairOverlaps(bboxes[rows][:,np.newaxis,0:4], bboxes[cols][np.newaxis,:,0:4])
+
+################################################################
+# nmsIndices(bboxes)
+#   Greedy NMS. The bboxes are visited in order (so they must be
+#   sorted by decreasing score), every bbox that is not suppressed
+#   is kept and suppresses the later bboxes that overlap it by
+#   threshold or more
+#
+#   The candidates are processed in blocks of block_size: the
+#   greedy pass inside a block only reads a precomputed block x
+#   block suppression matrix, then all kept bboxes of the block
+#   suppress the remaining candidates at once. This gives exactly
+#   the result of the one bbox at a time loop, with far fewer
+#   numpy calls
+#
+# Input: bboxes (n x 4 or n x 5 matrix, sorted by decreasing score)
+#        threshold (overlap at which a bbox is suppressed)
+#        top_k (stop after keeping top_k bboxes, None keeps all)
+#        block_size (number of candidates resolved at once)
+# Output: keep (indices of the kept bboxes, in order)
+#
+def nmsIndices(bboxes, threshold=NMS_THRESHOLD, top_k=None, block_size=64):
+    keep = []
+    candidates = np.arange(bboxes.shape[0])
+    while candidates.size > 0:
+        block = candidates[0:block_size]
+        candidates = candidates[block_size:]
+
+        suppresses = overlapsBetween(bboxes, block, block) >= threshold
+
+        # Greedy pass inside the block
+        suppressed = np.zeros(block.size, dtype=bool)
+        block_keep = []
+        for i in xrange(block.size):
+            if suppressed[i]:
+                continue
+            block_keep.append(i)
+            if top_k is not None and len(keep) + len(block_keep) >= top_k:
+                break
+            suppressed |= suppresses[i]
+        kept = block[block_keep]
+        keep.extend(kept)
+
+        if top_k is not None and len(keep) >= top_k:
+            break
+        if candidates.size == 0:
+            break
+
+        # The kept bboxes of the block suppress the later candidates
+        suppresses = overlapsBetween(bboxes, kept, candidates) >= threshold
+        candidates = candidates[~suppresses.any(axis=0)]
+
+    return np.array(keep, dtype=int)
+
+################################################################
+# nms(bboxes)
+#   Greedy NMS, returns the kept bboxes (see nmsIndices)
+#
+def nms(bboxes, threshold=NMS_THRESHOLD, top_k=None):
+    return bboxes[nmsIndices(bboxes, threshold, top_k)]
+
+################################################################
+# batchedNMS(bboxes, labels)
+#   NMS of the detections of several classes at once. Bboxes only
+#   suppress bboxes of the same class, so every class is suppressed
+#   on its own and the kept bboxes are merged by score
+#
+# Input: bboxes (n x 5 matrix, the last column is the score)
+#        labels (class of every bbox)
+#        threshold (overlap at which a bbox is suppressed)
+#        top_k (maximum number of bboxes kept per class)
+# Output: keep (indices of the kept bboxes, by decreasing score)
+#
+def batchedNMS(bboxes, labels, threshold=NMS_THRESHOLD, top_k=None):
+    labels = np.asarray(labels)
+    order = np.argsort(-bboxes[:,-1], kind='mergesort')
+
+    keep = [np.zeros(0, dtype=int)]
+    for label in np.unique(labels):
+        class_order = order[labels[order] == label]
+        keep.append(class_order[nmsIndices(bboxes[class_order], threshold, top_k)])
+    keep = np.concatenate(keep)
+
+    return keep[np.argsort(-bboxes[keep,-1], kind='mergesort')]
+
+################################################################
+# softNMS(bboxes)
+#   Soft-NMS (Bodla et al. 2017). Instead of removing the bboxes
+#   that overlap a kept bbox, their scores are decayed, linearly
+#   (score * (1 - overlap), only above threshold) or with a
+#   gaussian (score * exp(-overlap^2 / sigma)). The bboxes whose
+#   score falls below score_threshold are dropped
+#
+# Input: bboxes (n x 5 matrix, the last column is the score)
+#        method ('linear' or 'gaussian')
+#        threshold (overlap above which linear decay is applied)
+#        sigma (width of the gaussian decay)
+#        score_threshold (minimum score of a kept bbox)
+#        top_k (stop after keeping top_k bboxes, None keeps all)
+# Output: result (kept bboxes with their decayed scores, by decreasing score)
+#
+def softNMS(bboxes, method='linear', threshold=NMS_THRESHOLD, sigma=0.5, score_threshold=0.001, top_k=None):
+    if method not in ['linear', 'gaussian']:
+        raise ValueError('Unknown Soft-NMS method \'%s\''%method)
+
+    scores = bboxes[:,-1].astype(np.float64)
+    remaining = np.flatnonzero(scores >= score_threshold)
+
+    keep = []
+    while remaining.size > 0:
+        # Highest (decayed) score left
+        best = np.argmax(scores[remaining])
+        i = remaining[best]
+        keep.append(i)
+        if top_k is not None and len(keep) >= top_k:
+            break
+
+        remaining = np.delete(remaining, best)
+        if remaining.size == 0:
+            break
+        overlaps = overlapsBetween(bboxes, np.array([i]), remaining)[0]
+        if method == 'linear':
+            decay = np.where(overlaps >= threshold, 1 - overlaps, 1)
+        else:
+            decay = np.exp(-overlaps * overlaps / sigma)
+        scores[remaining] *= decay
+        remaining = remaining[scores[remaining] >= score_threshold]
+
+    result = np.array(bboxes[keep], dtype=np.float64).reshape((len(keep), bboxes.shape[1]))
+    result[:,-1] = scores[keep]
+    return result
@@ -3,6 +3,9 @@ import time
 import util
 import cv
 import det_eval
+import compact_model
+import feature_store
+import suppression
 
 import numpy as np
 import cPickle as cp
@@ -13,37 +16,53 @@ from train_bbox import *
 
 classes = ['CAR', 'CAT', 'PERSON']
 
+# Greedy NMS of the detections of one class (sorted by decreasing score)
+# See suppression.py for the top-k, batched and Soft-NMS variants
 def nms(data, debug=False):
     if debug: print data.shape[0],'->',
-    candidates = np.copy(data)
-    results = []
-
-    while candidates.size != 0:
-        # print candidates.shape
-        curr_candidate = candidates[0, :]
-        rest_candidates = candidates[1:, :]
-        overlaps = util.computeOverlap(curr_candidate, rest_candidates)
-        
-        # IDX = np.where(overlaps > 0.3)[0]
-        # mean_bbox = np.vstack((curr_candidate,rest_candidates[IDX]))
-        # mean_bbox = np.mean(mean_bbox, axis=0).astype(np.uint32)
-        # print mean_bbox
-        results.append(curr_candidate)
-
-        # if len(np.where(overlaps < 0.3)[0]) == 0:
-        #     break
-        candidates = rest_candidates[np.where(overlaps < NMS_THRESHOLD)[0], :]
-    if debug: print np.array(results).shape[0]
-    return np.array(results)
+    results = suppression.nms(data, NMS_THRESHOLD)
+    if debug: print results.shape[0]
+    return results
+
+################################################################
+# stackDetectors(svm_models, class_ids)
+#   Stacks the linear SVMs of several classes into one weight
+#   matrix, with the scaler of every class folded in, so that all
+#   classes are scored by a single matrix product of the raw
+#   features (see compact_model.py)
+#
+# Input: svm_models (dictionary class_id -> (model, scaler))
+#        class_ids (classes to detect)
+#        regression_models (optional, dictionary class_id -> bbox regressors)
+# Output: detector (compact_model.CompactModel)
+#
+def stackDetectors(svm_models, class_ids, regression_models=None):
+    if regression_models is not None:
+        regression_models = dict((c, regression_models[c]) for c in class_ids)
+    return compact_model.compactModelFromModels(dict((c, svm_models[c]) for c in class_ids), regression_models)
+
+################################################################
+# detectAll(image_name, detector, data)
+#   Detects all classes of a detector (see stackDetectors, or an
+#   exported compact_model.CompactModel) in one image. The features are loaded once and scored once, and a
+#   region is detected for a class when its score is positive (what
+#   the SVM predicts)
+#
+# Output: detections (dictionary class_id -> tuple( region indices,
+#           n x 5 bboxes with the score, features ) sorted by decreasing
+#           score, or (None, None, None) if nothing was detected)
+#
+def detectAll(image_name, detector, data, debug=False):
+    class_ids = detector.class_ids
+    no_detections = dict((c, (None, None, None)) for c in class_ids)
 
-def detect(image_name, model, data, debug=False):
-    model, scaler = model
     # Load features from file for current image
-    if not os.path.isfile(os.path.join(FEATURES_DIR, image_name + '.npy')):
+    store = feature_store.openFeatureStore()
+    if image_name not in store:
         print 'ERROR: detect(): Features not found for ', image_name
-        return
+        return no_detections
     
-    features = np.load(os.path.join(FEATURES_DIR, image_name + '.npy'))
+    features = store.get(image_name)
 
     # Get rid of GT_Bbox features from feature matrix
     gt_bboxes = data["gt"][image_name]
@@ -51,72 +70,103 @@ def detect(image_name, model, data, debug=False):
     if len(gt_bboxes[0]) != 0:
         num_gt_bboxes = len(gt_bboxes[0][0])
     # print '%s: Removing %d gt bboxes'%(image_name,num_gt_bboxes), data["gt"][image_name][0]
+    feature_store.checkImageFeatures(image_name, features, num_gt_bboxes, data["ssearch"][image_name].shape[0])
     features = features[num_gt_bboxes:, :]
 
-    result_bboxes = []
-    result_idx = [] # Length of 3, each element contains a list of indices where each index corresponds to a detected bbox
-    result_features = []
-    result_conf = []
-
-    X, _ = util.normalizeAndAddBias(features, scaler)
-    if debug:
-        print 'X', X.shape
-    # X = np.concatenate((np.ones((features.shape[0], 1)), features), axis=1) # Add the bias term
-    y_hat = model.predict(X)
-    confidence_scores = model.decision_function(X)
-
-    all_regions = data["ssearch"][image_name]
-
-    IDX = np.where(y_hat == 1)[0]
-
-    # If our model detects no bboxes
-    if len(IDX) == 0:
-        return None, None, None
-
-    # print "IDX", IDX.shape
-    candidates = all_regions[IDX, :]
-    candidates_features = features[IDX, :]
-    candidate_conf = confidence_scores[IDX]
-
-    assert(np.min(candidate_conf) >= 0)
-
-    # print "Candidate conf", candidate_conf.shape
-    sorted_IDX = np.argsort(-1*candidate_conf)
-    # print "sorted idx", sorted_IDX
-    candidates = candidates[sorted_IDX, :]
-    candidates_features = candidates_features[sorted_IDX, :]
-    candidate_conf = candidate_conf[sorted_IDX]
-    candidate_conf = np.reshape(candidate_conf, (candidate_conf.shape[0], 1))
+    return detectRegions(detector, features, data["ssearch"][image_name], debug)
 
+# Detects all classes of a detector in regions (n x 4 bboxes) from their
+# n x NUM_CNN_FEATURES features, see detectAll
+def detectRegions(detector, features, all_regions, debug=False):
+    class_ids = detector.class_ids
+    confidence_scores = detector.scores(features)
     if debug:
-        print 'Candidates:',candidates.shape
-        print 'Confidences:',candidate_conf.shape
-
-    candidates = np.hstack((candidates, candidate_conf))
+        print 'Scores', confidence_scores.shape
+
+    detections = dict((c, (None, None, None)) for c in class_ids)
+    for i, c in enumerate(class_ids):
+        candidate_conf = confidence_scores[:, i]
+        IDX = np.where(candidate_conf > 0)[0]
+
+        # If our model detects no bboxes
+        if len(IDX) == 0:
+            continue
+
+        # Result idx is the idx of detected bboxes in the original 2000 proposals
+        IDX = IDX[np.argsort(-1*candidate_conf[IDX])]
+        candidate_conf = np.reshape(candidate_conf[IDX], (IDX.shape[0], 1))
+        candidates = np.hstack((all_regions[IDX, :], candidate_conf))
+        if debug:
+            print 'Class %d candidates:'%c, candidates.shape
+
+        detections[c] = (IDX, candidates, features[IDX, :])
+
+    return detections
+
+################################################################
+# regressDetections(detector, detections)
+#   Runs the bbox regressors of the detector on the detections of
+#   all classes at once (see detectAll and CompactModel.regressAll)
+#
+# Output: detections (same as the input, with the regressed bboxes)
+#
+def regressDetections(detector, detections):
+    class_ids = [c for c in detector.class_ids if detections[c][0] is not None]
+    if len(class_ids) == 0:
+        return detections
+
+    num_detections = [detections[c][0].shape[0] for c in class_ids]
+    bboxes = detector.regressAll(np.repeat(class_ids, num_detections),
+        np.vstack([detections[c][2] for c in class_ids]),
+        np.vstack([detections[c][1] for c in class_ids]))
+
+    regressed = dict(detections)
+    for c, start, end in zip(class_ids, np.cumsum([0] + num_detections), np.cumsum(num_detections)):
+        regressed[c] = (detections[c][0], bboxes[start:end], detections[c][2])
+    return regressed
+
+# Detects a single class, see detectAll
+def detect(image_name, model, data, debug=False):
+    return detectAll(image_name, stackDetectors({0: model}, [0]), data, debug)[0]
+
+################################################################
+# loadDetector(class_ids)
+#   Loads the SVMs (and bbox regressors) of the classes, from the
+#   pickled models or from the archive written by --mode export
+#
+# Output: detector (compact_model.CompactModel, None if the regressors
+#         are missing from the archive)
+#
+def loadDetector(class_ids, bbox_regression='none', models_dir=MODELS_DIR, compact=False):
+    regression_models = None
+    if compact:
+        # SVMs and regressors exported by --mode export
+        detector = compact_model.loadCompactModel(compact_model.compactModelPath(models_dir))
+        if bbox_regression != 'none' and detector.regression_type == 'none':
+            print 'ERROR: loadDetector(): No bbox regressors in %s'%compact_model.compactModelPath(models_dir)
+            return None
+    else:
+        if bbox_regression != 'none':
+            model_file_name = os.path.join(models_dir, 'bbox_ridge_reg.mdl')
+            with open(model_file_name) as fp:
+                 regression_models = cp.load(fp)
+
+        svm_models = dict()
+        for c in class_ids:
+            model_file_name = os.path.join(models_dir, 'svm_%d_%s.mdl'%(c, FEATURE_LAYER))
+            with open(model_file_name) as fp:
+                svm_models[c] = cp.load(fp)
+        detector = stackDetectors(svm_models, class_ids, regression_models)
 
-    result_bboxes.append(candidates)
-    result_features.append(candidates_features)
-    
-    # Result idx is the idx of detected bboxes in the original 2000 proposals
-    result_idx.append(IDX[sorted_IDX])
-    
-    return IDX[sorted_IDX], candidates, candidates_features
+    return detector
 
-def test(data, bbox_regression='none', models_dir=MODELS_DIR, debug=False):
+def test(data, bbox_regression='none', models_dir=MODELS_DIR, compact=False, debug=False):
     # classes = ['CAR']
     class_ids = [1,2,3]
     # Load the models
-    regression_models = None
-    if bbox_regression != 'none':
-        model_file_name = os.path.join(MODELS_DIR, 'bbox_ridge_reg.mdl')
-        with open(model_file_name) as fp:
-             regression_models = cp.load(fp)
-
-    svm_models = dict()
-    for c in class_ids:
-        model_file_name = os.path.join(models_dir, 'svm_%d_%s.mdl'%(c, FEATURE_LAYER))
-        with open(model_file_name) as fp:
-            svm_models[c] = cp.load(fp)
+    detector = loadDetector(class_ids, bbox_regression, models_dir, compact)
+    if detector is None:
+        return
 
     local_data = data['test']
 
@@ -136,20 +186,18 @@ def test(data, bbox_regression='none', models_dir=MODELS_DIR, debug=False):
         
         # features = np.load(features_file_name)
 
+        # Run the detector and the regressor (all classes at once)
+        detections = detectAll(image_name, detector, local_data)
+        if bbox_regression != 'none':
+            detections = regressDetections(detector, detections)
         for c in class_ids:
-            # Run the detector
-            proposal_ids, proposal_bboxes, proposal_features = detect(image_name, svm_models[c], local_data)
+            proposal_ids, proposal_bboxes, proposal_features = detections[c]
             
             # If no boxes were detected
             if proposal_ids is None:
                 result.append(np.zeros((0,5)))
                 continue
 
-            # Run the regressor
-            if len(proposal_bboxes.shape) == 1:
-                proposal_bboxes = np.reshape(proposal_bboxes, (1,5))
-            if bbox_regression != 'none':
-                proposal_bboxes = predictBoundingBox(regression_models[c], proposal_features, proposal_bboxes, regression_type=bbox_regression)
             proposals = nms(proposal_bboxes)
             result.append(proposals)
         
@@ -1,7 +1,11 @@
 import util
 import numpy as np
 import det_eval
+import train_bbox
+import compact_model
 import random
+
+from sklearn import linear_model, preprocessing, svm
 try:
     import matlab.engine
     run_eval_test = True
@@ -13,6 +17,9 @@ TOLERANCE = 1e-7
 
 def main():
     bbox_overlap_test()
+    compact_model_test()
+    ridge_statistics_test()
+    det_eval_loop_test()
     if run_eval_test:
         eval_test()
 
@@ -28,6 +35,145 @@ def bbox_overlap_test():
     assert(np.abs(out[0] - 0.14935926) <= TOLERANCE)
     assert(np.abs(out[1] - 0) <= TOLERANCE)
     assert(np.abs(out[2] - 1) <= TOLERANCE)
+
+    # All pairs, touching and disjoint bboxes
+    region_bboxes = np.array([[50, 50, 100, 100],
+                            [101, 50, 150, 100], # Touches the first one
+                            [60, 60, 90, 90] # Inside the first one
+                            ])
+    out = util.computeOverlaps(region_bboxes, gt_bboxes)
+    assert(out.shape == (3, 3))
+    for i in xrange(region_bboxes.shape[0]):
+        assert(np.all(np.abs(out[i] - util.computeOverlap(region_bboxes[i], gt_bboxes)) <= TOLERANCE))
+    assert(np.abs(out[0,0] - 0.14935926) <= TOLERANCE)
+    assert(util.computeOverlaps(region_bboxes, np.zeros((0, 4))).shape == (3, 0))
+    # Scores in a fifth column are ignored
+    scored_bboxes = np.hstack((region_bboxes, np.ones((3, 1))))
+    assert(np.array_equal(util.computeOverlaps(scored_bboxes, gt_bboxes), out))
+
+    # Random bboxes: dense (in small chunks) and sparse must match computeOverlap exactly
+    rng = np.random.RandomState(0)
+    corners = rng.randint(0, 400, (300, 2))
+    bboxes = np.hstack((corners, corners + rng.randint(0, 100, (300, 2))))
+    expected = np.array([util.computeOverlap(bbox, bboxes[0:200]) for bbox in bboxes])
+    out = util.computeOverlaps(bboxes, bboxes[0:200], max_elements=1000)
+    assert(np.array_equal(out, expected))
+    out = util.computeSparseOverlaps(bboxes, bboxes[0:200], max_elements=1000)
+    assert(out.shape == expected.shape)
+    assert(np.array_equal(out.toarray(), expected))
+    out = util.computeSparseOverlaps(bboxes, bboxes[0:200], min_overlap=0.5)
+    assert(out.nnz == np.sum(expected > 0.5))
+    assert(np.array_equal(out.toarray(), np.where(expected > 0.5, expected, 0)))
+    print "Passed all tests."
+
+def compact_model_test():
+    print 'Testing the compact model...'
+    rng = np.random.RandomState(0)
+    X = (rng.randn(400, 20) * 3 + 5).astype(np.float32)
+    svm_models = {}
+    for class_id in [1, 2]:
+        y = (X[:,class_id] + 0.5 * rng.randn(400) > 5).astype(int)
+        scaler = preprocessing.StandardScaler().fit(X)
+        model = svm.LinearSVC(C=0.01, random_state=0).fit(scaler.transform(X), y)
+        svm_models[class_id] = (model, scaler)
+
+    # A score of exactly 0 is not a detection: the mean features score the
+    # intercept, which is 0 for class 2
+    svm_models[2][0].intercept_ = np.zeros(1)
+    mean = svm_models[2][1].mean_
+    near_zero = np.vstack((mean, mean + 1e-12, mean - 1e-12, X[0:5] + 0.5 * (mean - X[0:5])))
+
+    model = compact_model.compactModelFromModels(svm_models)
+    for features in [X, near_zero]:
+        scores = model.scores(features)
+        for i, class_id in enumerate(model.class_ids):
+            svm_model, scaler = svm_models[class_id]
+            expected = svm_model.decision_function(scaler.transform(features))
+            assert(np.array_equal(scores[:,i] > 0, expected > 0))
+    assert(svm_models[2][0].decision_function(svm_models[2][1].transform(mean[np.newaxis]))[0] == 0)
+    assert(scores[0,1] == 0)
+    print "Passed all tests."
+
+def ridge_statistics_test():
+    print 'Testing the streamed ridge regression...'
+    rng = np.random.RandomState(0)
+    X = rng.randn(300, 10) + 2
+    y = np.dot(X, rng.randn(10, 4)) + rng.randn(300, 4)
+    statistics = train_bbox.RidgeStatistics(10)
+    for start in xrange(0, 300, 70):
+        statistics.add(X[start:start+70], y[start:start+70])
+    W, b = statistics.solve(alpha=5.0)
+    ridge = linear_model.Ridge(alpha=5.0).fit(X, y)
+    assert(np.allclose(W, ridge.coef_.T, rtol=0, atol=1e-10) and np.allclose(b, ridge.intercept_, rtol=0, atol=1e-10))
+    print "Passed all tests."
+
+# Loop port of starter_code/det_eval.m, the reference of det_eval.det_eval
+def det_eval_loop(gt_bboxes, pred_bboxes):
+    minoverlap = 0.5
+    bboxes = np.vstack([np.reshape(b, (-1, 5)) for b in pred_bboxes])
+    image_ids = np.concatenate([i * np.ones(len(b), dtype=int) for i, b in enumerate(pred_bboxes)])
+    order = np.argsort(-bboxes[:,4], kind='mergesort') # Stable, like sort(..., 'descend')
+
+    detected = [np.zeros(len(g)) for g in gt_bboxes]
+    tp = np.zeros(len(order))
+    fp = np.zeros(len(order))
+    for pred_ind, k in enumerate(order):
+        bb = bboxes[k]
+        gts = gt_bboxes[image_ids[k]]
+        ovmax = -np.inf
+        for g in xrange(len(gts)):
+            bbgt = gts[g]
+            iw = min(bb[2], bbgt[2]) - max(bb[0], bbgt[0]) + 1
+            ih = min(bb[3], bbgt[3]) - max(bb[1], bbgt[1]) + 1
+            if iw > 0 and ih > 0:
+                ua = (bb[2]-bb[0]+1)*(bb[3]-bb[1]+1) + (bbgt[2]-bbgt[0]+1)*(bbgt[3]-bbgt[1]+1) - iw*ih
+                ov = iw*ih/ua
+                if ov > ovmax:
+                    ovmax = ov
+                    jmax = g
+        if ovmax >= minoverlap and not detected[image_ids[k]][jmax]:
+            tp[pred_ind] = 1
+            detected[image_ids[k]][jmax] = 1
+        else:
+            fp[pred_ind] = 1
+
+    fp = np.cumsum(fp)
+    tp = np.cumsum(tp)
+    rec = tp / sum(len(g) for g in gt_bboxes)
+    prec = tp / (fp + tp)
+
+    mrec = np.concatenate(([0], rec, [1]))
+    mpre = np.concatenate(([0], prec, [0]))
+    for i in xrange(len(mpre)-2, -1, -1):
+        mpre[i] = max(mpre[i], mpre[i+1])
+    i = np.where(mrec[1:] != mrec[0:-1])[0] + 1
+    ap = np.sum((mrec[i]-mrec[i-1]) * mpre[i])
+    return ap, prec, rec
+
+def det_eval_loop_test(num_cases=500):
+    print 'Testing det_eval against the loop port of det_eval.m...'
+    rng = np.random.RandomState(0)
+    for case in xrange(num_cases):
+        gt_bboxes, pred_bboxes = [], []
+        for i in xrange(rng.randint(1, 6)):
+            corners = rng.randint(0, 200, (rng.randint(0, 5), 2))
+            gt = np.hstack((corners, corners + rng.randint(5, 100, corners.shape)))
+            # Predictions near the GT bboxes and anywhere, with tied scores
+            near = gt[rng.randint(0, max(len(gt), 1), rng.randint(0, 6))] if len(gt) > 0 else np.zeros((0, 4), dtype=int)
+            near = near + rng.randint(-10, 11, near.shape)
+            corners = rng.randint(0, 200, (rng.randint(0, 4), 2))
+            anywhere = np.hstack((corners, corners + rng.randint(5, 100, corners.shape)))
+            boxes = np.vstack((near, anywhere))
+            scores = np.round(rng.rand(len(boxes), 1), 1)
+            gt_bboxes.append(gt)
+            pred_bboxes.append(np.hstack((boxes, scores)))
+        if sum(len(g) for g in gt_bboxes) == 0 or sum(len(p) for p in pred_bboxes) == 0:
+            continue
+
+        ap, prec, rec = det_eval.det_eval(gt_bboxes, pred_bboxes)
+        m_ap, m_prec, m_rec = det_eval_loop(gt_bboxes, pred_bboxes)
+        assert(np.abs(ap - m_ap) <= TOLERANCE)
+        assert(np.allclose(prec, m_prec, rtol=0, atol=TOLERANCE) and np.allclose(rec, m_rec, rtol=0, atol=TOLERANCE))
     print "Passed all tests."
 
 def eval_test(show_output=False):
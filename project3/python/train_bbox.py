@@ -4,9 +4,13 @@ import time
 import os.path
 import argparse
 import util
+import compact_model
+import feature_store
+import overlap_index
 import numpy as np
 
 from settings import *
+from scipy import linalg
 from sklearn import linear_model
 
 def getBboxParameters(bboxes):
@@ -17,120 +21,256 @@ def getBboxParameters(bboxes):
 
     return c_x, c_y, H, W
 
-def trainBboxRegressionForClass(data, class_id, bbox_regression='normal', debug=False):
-    models = []
-    X_train = []
-    y_train = []
-
-    num_images = len(data["train"]["gt"].keys())
-    # Loop through all images and get features and bbox
-    for i, image_name in enumerate(data["train"]["gt"].keys()):
-        # if (i+1)%50 == 0:
-        #     print 'Processing %d / %d'%(i+1, num_images)
-        features_file_name = os.path.join(FEATURES_DIR, image_name + '.npy')
-        if not os.path.isfile(features_file_name):
-            print 'ERROR: Missing features file \'%s\''%(features_file_name) 
-            sys.exit(1)
+# Returns the regression samples of one image for class_id: the features
+# of its GT bboxes (target 0) and of the regions overlapping them, with
+# their targets (center x, center y, log width, log height). None if the
+# image has no GT bbox of the class
+def getRegressionSamples(image_name, data, class_id, features, overlaps):
+    if len(data["gt"][image_name][0]) == 0:
+        # No Ground truth bboxes in image
+        return None
+
+    labels = np.array(data["gt"][image_name][0][0])
+    gt_bboxes = np.array(data["gt"][image_name][1]).astype(np.int32) # Otherwise uint8 by default
+    IDX = np.where(labels == class_id)[0]
+
+    regions = data["ssearch"][image_name]
+
+    if len(IDX) == 0:
+        # No Ground truth bboxes for this class in image
+        return None
+
+    gt_cx, gt_cy, gt_H, gt_W = getBboxParameters(gt_bboxes[IDX])
 
-        if debug: print features_file_name
-        features = np.load(features_file_name)
+    # Positive examples are the regions overlapping a GT bbox enough. Each one
+    # regresses to the GT bbox of the class it overlaps most
+    max_overlaps, argmax_gt = overlaps[image_name]
+    max_overlaps = max_overlaps[:,class_id-1]
+    argmax_gt = argmax_gt[:,class_id-1]
+    X, y = [], []
+    for j, gt_bbox in enumerate(gt_bboxes[IDX]):
+        positive_idx = np.where(np.logical_and(max_overlaps > BBOX_POSITIVE_THRESHOLD, argmax_gt == IDX[j]))[0]
 
-        if len(data["train"]["gt"][image_name][0]) == 0:
-            # No Ground truth bboxes in image
-            continue
+        gt_features = features[IDX[j], :]
+        proposals_features = features[positive_idx + len(labels), :]
+        proposals_bboxes = regions[positive_idx, :]
+
+        proposals_cx, proposals_cy, proposals_H, proposals_W = getBboxParameters(proposals_bboxes)
+
+        # Compute the bbox parameters: (center_x, center_y, log(width), log(height))
+        X.append(gt_features)
+        y.append(np.array([0.0, 0.0, 0.0, 0.0]))
+
+        X.append(proposals_features)
+        targets = np.zeros((proposals_features.shape[0], 4))
+        targets[:, 0] = np.divide((gt_cx[j] - proposals_cx), proposals_cx)
+        targets[:, 1] = np.divide((gt_cy[j] - proposals_cy), proposals_cy)
+        targets[:, 2] = np.log(gt_W[j]) - np.log(proposals_W)
+        targets[:, 3] = np.log(gt_H[j]) - np.log(proposals_H)
+        y.append(targets)
+
+    return util.stack(X), util.stack(y)
+
+# Yields (class_id, features, targets) of every image and class, reading
+# the features of each image once
+def iterRegressionSamples(image_names, data, class_ids, debug=False):
+    store = feature_store.openFeatureStore()
+    overlaps = overlap_index.getOverlapIndex(data)
+    for image_name in image_names:
+        if image_name not in store:
+            print 'ERROR: Missing features for \'%s\' in %s'%(image_name, FEATURES_DIR)
+            sys.exit(1)
 
-        labels = np.array(data["train"]["gt"][image_name][0][0])
-        gt_bboxes = np.array(data["train"]["gt"][image_name][1]).astype(np.int32) # Otherwise uint8 by default
-        IDX = np.where(labels == class_id)[0]
+        if debug: print image_name
+        features = store.get(image_name)
+        feature_store.checkImageFeatures(image_name, features, data["gt"][image_name][1].shape[0], data["ssearch"][image_name].shape[0])
+        for class_id in class_ids:
+            samples = getRegressionSamples(image_name, data, class_id, features, overlaps)
+            if samples is not None:
+                yield (class_id,) + samples
 
-        # Find positive examples by computing overlap of all regions with GT bbox
-        regions = data["train"]["ssearch"][image_name]
-        overlaps = np.zeros((len(IDX), regions.shape[0]))
+################################################################
+# Streaming ridge regression
+#   The bbox regressors are ridge regressions (with an intercept,
+#   like linear_model.Ridge) of the 4 targets on the features. They
+#   only depend on the sums of X, y, X'X, X'y and y^2 of the
+#   training samples, which are accumulated image by image: memory
+#   is O(d^2) instead of O(N*d). The 4 targets share X'X, so one
+#   Cholesky factorization solves them all. For a sweep of alphas,
+#   the eigendecomposition of X'X is computed once and every alpha
+#   costs a d x d product.
+#
 
-        if len(IDX) == 0:
-            # No Ground truth bboxes for this class in image
-            continue
+RIDGE_ALPHA = 10000 # Regularization of the bbox regressors
+BBOX_VAL_FRACTION = 0.2 # Fraction of the training images held out to select alpha in a sweep
 
-        gt_cx, gt_cy, gt_H, gt_W = getBboxParameters(gt_bboxes[IDX])
+################################################################
+# RidgeStatistics(num_features, num_targets)
+#   Sufficient statistics of a ridge regression. Statistics of
+#   different samples can be added with +=
+#
+class RidgeStatistics:
+    def __init__(self, num_features, num_targets=4):
+        self.n = 0
+        self.sum_x = np.zeros(num_features)
+        self.sum_y = np.zeros(num_targets)
+        self.XtX = np.zeros((num_features, num_features))
+        self.XtY = np.zeros((num_features, num_targets))
+        self.sum_y2 = np.zeros(num_targets)
+        self.eigen = None
 
-        for j, gt_bbox in enumerate(gt_bboxes[IDX]):
-            overlaps = util.computeOverlap(gt_bbox, regions)
-            positive_idx = np.where(overlaps > BBOX_POSITIVE_THRESHOLD)[0]
+    def add(self, X, y):
+        X = np.asarray(X, dtype=np.float64)
+        self.n += X.shape[0]
+        self.sum_x += X.sum(axis=0)
+        self.sum_y += y.sum(axis=0)
+        self.XtX += np.dot(X.T, X)
+        self.XtY += np.dot(X.T, y)
+        self.sum_y2 += np.einsum('ij,ij->j', y, y)
+        self.eigen = None
 
-            gt_features = features[IDX[j], :]
-            proposals_features = features[positive_idx + len(data["train"]["gt"][image_name][0][0]), :]
-            proposals_bboxes = regions[positive_idx, :]
+    def __iadd__(self, other):
+        self.n += other.n
+        self.sum_x += other.sum_x
+        self.sum_y += other.sum_y
+        self.XtX += other.XtX
+        self.XtY += other.XtY
+        self.sum_y2 += other.sum_y2
+        self.eigen = None
+        return self
 
-            proposals_cx, proposals_cy, proposals_H, proposals_W = getBboxParameters(proposals_bboxes)
+    # Means of X and y, and X'X and X'y of the centered samples
+    def centered(self):
+        mean_x = self.sum_x / self.n
+        mean_y = self.sum_y / self.n
+        G = self.XtX - self.n * np.outer(mean_x, mean_x)
+        C = self.XtY - self.n * np.outer(mean_x, mean_y)
+        return mean_x, mean_y, G, C
 
-            # Compute the bbox parameters: (center_x, center_y, log(width), log(height))
-            X_train.append(gt_features)
-            y_train.append(np.array([0.0, 0.0, 0.0, 0.0]))
+    # Returns the d x t weights and t intercepts of the ridge regression
+    def solve(self, alpha=RIDGE_ALPHA):
+        mean_x, mean_y, G, C = self.centered()
+        G[np.diag_indices_from(G)] += alpha
+        W = linalg.cho_solve(linalg.cho_factor(G, overwrite_a=True), C)
+        return W, mean_y - np.dot(mean_x, W)
 
-            X_train.append(proposals_features)
-            targets = np.zeros((proposals_features.shape[0], 4))
+    # Same as solve for every alpha, with one eigendecomposition
+    def solvePath(self, alphas):
+        mean_x, mean_y, G, C = self.centered()
+        if self.eigen is None:
+            eigenvalues, V = linalg.eigh(G)
+            self.eigen = eigenvalues, V, np.dot(V.T, C)
+        eigenvalues, V, VtC = self.eigen
 
-            # print proposals_cx.shape
-            targets[:, 0] = np.divide((gt_cx[j] - proposals_cx), proposals_cx)
-            targets[:, 1] = np.divide((gt_cy[j] - proposals_cy), proposals_cy)
-            targets[:, 2] = np.log(gt_W[j]) - np.log(proposals_W)
-            targets[:, 3] = np.log(gt_H[j]) - np.log(proposals_H)
-            y_train.append(targets)
+        solutions = []
+        for alpha in alphas:
+            W = np.dot(V, VtC / (eigenvalues + alpha)[:,np.newaxis])
+            solutions.append((W, mean_y - np.dot(mean_x, W)))
+        return solutions
 
-    X_train = util.stack(X_train)
-    y_train = util.stack(y_train)
+    # Sum of the squared errors of every target, for the weights W and
+    # intercepts b, over the accumulated samples
+    def squaredErrors(self, W, b):
+        return (self.sum_y2 - 2 * (np.einsum('ij,ij->j', W, self.XtY) + b * self.sum_y)
+            + np.einsum('ij,ij->j', W, np.dot(self.XtX, W)) + 2 * b * np.dot(self.sum_x, W) + self.n * b * b)
 
+# Accumulates the RidgeStatistics of every class over image_names
+def regressionStatistics(image_names, data, class_ids, debug=False):
+    num_features = feature_store.openFeatureStore().num_features
+    statistics = dict((c, RidgeStatistics(num_features)) for c in class_ids)
+    for class_id, X, y in iterRegressionSamples(image_names, data, class_ids, debug):
+        statistics[class_id].add(X, y)
+    return statistics
 
-    print 'X_train:', X_train.shape, 'Y_train', y_train.shape
-    # Now train 4 different regressions, one for each bbox parameter (y_train)
-    # So in total, for the three classes, we will have 12 regressions
+# Returns the ridge models of a regression (4 Ridge models for 'normal',
+# 1 multivariate Ridge otherwise), the same as fitting linear_model.Ridge
+def ridgeModels(W, b, alpha, bbox_regression='normal'):
     if bbox_regression == 'normal':
-        for i in xrange(y_train.shape[1]):
-            model = linear_model.Ridge(alpha = 10000)
-            model.fit(X_train, y_train[:,i])
-            y_hat = model.predict(X_train)
-            print 'Error (Model %d, Class %d): %0.2f'%(i+1, class_id, np.mean(np.abs(y_hat - y_train[:,i])))
-            models.append(model)
+        targets = [(W[:,i], b[i]) for i in xrange(W.shape[1])]
     else:
-        model = linear_model.Ridge(alpha = 10000)
-        model.fit(X_train, y_train)
-        y_hat = model.predict(X_train)
-        l2norm = np.sum(np.abs(y_hat - y_train)**2,axis=-1)**(1./2)
-        print 'Multivariate Error (Model %d, Class %d): %0.2f'%(i+1, class_id, np.mean(l2norm))
-        models.append(model)
+        targets = [(W.T, b)]
 
+    models = []
+    for coef, intercept in targets:
+        model = linear_model.Ridge(alpha=alpha)
+        model.coef_ = np.array(coef)
+        model.intercept_ = intercept
+        models.append(model)
     return models
 
-def predictBoundingBox(models, features, bboxes, regression_type='normal'):
-    targets = np.zeros((features.shape[0], 4))
+################################################################
+# selectRidgeAlpha(train_statistics, val_statistics, alphas)
+#   Alpha sweep: solves the regression of the training statistics
+#   for every alpha and returns the alpha with the lowest squared
+#   error on the validation statistics, with the RMS error of every
+#   alpha
+#
+def selectRidgeAlpha(train_statistics, val_statistics, alphas):
+    errors = []
+    for W, b in train_statistics.solvePath(alphas):
+        errors.append(np.sqrt(max(np.sum(val_statistics.squaredErrors(W, b)), 0) / max(val_statistics.n, 1)))
+    return alphas[int(np.argmin(errors))], errors
 
-    if regression_type == 'normal':
-        for i, model in enumerate(models):
-            targets[:,i] = model.predict(features)
+################################################################
+# trainBboxRegression(data, class_ids)
+#   Trains the bbox regressors of every class in one pass over the
+#   training features. With several alphas, BBOX_VAL_FRACTION of the
+#   images is held out to select the alpha of every class (see
+#   selectRidgeAlpha), and the regressors are then solved on all
+#   images
+#
+# Input: data (training data, see util.readMatrixData)
+#        class_ids (classes to train)
+#        bbox_regression ('normal' or 'multivariate')
+#        alphas (regularizations to sweep)
+# Output: models (dictionary class_id -> list of Ridge models)
+#
+def trainBboxRegression(data, class_ids, bbox_regression='normal', alphas=[RIDGE_ALPHA], debug=False):
+    image_names = sorted(data["gt"].keys())
+    if len(alphas) > 1:
+        val_names = image_names[::int(round(1.0 / BBOX_VAL_FRACTION))]
     else:
-        targets = models[0].predict(features)
+        val_names = []
+    train_names = sorted(set(image_names) - set(val_names))
+
+    statistics = regressionStatistics(train_names, data, class_ids, debug)
+    if len(val_names) > 0:
+        val_statistics = regressionStatistics(val_names, data, class_ids, debug)
+
+    models = dict()
+    for class_id in class_ids:
+        alpha = alphas[0]
+        if len(val_names) > 0:
+            alpha, errors = selectRidgeAlpha(statistics[class_id], val_statistics[class_id], alphas)
+            for a, error in zip(alphas, errors):
+                print 'Validation error (Class %d, alpha %g): %0.4f'%(class_id, a, error)
+            statistics[class_id] += val_statistics[class_id]
+
+        class_statistics = statistics[class_id]
+        print 'Class %d: %d samples, alpha %g'%(class_id, class_statistics.n, alpha)
+        W, b = class_statistics.solve(alpha)
+        squared_errors = np.maximum(class_statistics.squaredErrors(W, b), 0) / class_statistics.n
+        if bbox_regression == 'normal':
+            for i in xrange(W.shape[1]):
+                print 'RMS Error (Model %d, Class %d): %0.2f'%(i+1, class_id, np.sqrt(squared_errors[i]))
+        else:
+            print 'Multivariate RMS Error (Class %d): %0.2f'%(class_id, np.sqrt(np.sum(squared_errors)))
+        models[class_id] = ridgeModels(W, b, alpha, bbox_regression)
+
+    return models
+
+# Trains the bbox regressors of one class, see trainBboxRegression
+def trainBboxRegressionForClass(data, class_id, bbox_regression='normal', debug=False):
+    return trainBboxRegression(data["train"], [class_id], bbox_regression, debug=debug)[class_id]
+
+# The targets of all 4 bbox parameters come from one matrix product
+# (regression_type is given by the models, 4 Ridge models for 'normal')
+def predictBoundingBox(models, features, bboxes, regression_type='normal'):
+    W, b = compact_model.regressionArrays(models)
+    targets = np.dot(features, W) + b
 
     # Convert from targets to bboxes
-    Px = 0.5 * (bboxes[:,0]+bboxes[:,2])
-    Py = 0.5 * (bboxes[:,1]+bboxes[:,3])
-    Pw = bboxes[:,2] - bboxes[:,0] + 1
-    Ph = bboxes[:,3] - bboxes[:,1] + 1
-
-    # Solve for G using Equations 1,2,3,4 from paper
-    Gx = np.multiply(targets[:,0], Px) + Px
-    Gy = np.multiply(targets[:,1], Py) + Py
-    Gw = np.multiply(Pw, np.exp(targets[:,2]))
-    Gh = np.multiply(Ph, np.exp(targets[:,3]))
-
-    center = np.vstack((Gx.T, Gy.T)).T
-    offset = 0.5*np.vstack((Gw.T, Gh.T)).T
-    top_left = center - offset
-    bottom_right = center + offset
-
-    new_bboxes = np.vstack((top_left.T, bottom_right.T)).T
-    scores = np.reshape(bboxes[:,4], (bboxes[:,4].shape[0],1))
-
-    return np.hstack((new_bboxes, scores))
+    return compact_model.applyBboxTargets(targets, bboxes)
 
 def main():
     print "Error: Do not run train_bbox.py directly. You should use main.py."
@@ -2,225 +2,264 @@ import os
 import sys
 import time
 import util
+import feature_store
+import overlap_index
 import numpy as np
 import random
 
 from sklearn import svm
+from sklearn import preprocessing
 from sklearn.linear_model import SGDClassifier
 from settings import *
 
-def getTrainingFeatures(image_names, data, class_id, debug=False):
-    X_pos, X_neg = [], []
+# Returns the positive and negative features of one image for class_id
+# (both n x NUM_CNN_FEATURES, possibly empty)
+def getImageSamples(image_name, data, class_id, store, overlaps):
+    # Load features from file for current image
+    if image_name not in store:
+        print 'ERROR: Missing features for \'%s\' in %s'%(image_name, FEATURES_DIR)
+        sys.exit(1)
+    features = store.get(image_name)
+
+    num_gt_bboxes = data["gt"][image_name][0].shape[1]
+    feature_store.checkImageFeatures(image_name, features, num_gt_bboxes, data["ssearch"][image_name].shape[0])
+    no_positives = features[0:0, :]
+
+    # Case 1: No GT boxes in image. Cannot compute overlap with regions.
+    # Case 2: No GT boxes in image for current class
+    # Case 3: GT boxes in image for current class
+    if num_gt_bboxes == 0: # Case 1
+        return no_positives, features
+
+    labels = np.array(data["gt"][image_name][0][0])
+    IDX = np.where(labels == class_id)[0]
+
+    if len(IDX) == 0: # Case 2
+        return no_positives, features
+
+    regions = data["ssearch"][image_name]
+    highest_overlaps = overlaps[image_name][0][:,class_id-1]
+
+    # TODO: PLOTTT THIISSS
+    # import matplotlib.pyplot as plt
+    # plt.hist(highest_overlaps[highest_overlaps>0.001], bins=200)
+    # plt.show()
+     
+    assert(max(IDX) < num_gt_bboxes)
+    assert((features.shape[0] - num_gt_bboxes) == regions.shape[0])
+
+    # Select Positive/Negatives Regions
+    positive_idx = np.where(highest_overlaps > POSITIVE_THRESHOLD)[0]
+    positive_idx += num_gt_bboxes
+    X_pos = np.vstack((features[IDX, :], # GT box
+        features[positive_idx, :])) # GT box overlapping regions
+    
+    # Only add negative examples where bbox is far from all GT boxes
+    negative_idx = np.where(highest_overlaps < NEGATIVE_THRESHOLD)[0]
+    negative_idx += num_gt_bboxes
+    X_neg = features[negative_idx, :]
+
+    return X_pos, X_neg
+
+# Yields the positive and negative features of every image, one image at a time
+def iterImageSamples(image_names, data, class_id, debug=False):
     num_images = len(image_names)
+    store = feature_store.openFeatureStore()
+    overlaps = overlap_index.getOverlapIndex(data)
     start_time = time.time()
     for i, image_name in enumerate(image_names):
-        # Load features from file for current image
-        features_file_name = os.path.join(FEATURES_DIR, image_name + '.npy')
-        if not os.path.isfile(features_file_name):
-            print 'ERROR: Missing features file \'%s\''%(features_file_name) 
-            sys.exit(1)
-        features = np.load(features_file_name)
+        yield getImageSamples(image_name, data, class_id, store, overlaps)
 
-        num_gt_bboxes = data["gt"][image_name][0].shape[1]
+        if debug:
+            if (i+1) % 50 == 0:
+                print "Finished %i / %i.\tElapsed: %f" % (i+1, num_images, time.time()-start_time)
 
-        # Case 1: No GT boxes in image. Cannot compute overlap with regions.
-        # Case 2: No GT boxes in image for current class
-        # Case 3: GT boxes in image for current class
-        if num_gt_bboxes == 0: # Case 1
-            X_neg.append(features)
-        else:
-            labels = np.array(data["gt"][image_name][0][0])
-            gt_bboxes = np.array(data["gt"][image_name][1])
-            IDX = np.where(labels == class_id)[0]
+def getTrainingFeatures(image_names, data, class_id, debug=False):
+    X_pos, X_neg = [], []
+    for image_pos, image_neg in iterImageSamples(image_names, data, class_id, debug):
+        if image_pos.shape[0] > 0:
+            X_pos.append(image_pos)
+        X_neg.append(image_neg)
 
-            if len(IDX) == 0: # Case 2
-                X_neg.append(features)
-            else:
-                regions = data["ssearch"][image_name]
+    return X_pos, X_neg
 
-                overlaps = np.zeros((regions.shape[0], len(IDX)))
-                for j, gt_bbox in enumerate(gt_bboxes[IDX]):
-                    overlaps[:,j] = util.computeOverlap(gt_bbox, regions)
-                highest_overlaps = overlaps.max(axis=1)
+################################################################
+# Streaming hard negative mining
+#   The negatives of a class are never stacked. They are read in
+#   float32 blocks of NEGATIVE_BLOCK_SIZE rows (image by image from
+#   the feature store, or from a memory-mapped matrix), scored with
+#   the weights of the current SVM (the scaler folded in, see
+#   util.foldScaler), and only the misclassified ones enter a
+#   NegativeCache of bounded size. The scaler is fitted once on all
+#   training features, so retraining does not refit it.
+#
+
+NEGATIVE_BLOCK_SIZE = 30000 # Negatives scored at once
+RETRAIN_NUM_HARD = 10000 # The SVM is retrained after this many new hard negatives
+
+# Yields the negatives of image_names (in random image order) in blocks of block_size rows
+def iterNegatives(image_names, data, class_id, block_size=NEGATIVE_BLOCK_SIZE):
+    image_names = list(image_names)
+    random.shuffle(image_names)
+
+    blocks, num_rows = [], 0
+    for _, image_neg in iterImageSamples(image_names, data, class_id):
+        blocks.append(image_neg)
+        num_rows += image_neg.shape[0]
+        while num_rows >= block_size:
+            block = np.vstack(blocks)
+            yield np.asarray(block[0:block_size], dtype=np.float32)
+            blocks, num_rows = [block[block_size:]], num_rows - block_size
+    if num_rows > 0:
+        yield np.asarray(np.vstack(blocks), dtype=np.float32)
+
+# Yields the rows of X (e.g. a memory-mapped matrix) in blocks of block_size rows, in random block order
+def iterBlocks(X, block_size=NEGATIVE_BLOCK_SIZE):
+    for start in np.random.permutation(np.arange(0, X.shape[0], block_size)):
+        yield np.asarray(X[start:start+block_size], dtype=np.float32)
+
+# Fits the scaler of a class once, on the positives and all negative blocks
+def fitScaler(X_pos, negative_blocks):
+    scaler = preprocessing.StandardScaler()
+    scaler.partial_fit(X_pos)
+    for X_neg in negative_blocks:
+        scaler.partial_fit(X_neg)
+    return scaler
+
+# Returns a function computing the decision scores of raw features in float32
+def linearScorer(model, scaler):
+    w, b = util.foldScaler(model, scaler)
+    w = w[:,0].astype(np.float32)
+    b = np.float32(b[0])
+    return lambda X: np.dot(X, w) + b
+
+################################################################
+# NegativeCache(capacity, num_features)
+#   Hard negatives and their decision scores. Holds at most
+#   capacity + slack rows: when it is full, only the highest
+#   scoring rows are kept
+#
+class NegativeCache:
+    def __init__(self, capacity, num_features, slack=RETRAIN_NUM_HARD+NEGATIVE_BLOCK_SIZE):
+        self.capacity = capacity
+        self.features = np.zeros((capacity + slack, num_features), dtype=np.float32)
+        self.scores = np.zeros(capacity + slack, dtype=np.float32)
+        self.size = 0
+
+    def add(self, features, scores):
+        if self.size + features.shape[0] > self.features.shape[0]:
+            self.keep(self.capacity)
+        free = self.features.shape[0] - self.size
+        if features.shape[0] > free:
+            IDX = np.argsort(-1*scores, kind='mergesort')[0:free]
+            features, scores = features[IDX], scores[IDX]
+        self.features[self.size:self.size+features.shape[0]] = features
+        self.scores[self.size:self.size+features.shape[0]] = scores
+        self.size += features.shape[0]
+
+    # Scores the cached rows again, with a new model
+    def rescore(self, scorer):
+        self.scores[0:self.size] = scorer(self.features[0:self.size])
+
+    # Keeps the k highest scoring rows, ordered by decreasing score
+    def keep(self, k):
+        IDX = np.argsort(-1*self.scores[0:self.size], kind='mergesort')[0:k]
+        self.size = IDX.shape[0]
+        self.features[0:self.size] = self.features[IDX]
+        self.scores[0:self.size] = self.scores[IDX]
+
+    def get(self):
+        return self.features[0:self.size]
+
+################################################################
+# mineHardNegatives(X_pos, negatives, scaler)
+#   Hard negative mining. The first block of negatives trains the
+#   initial SVM. Every following block is scored, its misclassified
+#   negatives are cached, and once RETRAIN_NUM_HARD new ones are
+#   cached the memory_size highest scoring negatives are kept and
+#   the SVM is retrained on them
+#
+# Input: X_pos (positive features)
+#        negatives (function returning an iterator over blocks of negatives, called once per epoch)
+#        scaler (see fitScaler)
+#        memory_size (maximum number of hard negatives kept)
+#        C, B, W (SVM hyperparameters, see trainSVM)
+# Output: hard_negs (at most memory_size x NUM_CNN_FEATURES matrix)
+#
+def mineHardNegatives(X_pos, negatives, scaler, epochs=1, memory_size=30000, C=0.01, B=50, W={1:10}, output_dir=MODELS_DIR, debug=False):
+    cache = NegativeCache(memory_size, X_pos.shape[1])
+    scorer = None
+    num_new_hard = 0
+    num_seen = 0
+    for epoch in xrange(epochs):
+        for X_neg in negatives():
+            if debug: print "[INFO] Negative traversal process: %d"%(num_seen)
+            num_seen += X_neg.shape[0]
+            if scorer is None:
+                if debug: print 'Training SVM...'
+                start_time = time.time()
+                model, _ = trainSVM(X_pos, X_neg, C=C, B=B, W=W, scaler=scaler, output_dir=output_dir)
+                if debug: print 'Training took: %f'%(time.time() - start_time)
 
-                # TODO: PLOTTT THIISSS
-                # import matplotlib.pyplot as plt
-                # plt.hist(highest_overlaps[highest_overlaps>0.001], bins=200)
-                # plt.show()
-                 
-                assert(max(IDX) < num_gt_bboxes)
-                assert((features.shape[0] - num_gt_bboxes) == regions.shape[0])
+                scorer = linearScorer(model, scaler)
+                cache.add(X_neg, scorer(X_neg))
+                continue
 
-                # Select Positive/Negatives Regions
-                positive_idx = np.where(highest_overlaps > POSITIVE_THRESHOLD)[0]
-                positive_idx += num_gt_bboxes
-                X_pos.append(features[IDX, :]) # GT box
-                X_pos.append(features[positive_idx, :]) # GT box overlapping regions
-                
-                # Only add negative examples where bbox is far from all GT boxes
-                negative_idx = np.where(highest_overlaps < NEGATIVE_THRESHOLD)[0]
-                negative_idx += num_gt_bboxes
-                X_neg.append(features[negative_idx, :])
+            # Classify negative features using small_svm
+            scores = scorer(X_neg)
+            hard_idx = np.where(scores > 0)[0]
+            cache.add(X_neg[hard_idx], scores[hard_idx])
+            num_new_hard += hard_idx.shape[0]
+            if debug: print 'Num Hard: %d / %d'%(hard_idx.shape[0], X_neg.shape[0])
 
-        if debug:
-            if (i+1) % 50 == 0:
-                print "Finished %i / %i.\tElapsed: %f" % (i+1, num_images, time.time()-start_time)
+            # Check if we need to retrain SVM
+            if num_new_hard > RETRAIN_NUM_HARD:
+                # Keep only max_num_neg negatives
+                cache.rescore(scorer)
+                cache.keep(memory_size)
 
-    return X_pos, X_neg
+                if debug: print 'Retraining SVM (Num hard: %d)...'%(num_new_hard)
+                start_time = time.time()
+                model, _ = trainSVM(X_pos, cache.get(), C=C, B=B, W=W, scaler=scaler, output_dir=output_dir)
+                if debug: print 'Retraining took: %f'%(time.time() - start_time)
 
-def trainClassifierForClass(data, class_id, epochs=1, memory_size=30000, C=0.01, B=50, W={1:10}, output_dir=MODELS_DIR, evaluate=False, debug=False):
-    X_pos = []
-    X_neg = []
-    X_pos_val = []
-    X_neg_val = []
+                scorer = linearScorer(model, scaler)
+                num_new_hard = 0
 
+    if scorer is None:
+        return np.zeros((0, X_pos.shape[1]), dtype=np.float32)
+
+    # Keep only max_num_neg negatives
+    cache.rescore(scorer)
+    cache.keep(memory_size)
+    return cache.get().copy()
+
+def trainClassifierForClass(data, class_id, epochs=1, memory_size=30000, C=0.01, B=50, W={1:10}, output_dir=MODELS_DIR, evaluate=False, debug=False):
     # Split train into train and val set
     val_set_images = random.sample(data["train"]["gt"].keys(), 100)
     train_set_images = list(set(data["train"]["gt"].keys()) - set(val_set_images))
     # test_set_images = data["test"]["gt"].keys()
 
-    X_pos, X_neg = getTrainingFeatures(train_set_images, data["train"], class_id)
+    # Only the positives and the validation set are held in memory
+    X_pos = util.stack([image_pos for image_pos, _ in iterImageSamples(train_set_images, data["train"], class_id, debug)])
     X_pos_val, X_neg_val = getTrainingFeatures(val_set_images, data["train"], class_id)
-    # X_pos_test, X_neg_test = getTrainingFeatures(test_set_images, data["test"], class_id)
-
-    model = None
-    scaler = None
-    if debug: print 'Stacking...'
-    start_time = time.time()
-    X_pos = util.stack(X_pos)
-    X_neg = util.stack(X_neg)
     X_pos_val = util.stack(X_pos_val)
     X_neg_val = util.stack(X_neg_val)
-    # X_pos_test = util.stack(X_pos_test)
-    # X_neg_test = util.stack(X_neg_test)
-    end_time = time.time()
-    if debug: print 'Stacking took: %f'%(end_time - start_time)
-
-    if debug: print X_pos.shape, X_neg.shape, X_pos_val.shape, X_neg_val.shape
+    negatives = lambda: iterNegatives(train_set_images, data["train"], class_id)
 
-    if debug: print 'Normalizing and adding bias to positive...'
+    if debug: print 'Fitting the scaler...'
     start_time = time.time()
-    # X_pos = util.normalizeAndAddBias(X_pos)
-    end_time = time.time()
-    if debug: print 'Normalizing and adding bias to positive took: %f'%(end_time - start_time)
-
-    num_positives = X_pos.shape[0]
-    num_negatives = X_neg.shape[0]
-    hard_negs = []
-    curr_num_hard_negs = 0
-    for epoch in xrange(epochs):
-        X_neg_idx = np.random.permutation(num_negatives)
-
-        start_idx = 0
-        # increment = 2*num_positives
-        increment = 30000
-        while start_idx < num_negatives:
-            if debug: print "[INFO] Negative traversal process: %d / %d"%(start_idx, num_negatives)
-            end_idx = min(start_idx + increment, num_negatives)
-            if model is None:
-                if debug: print 'Picking Features'
-                start_time = time.time()
-                X_neg_subset = X_neg[X_neg_idx[start_idx:end_idx], :]
-                end_time = time.time()
-                if debug: print 'Picking took: %f'%(end_time - start_time)
-
-                if debug: print 'Training SVM...'
-                start_time = time.time()
-                model, scaler = trainSVM(X_pos, X_neg_subset, C=C, B=B, W=W, output_dir=output_dir)
-                end_time = time.time()
-                if debug: print 'Training took: %f'%(end_time - start_time)
+    scaler = fitScaler(X_pos, negatives())
+    if debug: print 'Fitting the scaler took: %f'%(time.time() - start_time)
 
-                hard_negs.append(X_neg_subset)
-                num_iter_since_retrain = 0
-            else:
-                if debug: print 'Picking Features'
-                start_time = time.time()
-                X_neg_subset = X_neg[X_neg_idx[start_idx:end_idx], :]
-                end_time = time.time()
-                if debug: print 'Picking took: %f'%(end_time - start_time)
+    hard_negs = mineHardNegatives(X_pos, negatives, scaler, epochs, memory_size, C, B, W, output_dir, debug)
 
-                if debug: print 'Normalizing and adding bias to negative subset...'
-                start_time = time.time()
-                X_neg_subset_1, _ = util.normalizeAndAddBias(X_neg_subset, scaler)
-                end_time = time.time()
-                if debug: print 'Normalizing and adding bias to negative subset took: %f'%(end_time - start_time)
-
-                # Classify negative features using small_svm
-                y_hat = model.predict(X_neg_subset_1)
-                hard_idx = np.where(y_hat == 1)[0]
-                hard_negs_subset = X_neg_subset[hard_idx, :]
-                hard_negs.append(hard_negs_subset)
-                
-                curr_num_hard_negs += hard_negs_subset.shape[0]
-                if debug: print 'Num Hard: %d / %d'%(hard_negs_subset.shape[0], X_neg_subset.shape[0])
-
-                # Check if we need to retrain SVM
-                if curr_num_hard_negs > 10000:
-                    hard_negs = util.stack(hard_negs)
-
-                    # Filter negs
-                    X, _ = util.normalizeAndAddBias(hard_negs, scaler)
-                    conf = model.decision_function(X)
-                    y_hat = model.predict(X)
-                    # y = model.predict(X)
-                    # print conf[IDX[10000:10100]], y[IDX[10000:10100]]
-
-                    # Discard 1/4th easy examples
-                    # IDX = np.argsort(conf)
-                    # IDX = IDX[IDX.shape[0]/4:]
-                    
-                    # Keep only max_num_neg negatives
-                    IDX = np.argsort(-1*conf)
-                    IDX = IDX[0:min(memory_size, IDX.shape[0])]
-                    
-                    # Keep only negatives with decision score > -1.0
-                    # IDX = np.where(conf > -1.0)[0]
-                    
-                    # print 'Old num hard negs: %d'%(hard_negs.shape[0])
-                    hard_negs = hard_negs[IDX,:]
-                    # print 'New num hard negs: %d'%(hard_negs.shape[0])
-
-                    if debug: print 'Retraining SVM (Skipped %d retrains) (Num hard: %d)...'%(num_iter_since_retrain, curr_num_hard_negs)
-                    start_time = time.time()
-                    model, scaler = trainSVM(X_pos, hard_negs, C=C, B=B, W=W, output_dir=output_dir)
-                    end_time = time.time()
-                    if debug: print 'Retraining took: %f'%(end_time - start_time)
-                    # getValidationAccuracy(model, X_pos_val, X_neg_val)
-
-                    # Keep only misclassified
-                    # hard_idx = np.where(y_hat == 1)[0]
-                    # hard_negs_subset = hard_negs[hard_idx, :]
-                    
-                    # Keep only max_num_neg negatives
-                    # max_num_neg = 30000
-                    # IDX = np.argsort(-1*conf)
-                    # IDX = IDX[0:min(max_num_neg, IDX.shape[0])]
-                    # hard_negs_subset = hard_negs[IDX,:]
-
-                    hard_negs = [hard_negs]
-                    curr_num_hard_negs = 0
-                    num_iter_since_retrain = 0
-                else:
-                    num_iter_since_retrain += 1
-                    # print 'No retrain required (Num hard: %d)'%(curr_num_hard_negs)
-
-            start_idx += increment
-
-    if debug: print 'Retraining SVM (Final)...'
-    hard_negs = util.stack(hard_negs)
-    X, _ = util.normalizeAndAddBias(hard_negs, scaler)
-    conf = model.decision_function(X)
-    
-    # Keep only max_num_neg negatives
-    IDX = np.argsort(-1*conf)
-    IDX = IDX[0:min(memory_size, IDX.shape[0])]
-    hard_negs = hard_negs[IDX,:]
     if evaluate:
-        model, scaler, train_acc = trainSVM(X_pos, hard_negs, model=model,  C=C, B=B, W=W, output_dir=output_dir, evaluate=evaluate, debug=True)
+        model, scaler, train_acc = trainSVM(X_pos, hard_negs, C=C, B=B, W=W, scaler=scaler, output_dir=output_dir, evaluate=evaluate, debug=True)
         val_acc = getValidationAccuracy(model, scaler, X_pos_val, X_neg_val, evaluate=evaluate, output_dir=output_dir)
         return (model, scaler, train_acc, val_acc)
     else:
-        model, scaler = trainSVM(X_pos, hard_negs, model=model,  C=C, B=B, W=W, output_dir=output_dir, evaluate=evaluate, debug=True)
+        model, scaler = trainSVM(X_pos, hard_negs, C=C, B=B, W=W, scaler=scaler, output_dir=output_dir, evaluate=evaluate, debug=True)
         getValidationAccuracy(model, scaler, X_pos_val, X_neg_val, evaluate=evaluate, output_dir=output_dir)
         return (model, scaler)
 
@@ -238,14 +277,15 @@ def trainSGDClassifierForClass(data, class_id, epochs=1, memory_size=1000, debug
     curr_pos = []
     curr_neg = []
     num_images = len(train_set_images)
+    store = feature_store.openFeatureStore()
+    overlaps = overlap_index.getOverlapIndex(data["train"])
     start_time = time.time()
     for i, image_name in enumerate(train_set_images):
         # Load features from file for current image
-        features_file_name = os.path.join(FEATURES_DIR, image_name + '.npy')
-        if not os.path.isfile(features_file_name):
-            print 'ERROR: Missing features file \'%s\''%(features_file_name) 
+        if image_name not in store:
+            print 'ERROR: Missing features for \'%s\' in %s'%(image_name, FEATURES_DIR)
             sys.exit(1)
-        features = np.load(features_file_name)
+        features = store.get(image_name)
 
         num_gt_bboxes = data["train"]["gt"][image_name][0].shape[1]
 
@@ -256,18 +296,12 @@ def trainSGDClassifierForClass(data, class_id, epochs=1, memory_size=1000, debug
             curr_neg.append(features)
         else:
             labels = np.array(data["train"]["gt"][image_name][0][0])
-            gt_bboxes = np.array(data["train"]["gt"][image_name][1])
             IDX = np.where(labels == class_id)[0]
 
             if len(IDX) == 0: # Case 2
                 curr_neg.append(features)
             else:
-                regions = data["train"]["ssearch"][image_name]
-
-                overlaps = np.zeros((regions.shape[0], len(IDX)))
-                for j, gt_bbox in enumerate(gt_bboxes[IDX]):
-                    overlaps[:,j] = util.computeOverlap(gt_bbox, regions)
-                highest_overlaps = overlaps.max(axis=1)
+                highest_overlaps = overlaps[image_name][0][:,class_id-1]
 
                 # Select Positive/Negatives Regions
                 positive_idx = np.where(highest_overlaps > POSITIVE_THRESHOLD)[0]
@@ -354,7 +388,7 @@ def getValidationAccuracy(model, scaler, X_pos_val, X_neg_val, evaluate=False, o
     if evaluate:
         return (pos_acc, neg_acc, tot_acc)
     
-def trainSVM(pos_features, neg_features, model=None, C=0.001, B=50, W={1:6}, output_dir=MODELS_DIR, evaluate=False, debug=False):
+def trainSVM(pos_features, neg_features, model=None, C=0.001, B=50, W={1:6}, scaler=None, output_dir=MODELS_DIR, evaluate=False, debug=False):
     start_time = time.time()
 
     if debug: 
@@ -372,9 +406,9 @@ def trainSVM(pos_features, neg_features, model=None, C=0.001, B=50, W={1:6}, out
     # neg_features = neg_features[IDX,:]
     # print neg_features.shape
     
-    # Build inputs
+    # Build inputs (the scaler is fitted on them unless one is given)
     X = np.vstack((pos_features,neg_features))
-    X, scaler = util.normalizeAndAddBias(X)
+    X, scaler = util.normalizeAndAddBias(X, scaler)
 
     y = [np.ones((pos_features.shape[0], 1)), np.zeros((neg_features.shape[0], 1))]
     y = np.squeeze(np.vstack(tuple(y)))
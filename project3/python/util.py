@@ -3,8 +3,10 @@ import os.path
 import sys
 
 import numpy as np
+import compact_model
+import dataset_manifest
 
-from scipy.io import loadmat
+from scipy import sparse
 from sklearn import preprocessing
 from settings import *
 
@@ -49,6 +51,129 @@ def computeOverlap(bbox, bboxes):
 
 	return overlap
 
+################################################################
+# computePairOverlaps(bboxes_a, bboxes_b)
+#   Elementwise version of computeOverlap. bboxes_a and bboxes_b
+#   are broadcast against each other, e.g. (M x 1 x 4) and
+#   (1 x N x 4) give the M x N overlaps of all pairs
+#
+# Input: bboxes_a (... x 4 matrix)
+#        bboxes_b (... x 4 matrix)
+# Output: overlaps (matrix of the broadcast shape, without the last axis)
+#
+def computePairOverlaps(bboxes_a, bboxes_b):
+	# Contiguous coordinates make the broadcast operations much faster
+	ax1, ay1, ax2, ay2 = [np.ascontiguousarray(bboxes_a[...,i]) for i in xrange(4)]
+	bx1, by1, bx2, by2 = [np.ascontiguousarray(bboxes_b[...,i]) for i in xrange(4)]
+
+	# Work in place on the (possibly very large) temporaries
+	w = np.minimum(bx2, ax2)
+	w -= np.maximum(bx1, ax1)
+	w += 1
+	h = np.minimum(by2, ay2)
+	h -= np.maximum(by1, ay1)
+	h += 1
+	np.maximum(w, 0, out=w)
+	np.maximum(h, 0, out=h)
+	inter = w
+	inter *= h
+
+	# Same order of operations as computeOverlap, so the results are identical
+	union = (bx2-bx1+1)*(by2-by1+1) + 1.0*((ax2-ax1+1)*(ay2-ay1+1))
+	union -= inter
+	union[inter == 0] = 1 # The bboxes do not intersect
+
+	overlaps = inter.astype(np.float64)
+	overlaps /= union
+	return overlaps
+
+################################################################
+# computeOverlaps(bboxes_a, bboxes_b)
+#   Computes the overlap of every bbox in bboxes_a with every bbox
+#   in bboxes_b. Row i is computeOverlap(bboxes_a[i], bboxes_b).
+#   The rows are computed in chunks of at most max_elements pairs
+#   to bound the memory of the temporaries
+#
+# Input: bboxes_a (M x 4 matrix, extra columns such as scores are ignored)
+#        bboxes_b (N x 4 matrix)
+#        max_elements (number of pairs computed at once)
+# Output: overlaps (M x N matrix)
+#
+def computeOverlaps(bboxes_a, bboxes_b, max_elements=1<<22):
+	bboxes_a = np.asarray(bboxes_a).reshape((-1, np.shape(bboxes_a)[-1]))[:,0:4]
+	bboxes_b = np.asarray(bboxes_b).reshape((-1, np.shape(bboxes_b)[-1]))[:,0:4]
+	M, N = bboxes_a.shape[0], bboxes_b.shape[0]
+
+	overlaps = np.zeros((M, N))
+	if M == 0 or N == 0:
+		return overlaps
+
+	chunk_size = max(1, max_elements / N)
+	for start in xrange(0, M, chunk_size):
+		end = min(start + chunk_size, M)
+		overlaps[start:end] = computePairOverlaps(bboxes_a[start:end,np.newaxis,:], bboxes_b[np.newaxis,:,:])
+
+	return overlaps
+
+################################################################
+# computeSparseOverlaps(bboxes_a, bboxes_b)
+#   Sparse version of computeOverlaps for large sets, where most
+#   pairs do not intersect. bboxes_b is sorted by x1, so the only
+#   candidates of a bbox in bboxes_a are an interval of that order
+#   (every bbox starting at most one width of the widest bbox
+#   before it, and before its end). Only the candidate pairs are
+#   computed, and pairs with an overlap of at most min_overlap are
+#   dropped
+#
+# Input: bboxes_a (M x 4 matrix)
+#        bboxes_b (N x 4 matrix)
+#        min_overlap (only overlaps strictly above it are kept)
+#        max_elements (number of candidate pairs computed at once)
+# Output: overlaps (M x N scipy.sparse.csr_matrix)
+#
+def computeSparseOverlaps(bboxes_a, bboxes_b, min_overlap=0.0, max_elements=1<<22):
+	bboxes_a = np.asarray(bboxes_a).reshape((-1, np.shape(bboxes_a)[-1]))[:,0:4]
+	bboxes_b = np.asarray(bboxes_b).reshape((-1, np.shape(bboxes_b)[-1]))[:,0:4]
+	M, N = bboxes_a.shape[0], bboxes_b.shape[0]
+	if M == 0 or N == 0:
+		return sparse.csr_matrix((M, N))
+
+	order = np.argsort(bboxes_b[:,0], kind='mergesort')
+	sorted_b = bboxes_b[order]
+	max_width = (sorted_b[:,2] - sorted_b[:,0]).max()
+
+	# Candidates of a: a.x1 - max_width <= b.x1 <= a.x2
+	lo = np.searchsorted(sorted_b[:,0], bboxes_a[:,0] - max_width, side='left')
+	hi = np.searchsorted(sorted_b[:,0], bboxes_a[:,2], side='right')
+	counts = np.maximum(hi - lo, 0)
+	cumulative_counts = np.cumsum(counts)
+
+	rows, cols, values = [], [], []
+	start = 0
+	while start < M:
+		# Take as many rows as fit in max_elements candidate pairs
+		done = cumulative_counts[start-1] if start > 0 else 0
+		end = np.searchsorted(cumulative_counts, done + max_elements, side='right')
+		end = min(max(end, start + 1), M)
+		chunk_counts = counts[start:end]
+		total = chunk_counts.sum()
+		if total > 0:
+			pair_rows = np.repeat(np.arange(start, end), chunk_counts)
+			# Position of every pair inside the candidate interval of its row
+			offsets = np.arange(total) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+			pair_cols = lo[pair_rows] + offsets
+
+			pair_overlaps = computePairOverlaps(bboxes_a[pair_rows], sorted_b[pair_cols])
+			keep = pair_overlaps > min_overlap
+			rows.append(pair_rows[keep])
+			cols.append(order[pair_cols[keep]])
+			values.append(pair_overlaps[keep])
+		start = end
+
+	if len(rows) == 0:
+		return sparse.csr_matrix((M, N))
+	return sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=(M, N))
+
 ################################################################
 # randomColor()
 #   Generates a random color from our color list
@@ -153,6 +278,22 @@ def normalizeAndAddBias(X, scaler = None):
 	
 	return X_t, scaler
 
+################################################################
+# foldScaler(model, scaler)
+#   Folds the normalization of scaler into the weights of a linear
+#   model (e.g. LinearSVC), so that the decision scores of raw
+#   features are X.dot(w) + b, without normalizing X (see
+#   compact_model.foldWeights)
+#
+# Input: model (linear model with coef_ and intercept_)
+#        scaler (see normalizeAndAddBias)
+# Output: w (num features x num outputs matrix)
+#         b (num outputs vector)
+#
+def foldScaler(model, scaler):
+	w, b = compact_model.foldWeights(*compact_model.linearModelArrays(model, scaler))
+	return w[:,np.newaxis], np.array([b])
+
 def stack(data):
 	result = None
 	if len(data) == 0:
@@ -166,7 +307,9 @@ def stack(data):
 
 ################################################################
 # readMatrixData()
-#   Reads the Matlab matrix data into a nice dictionary format
+#   Reads the Matlab matrix data into a nice dictionary format. The
+#   data comes from a dataset manifest converted once from the
+#   Matlab files (see dataset_manifest.py)
 #
 # Input: "train" or "test"
 # Output: A dictionary data, see examples below
@@ -174,21 +317,4 @@ def stack(data):
 #   data["train"]["gt"]["2008_007640.jpg"] = tuple( [[2]] , [[ 90,  85, 500, 366]] )
 #   data["train"]["ssearch"]["2008_007640.jpg"] = n x 4 matrix of region proposals (bboxes)
 def readMatrixData(phase):
-    # Read the matrix files
-    raw_ims = {}
-    raw_ims.update(loadmat(os.path.join(ML_DIR, phase + "_ims.mat")))
-
-    raw_ssearch = {}
-    raw_ssearch.update(loadmat(os.path.join(ML_DIR, "ssearch_" + phase + ".mat")))
-
-    # Populate our new, cleaner dictionary
-    data = {}
-    data["gt"] = {}
-    data["ssearch"] = {}
-
-    for i in xrange(raw_ims["images"].shape[1]):
-        filename, labels, bboxes = raw_ims["images"][0,i]
-        data["gt"][filename[0]] = (labels, bboxes.astype(np.int32))
-        data["ssearch"][filename[0]] = raw_ssearch["ssearch_boxes"][0,i].astype(np.int32)
-
-    return data
\ No newline at end of file
+    return dataset_manifest.readDataset(phase)
\ No newline at end of file
@@ -0,0 +1,135 @@
+import cv2
+import numpy as np
+
+from settings import *
+
+################################################################
+# padImage(img)
+#   Pads the image with INDICATOR_PAD_SIZE pixels on every side.
+#   The padding is filled with -1's, which indicate that the
+#   pixel will be replaced with the image mean after warping.
+#   Only used by warpRegion in main.py, warpRegions needs no padding
+#
+# Input: img (H x W x 3 matrix)
+# Output: padded_img (float32 matrix of (H+2*PAD) x (W+2*PAD) x 3)
+#
+def padImage(img):
+    H, W, _ = img.shape
+
+    padded_img = -1 * np.ones((H + 2*INDICATOR_PAD_SIZE, W + 2*INDICATOR_PAD_SIZE, 3), dtype=np.float32)
+
+    # Add the region to the center of this new "padded" image
+    start = INDICATOR_PAD_SIZE
+    padded_img[start:start+H, start:start+W, :] = img
+
+    return padded_img
+
+################################################################
+# computeWarpWindows(regions)
+#   Computes the crop window (region plus context) of every region
+#   at once, in image coordinates (windows near the borders extend
+#   past the image). Uses the same arithmetic as warpRegion in
+#   main.py
+#
+# Input: regions (n x 4 matrix of 0-indexed bboxes)
+# Output: windows (n x 4 matrix where each row is [startY, endY, startX, endX])
+#
+def computeWarpWindows(regions):
+    regions = regions.astype(np.int64)
+
+    bbH = regions[:,3] - regions[:,1] + 1 # Plus one to include the box as part of the region
+    bbW = regions[:,2] - regions[:,0] + 1
+
+    subimg_size = float(CNN_INPUT_SIZE - CONTEXT_SIZE) # Usually 227-16 = 211
+
+    # Compute the scaling factors. Original region boxes must be sized to subimg_size
+    scaleH = subimg_size / bbH
+    scaleW = subimg_size / bbW
+
+    # Compute how many context pixels we need from the original image
+    contextW = np.ceil(CONTEXT_SIZE / scaleW).astype(np.int64)
+    contextH = np.ceil(CONTEXT_SIZE / scaleH).astype(np.int64)
+
+    windows = np.zeros((regions.shape[0], 4), dtype=np.int64)
+    windows[:,0] = regions[:,1] - contextH
+    windows[:,1] = regions[:,3] + contextH + 1
+    windows[:,2] = regions[:,0] - contextW
+    windows[:,3] = regions[:,2] + contextW + 1
+
+    return windows
+
+# Returns the warped rows (or columns) [low, high) that come from inside
+# the image, for a window [start, end) along an image side of length size.
+# cv2.resize samples warped pixel d at (d + 0.5) * (end - start) / CNN_INPUT_SIZE - 0.5
+# in the window, and the image covers [-start - 0.5, size - start - 0.5)
+def insideRange(start, end, size):
+    scale = float(CNN_INPUT_SIZE) / (end - start)
+    low = int(np.ceil(max(0, -start) * scale - 0.5))
+    high = int(np.ceil((min(end, size) - start) * scale - 0.5))
+    return min(max(low, 0), CNN_INPUT_SIZE), min(max(high, 0), CNN_INPUT_SIZE)
+
+################################################################
+# warpRegions(img, regions, img_mean, out=None, pool=None)
+#   Batched version of warpRegion. Warps all regions of the image
+#   and writes the results directly into a (possibly preallocated)
+#   float32 batch. Just like extractRegionFeatsFromImage used to,
+#   every warped region is stored with W and H swapped, which is
+#   what pycaffe expects
+#
+#   Windows inside the image are resized straight from the image.
+#   Windows that extend past the image only copy their inside part
+#   (with the border pixels replicated), and the warped pixels that
+#   come from outside the image are then set to the mean image,
+#   with the bounds given by insideRange. The image is never padded
+#   and the warped pixels are never scanned for the mean
+#
+# Input: img (H x W x 3 matrix, float32 is used as is)
+#        regions (n x 4 matrix of 0-indexed bboxes)
+#        img_mean (CNN_INPUT_SIZE x CNN_INPUT_SIZE x 3 mean image)
+#        out (optional n x CNN_INPUT_SIZE x CNN_INPUT_SIZE x 3 float32 buffer)
+#        pool (optional thread pool. cv2.resize releases the GIL, so the
+#              regions are warped concurrently)
+# Output: out (n x CNN_INPUT_SIZE x CNN_INPUT_SIZE x 3 float32 batch)
+#
+def warpRegions(img, regions, img_mean, out=None, pool=None):
+    num_regions = regions.shape[0]
+    if out is None:
+        out = np.zeros((num_regions, CNN_INPUT_SIZE, CNN_INPUT_SIZE, 3), dtype=np.float32)
+
+    img = np.asarray(img, dtype=np.float32)
+    H, W = img.shape[0:2]
+    windows = computeWarpWindows(regions)
+
+    img_mean = img_mean.astype(np.float32)
+
+    def warp(i):
+        startY, endY, startX, endX = windows[i]
+        if startY >= 0 and startX >= 0 and endY <= H and endX <= W:
+            resized_img = cv2.resize(img[startY:endY, startX:endX, :], (CNN_INPUT_SIZE, CNN_INPUT_SIZE), interpolation=cv2.INTER_LINEAR)
+        elif startY >= H or startX >= W or endY <= 0 or endX <= 0:
+            # Entirely outside of the image
+            resized_img = img_mean.copy()
+        else:
+            inside = img[max(startY, 0):min(endY, H), max(startX, 0):min(endX, W), :]
+            cropped_region = cv2.copyMakeBorder(inside, max(-startY, 0), max(endY - H, 0),
+                max(-startX, 0), max(endX - W, 0), cv2.BORDER_REPLICATE)
+            resized_img = cv2.resize(cropped_region, (CNN_INPUT_SIZE, CNN_INPUT_SIZE), interpolation=cv2.INTER_LINEAR)
+
+            # Replace the pixels from outside the image with the mean image
+            low, high = insideRange(startY, endY, H)
+            resized_img[0:low] = img_mean[0:low]
+            resized_img[high:] = img_mean[high:]
+            low, high = insideRange(startX, endX, W)
+            resized_img[:, 0:low] = img_mean[:, 0:low]
+            resized_img[:, high:] = img_mean[:, high:]
+
+        # Swap W,H to H,W straight into the batch (much faster than
+        # copying a np.swapaxes view)
+        cv2.transpose(resized_img, dst=out[i])
+
+    if pool is None:
+        map(warp, xrange(num_regions))
+    else:
+        pool.map(warp, xrange(num_regions))
+
+    return out